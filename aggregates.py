@@ -0,0 +1,234 @@
+import heapq
+
+import clear_types
+import goldens
+import local_cache
+import timing
+from constants import ClearType, DiffType
+from state import ClearState
+
+# running totals over the whole state, kept up to date from every run's changes instead of being recounted from the
+# clears page, so milestones and leaderboards cost about as much as the diff. saved in the list's cache as:
+#   {"batch": <id of the state sheet save they're for (see event_log.py)>,
+#    "players": {player: {star difficulty: {ClearType name: number of cells}}},
+#    "maps": {map name: {"stars": star difficulty, "counts": {ClearType name: number of cells}}},
+#    "first_goldens": {trimmed map name: player who got the first golden (None if it was there before we looked)},
+#    "milestones": {player: {star difficulty: highest clear count milestone announced}}}
+# star difficulties are strings, since these are json keys. every [C] and [FC] row counts on its own, like the
+# "# of Challenges" the clears page counts.
+
+AGGREGATES_FILE_NAME = "aggregates.json"
+# a player reaching one of these numbers of clears of one star difficulty gets announced
+MILESTONE_CLEAR_COUNTS = (10, 25, 50, 100, 250, 500, 1000)
+MILESTONE_MIN_STAR_DIFFICULTY = 4
+LEADERBOARD_SIZE = 5
+
+
+def new_aggregates():
+    return {"batch": None, "players": {}, "maps": {}, "first_goldens": {}, "milestones": {}}
+
+
+# the saved aggregates if they're for the state that was saved as batch_id, otherwise None
+def load_aggregates(batch_id):
+    aggregates = local_cache.load_json(AGGREGATES_FILE_NAME)
+    if batch_id is None or aggregates is None or aggregates.get("batch") != batch_id:
+        return None
+    return aggregates
+
+
+def save_aggregates(aggregates, batch_id):
+    aggregates["batch"] = batch_id
+    local_cache.save_json(AGGREGATES_FILE_NAME, aggregates)
+
+
+# counts a whole state, as the changes from an empty one, without announcing anything that's already there
+def build_aggregates(state, map_catalog):
+    aggregates = new_aggregates()
+    cell_changes = [(player_name, map_name, value) for (player_name, map_name), value in state.items()]
+    update_aggregates(aggregates, ClearState(), [], cell_changes, map_catalog, announce=False)
+    return aggregates
+
+
+# applies one run's changes (its diff list and raw cell changes, see clears.get_state_diff_list_and_cell_changes) to
+# aggregates, which have to be for previous_state. map_catalog is the current state's (see maps.MapCatalog). returns
+# the milestone diffs the changes earned:
+#   (DiffType.CLEAR_MILESTONE, player, clear count, star difficulty)
+#   (DiffType.FIRST_GOLDEN, player, trimmed map name, star difficulty)
+# with announce=False, milestones are only recorded, so they're never announced later.
+def update_aggregates(aggregates, previous_state, diff_list, cell_changes, map_catalog, announce=True):
+    removed_players = set()
+    removed_maps = set()
+    player_renamings = {}
+    map_renamings = {}
+    for diff_type, *values in diff_list:
+        match diff_type:
+            case DiffType.REMOVED_PLAYER:
+                removed_players.add(values[0])
+            case DiffType.REMOVED_MAP:
+                removed_maps.add(values[0])
+            case DiffType.RENAMED_PLAYER:
+                player_renamings[values[0]] = values[1]
+            case DiffType.RENAMED_MAP:
+                map_renamings[values[0]] = values[1]
+
+    players = aggregates["players"]
+    maps = aggregates["maps"]
+
+    # take out everything of removed maps and players, using the old names
+    for map_name in removed_maps:
+        stars = maps[map_name]["stars"]
+        map_clear_type = map_catalog.clear_type(map_name)
+        for player_name, value in previous_state.row_items(map_name):
+            if player_name not in removed_players:
+                add_cell(aggregates, player_name, map_name, value, stars, map_clear_type, -1)
+        del maps[map_name]
+    for player_name in removed_players:
+        for map_name in previous_state.map_names():
+            value = previous_state.get((player_name, map_name))
+            if value and map_name not in removed_maps:
+                add_cell(aggregates, player_name, map_name, value, maps[map_name]["stars"],
+                         map_catalog.clear_type(map_name), -1)
+        players.pop(player_name, None)
+        aggregates["milestones"].pop(player_name, None)
+
+    # recount the rows of maps that moved to another star difficulty or were renamed to another clear type (which
+    # can change what their cells count as). this is the only part that looks at every map, not just changed ones.
+    for old_map_name, map_aggregates in list(maps.items()):
+        new_map_name = map_renamings.get(old_map_name, old_map_name)
+        new_stars = map_catalog.star_difficulty(new_map_name)
+        if new_stars is None:
+            new_stars = map_aggregates["stars"]
+        old_clear_type = map_catalog.clear_type(old_map_name)
+        new_clear_type = map_catalog.clear_type(new_map_name)
+        if new_stars == map_aggregates["stars"] and old_clear_type == new_clear_type:
+            continue
+        for player_name, value in previous_state.row_items(old_map_name):
+            if player_name not in removed_players:
+                add_cell(aggregates, player_name, old_map_name, value, map_aggregates["stars"], old_clear_type, -1)
+                add_cell(aggregates, player_name, old_map_name, value, new_stars, new_clear_type, 1)
+        map_aggregates["stars"] = new_stars
+
+    for old_player_name, new_player_name in player_renamings.items():
+        for name_dict in (players, aggregates["milestones"]):
+            if old_player_name in name_dict:
+                name_dict[new_player_name] = name_dict.pop(old_player_name)
+    for old_map_name, new_map_name in map_renamings.items():
+        maps[new_map_name] = maps.pop(old_map_name)
+        old_trimmed_map_name = map_catalog.trimmed_name(old_map_name)
+        new_trimmed_map_name = map_catalog.trimmed_name(new_map_name)
+        first_goldens = aggregates["first_goldens"]
+        # copied rather than moved, since the other row of a [C]/[FC] pair can keep the old name
+        if old_trimmed_map_name in first_goldens and new_trimmed_map_name not in first_goldens:
+            first_goldens[new_trimmed_map_name] = first_goldens[old_trimmed_map_name]
+
+    # the changed cells, which use the new names
+    old_player_names = {new_name: old_name for old_name, new_name in player_renamings.items()}
+    old_map_names = {new_name: old_name for old_name, new_name in map_renamings.items()}
+    # (player, star difficulty) -> clear count before this run, for the players whose counts changed
+    old_clear_counts = {}
+    milestone_diffs = []
+
+    for player_name, map_name, new_value in cell_changes:
+        _, trimmed_map_name, map_clear_type = map_catalog[map_name]
+        if map_name not in maps:
+            maps[map_name] = {"stars": map_catalog[map_name][0], "counts": {}}
+        stars = maps[map_name]["stars"]
+        count_key = (player_name, stars)
+        if count_key not in old_clear_counts:
+            old_clear_counts[count_key] = clear_count(aggregates, player_name, stars)
+
+        old_value = previous_state.get((old_player_names.get(player_name, player_name),
+                                        old_map_names.get(map_name, map_name)), "")
+        if old_value:
+            add_cell(aggregates, player_name, map_name, old_value, stars, map_clear_type, -1)
+        if new_value:
+            clear_type = add_cell(aggregates, player_name, map_name, new_value, stars, map_clear_type, 1)
+            if clear_type in goldens.GOLDEN_CLEAR_TYPES and trimmed_map_name not in aggregates["first_goldens"]:
+                aggregates["first_goldens"][trimmed_map_name] = player_name if announce else None
+                if announce:
+                    milestone_diffs.append((DiffType.FIRST_GOLDEN, player_name, trimmed_map_name, stars))
+
+    for (player_name, stars), old_count in old_clear_counts.items():
+        new_count = clear_count(aggregates, player_name, stars)
+        milestone = max((count for count in MILESTONE_CLEAR_COUNTS if count <= new_count), default=0)
+        player_milestones = aggregates["milestones"].setdefault(player_name, {})
+        if milestone <= max(old_count, player_milestones.get(str(stars), 0)):
+            continue
+        player_milestones[str(stars)] = milestone
+        if announce and stars >= MILESTONE_MIN_STAR_DIFFICULTY:
+            milestone_diffs.append((DiffType.CLEAR_MILESTONE, player_name, milestone, stars))
+
+    return milestone_diffs
+
+
+# adds sign (1 or -1) times the cell to the counts of its player and map, where map_clear_type is the map's "[C]" or
+# "[FC]" (see helpers.trim_map_name). returns the cell's ClearType.
+def add_cell(aggregates, player_name, map_name, value, stars, map_clear_type, sign):
+    clear_type = clear_types.cell_value_to_clear_type(value, map_clear_type)
+    players = aggregates["players"]
+    player_star_counts = players.setdefault(player_name, {})
+    counts = player_star_counts.setdefault(str(stars), {})
+    add_count(counts, clear_type.name, sign)
+    # don't keep empty counts around, so the aggregates only depend on the state and not on how it got there
+    if not counts:
+        del player_star_counts[str(stars)]
+        if not player_star_counts:
+            del players[player_name]
+    map_aggregates = aggregates["maps"].get(map_name)
+    if map_aggregates is not None:
+        add_count(map_aggregates["counts"], clear_type.name, sign)
+    return clear_type
+
+
+def add_count(counts, key, amount):
+    count = counts.get(key, 0) + amount
+    if count:
+        counts[key] = count
+    else:
+        del counts[key]
+
+
+# how many rows of one star difficulty the player has a recognized clear of
+def clear_count(aggregates, player_name, stars):
+    counts = aggregates["players"].get(player_name, {}).get(str(stars), {})
+    return sum(count for clear_type_name, count in counts.items() if clear_type_name != ClearType.OTHER.name)
+
+
+# returns a list of (star difficulty, [(player, clear count), ...]) from the hardest star difficulty down, and then
+# (None, [(player, golden count), ...]) for goldens of any difficulty, with the top LEADERBOARD_SIZE players of each
+def get_leaderboard(aggregates, size=LEADERBOARD_SIZE):
+    # star difficulty -> [(player, clear count)]
+    clear_counts = {}
+    golden_counts = []
+    golden_clear_type_names = {clear_type.name for clear_type in goldens.GOLDEN_CLEAR_TYPES}
+    for player_name, player_counts in aggregates["players"].items():
+        num_goldens = 0
+        for stars, counts in player_counts.items():
+            count = sum(count for clear_type_name, count in counts.items() if clear_type_name != ClearType.OTHER.name)
+            if count:
+                clear_counts.setdefault(int(stars), []).append((player_name, count))
+            num_goldens += sum(counts.get(clear_type_name, 0) for clear_type_name in golden_clear_type_names)
+        if num_goldens:
+            golden_counts.append((player_name, num_goldens))
+
+    def top(counts):
+        # ties go to the alphabetically first player, so the leaderboard doesn't flicker between runs
+        return heapq.nsmallest(size, counts, key=lambda player_and_count: (-player_and_count[1], player_and_count[0]))
+
+    leaderboard = [(stars, top(clear_counts[stars])) for stars in sorted(clear_counts, reverse=True)]
+    if golden_counts:
+        leaderboard.append((None, top(golden_counts)))
+    return leaderboard
+
+
+# brings the saved aggregates up to date with a run's changes. returns (aggregates for current_state, milestone diffs).
+# if the saved aggregates aren't for previous_state, which was saved as saved_batch_id (e.g. on the first run, or after
+# losing the cache), they're counted again from current_state instead, and nothing gets announced.
+def update_saved_aggregates(saved_batch_id, previous_state, current_state, diff_list, cell_changes, map_catalog):
+    aggregates = load_aggregates(saved_batch_id)
+    if aggregates is None:
+        timing.count("aggregates_rebuilt")
+        return build_aggregates(current_state, map_catalog), []
+    milestone_diffs = update_aggregates(aggregates, previous_state, diff_list, cell_changes, map_catalog)
+    timing.count("milestones", len(milestone_diffs))
+    return aggregates, milestone_diffs
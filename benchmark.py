@@ -0,0 +1,243 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+import clears
+import discord
+import goldens
+import local_cache
+import synthetic
+import timing
+from constants import FIRST_REAL_MAP_ROW_INDEX
+
+# name -> (number of players, number of maps)
+SIZES = {
+    "tiny": (100, 500),
+    "small": (500, 1000),
+    "medium": (2000, 2500),
+    "large": (5000, 4000),
+    "huge": (10000, 5000),
+}
+DEFAULT_SIZES = ["tiny", "small", "medium"]
+
+# a best time this much slower than the baseline's counts as a regression in --compare
+REGRESSION_THRESHOLD = 1.25
+# benchmarks faster than this (in seconds) are too noisy to compare
+MIN_COMPARED_TIME = 0.001
+
+
+def time_call(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+# the most memory (in bytes) allocated at once while running func, not counting what it returns
+def measure_peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+# returns the removed and added player dicts and the removed and added map dicts, the way
+# clears.old_and_new_entities_to_added_removed_renamed would pass them to maybe_pair_removed_and_added_entities
+def get_rename_inputs(previous_state, current_state):
+    entity_sets = []
+    for state in (previous_state, current_state):
+        player_clears = defaultdict(set)
+        map_clearers = defaultdict(set)
+        for player_name, map_name in state.keys():
+            player_clears[player_name].add(map_name)
+            map_clearers[map_name].add(player_name)
+        entity_sets.append((player_clears, map_clearers))
+
+    (old_player_clears, old_map_clearers), (new_player_clears, new_map_clearers) = entity_sets
+    rename_inputs = []
+    for old_entities, new_entities in ((old_player_clears, new_player_clears), (old_map_clearers, new_map_clearers)):
+        rename_inputs.append((
+            {name: old_entities[name] for name in old_entities.keys() - new_entities.keys()},
+            {name: new_entities[name] for name in new_entities.keys() - old_entities.keys()},
+        ))
+    return rename_inputs
+
+
+# generates a list of the given size, edits it, and times every hot path on it. returns a list of result dicts.
+# noinspection PyShadowingNames
+def run_size(size_name, num_players, num_maps, args):
+    with timing.Timer(f"Generating {size_name} list ({num_players} players x {num_maps} maps)... "):
+        page = synthetic.make_clears_page(num_players, num_maps, args.fill, args.fc_pairs, args.seed)
+        edited_page = synthetic.edit_clears_page(page, args.edits, args.renames, args.seed)
+        cld = synthetic.make_cld(edited_page, seed=args.seed)
+        edited_map_rows = edited_page[FIRST_REAL_MAP_ROW_INDEX:]
+
+        previous_state, _ = clears.get_current_state_and_maps_from_sheet_values(page)
+        current_state, map_catalog = clears.get_current_state_and_maps_from_sheet_values(edited_page)
+        diff_list = clears.get_state_diff_list(previous_state, current_state, map_catalog)
+        (removed_players, added_players), (removed_maps, added_maps) = get_rename_inputs(previous_state,
+                                                                                         current_state)
+        # so rendering golden clears doesn't go to the sheet for their tiers
+        goldens.prime_golden_tiers(cld)
+
+    benchmarks = [
+        ("parse_clears_page", lambda: clears.get_current_state_and_maps_from_sheet_values(edited_page)),
+        ("diff", lambda: clears.get_state_diff_list(previous_state, current_state, map_catalog)),
+        ("parse_and_diff", lambda: clears.get_state_diff_list_and_cell_changes(
+            previous_state, *clears.get_current_state_and_maps_from_clears_rows(edited_page[0], edited_map_rows))),
+        ("parse_and_diff_stream", lambda: clears.get_current_state_and_diffs_streaming(
+            previous_state, edited_page[0], edited_map_rows)),
+        ("match_renamed_players", lambda: clears.maybe_pair_removed_and_added_entities(removed_players, added_players)),
+        ("match_renamed_maps", lambda: clears.maybe_pair_removed_and_added_entities(removed_maps, added_maps)),
+        ("save_state_as_grid", lambda: clears.save_state_as_grid(current_state)),
+        ("parse_golden_tiers", lambda: goldens.parse_golden_tiers(cld)),
+        ("render_messages", lambda: discord.render_diff_messages(diff_list, args.batch_mode)),
+    ]
+
+    try:
+        import numpy_diff
+        benchmarks.append(("diff_numpy", lambda: numpy_diff.get_state_diff_list_and_cell_changes(
+            previous_state, current_state, map_catalog)))
+    except ImportError:
+        pass
+
+    results = []
+    for name, func in benchmarks:
+        if args.only and name not in args.only:
+            continue
+        with timing.Timer(f"  {name}... ", lambda d: f"{d:.3f} sec total"):
+            times = time_call(func, args.repeat)
+        result = {
+            "size": size_name,
+            "players": num_players,
+            "maps": num_maps,
+            "cells": len(current_state),
+            "diffs": len(diff_list),
+            "name": name,
+            "times": times,
+            "min": min(times),
+            "median": statistics.median(times),
+        }
+        if args.memory:
+            result["peak_memory"] = measure_peak_memory(func)
+            print(f"    peak memory: {result['peak_memory'] / 2 ** 20:.1f} MiB")
+        results.append(result)
+    return results
+
+
+def get_git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                                    text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+
+# prints how every benchmark's best time compares to the same benchmark in a baseline report (the best time is less
+# noisy than the median). returns whether any of them regressed.
+def compare_reports(report, baseline_report):
+    baseline_times = {(result["size"], result["name"]): result["min"] for result in baseline_report["results"]}
+    regressed = False
+
+    print(f"Compared to {baseline_report.get('commit') or 'baseline'}:")
+    for result in report["results"]:
+        baseline_time = baseline_times.get((result["size"], result["name"]))
+        if baseline_time is None or baseline_time < MIN_COMPARED_TIME:
+            continue
+        ratio = result["min"] / baseline_time
+        marker = ""
+        if ratio > REGRESSION_THRESHOLD:
+            marker = "  <-- REGRESSION"
+            regressed = True
+        print(f"  {result['size']:<8} {result['name']:<24} {baseline_time:9.4f} -> {result['min']:9.4f} sec "
+              f"({ratio:.2f}x){marker}")
+
+    return regressed
+
+
+# noinspection PyShadowingNames
+def main(args):
+    # keep the golden tiers cache of real runs out of this
+    local_cache.CACHE_DIR = tempfile.mkdtemp(prefix="histcord_benchmark_")
+
+    commit, dirty = get_git_commit()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "fill": args.fill,
+            "fc_pairs": args.fc_pairs,
+            "edits": args.edits,
+            "renames": args.renames,
+            "batch_mode": args.batch_mode,
+            "memory": args.memory,
+        },
+        "results": [],
+    }
+
+    for size_name in args.sizes:
+        num_players, num_maps = SIZES[size_name]
+        report["results"] += run_size(size_name, num_players, num_maps, args)
+
+    output = args.output or os.path.join("benchmarks", f"{commit or 'unknown'}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline_report = json.load(f)
+        if compare_reports(report, baseline_report):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the hot paths on generated lists")
+    parser.add_argument("-s", "--sizes", nargs="+", choices=SIZES.keys(), default=DEFAULT_SIZES,
+                        help=f"List sizes to run, from {', '.join(f'{k} ({p}x{m})' for k, (p, m) in SIZES.items())} "
+                             f"(default: {' '.join(DEFAULT_SIZES)})")
+    parser.add_argument("--only", nargs="+", help="Only run these benchmarks")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Times to run each benchmark (default: 5)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated lists (default: 0)")
+    parser.add_argument("--fill", type=float, default=0.05,
+                        help="Fraction of cells with a clear in them (default: 0.05)")
+    parser.add_argument("--fc-pairs", type=float, default=0.3,
+                        help="Fraction of maps that come as a [C]/[FC] pair (default: 0.3)")
+    parser.add_argument("--edits", type=float, default=0.01,
+                        help="Fraction of clears that are removed, changed or added between runs (default: 0.01)")
+    parser.add_argument("--renames", type=float, default=0.005,
+                        help="Fraction of players and maps that are renamed between runs (default: 0.005)")
+    parser.add_argument("-b", "--batch-mode", choices=discord.BATCH_MODES, default=discord.DEFAULT_BATCH_MODE,
+                        help="Batch mode to render messages with (default: lines)")
+    parser.add_argument("-m", "--memory", action="store_true",
+                        help="Also measure the peak memory of every benchmark (in one extra run, with tracemalloc)")
+    parser.add_argument("-o", "--output",
+                        help="Where to save the results as JSON (default: benchmarks/<commit>.json)")
+    parser.add_argument("-c", "--compare",
+                        help="Results JSON from an earlier run to compare against. Exits with 1 on a regression.")
+    args = parser.parse_args()
+
+    main(args)
@@ -1,3 +1,6 @@
+import functools
+
+import helpers
 from constants import ClearType
 
 
@@ -21,35 +24,76 @@ def is_clear_type_or_repeated(val, pattern):
     return is_clear_type(val, pattern) or is_repeated_and_numbered(val, pattern)
 
 
+# every rule is (clear type, pattern, whether numbered repeats like "v1 v2" also count, required suffix, whether it only
+# applies to [FC] maps). the first matching rule wins, so the order matters.
+CLEAR_TYPE_RULES = [
+    (ClearType.NO_VIDEO_FC, "nv fc", False, "", False),
+    (ClearType.NO_VIDEO_FC, "nv", False, "", True),
+    (ClearType.NO_VIDEO, "nv", False, "", False),
+    (ClearType.VIDEO_FC, "fc", True, "", False),
+    (ClearType.VIDEO_FC, "v", True, "", True),
+    (ClearType.VIDEO_AND_FC, "v fc", False, "", False),
+    (ClearType.VIDEO, "v", True, "", False),
+    (ClearType.CREATOR_FC, "creator [fc]", False, "", False),
+    (ClearType.CREATOR_FC, "creator", False, "", True),
+    (ClearType.CREATOR, "creator", False, "", False),
+    (ClearType.GOLDEN_FC, "fcg", False, "", False),
+    (ClearType.GOLDEN_AND_FC, "g & fc", False, "", False),
+    (ClearType.GOLDEN, "g", False, "", False),
+    (ClearType.ALL_SILVERS, "s", True, "", False),
+    (ClearType.ALL_SILVERS_AND_FC, "s", True, " & fc", False),
+]
+
+# how many distinct (cell value, map clear type) pairs to remember. a whole list only has a few hundred.
+CLEAR_TYPE_CACHE_SIZE = 4096
+
+
+def compile_clear_type_rules(rules, is_map_fc):
+    compiled_rules = []
+    for clear_type, pattern, allow_repeated, suffix, fc_map_only in rules:
+        if fc_map_only and not is_map_fc:
+            continue
+        matches = is_clear_type_or_repeated if allow_repeated else is_clear_type
+        compiled_rules.append((clear_type, pattern, matches, suffix))
+    return compiled_rules
+
+
+# rules for non-[FC] maps and [FC] maps
+_COMPILED_CLEAR_TYPE_RULES = (compile_clear_type_rules(CLEAR_TYPE_RULES, False),
+                              compile_clear_type_rules(CLEAR_TYPE_RULES, True))
+
+
+@functools.lru_cache(maxsize=CLEAR_TYPE_CACHE_SIZE)
+def normalized_value_to_clear_type(val, is_map_fc):
+    for clear_type, pattern, matches, suffix in _COMPILED_CLEAR_TYPE_RULES[is_map_fc]:
+        if suffix:
+            if val.endswith(suffix) and matches(val.removesuffix(suffix), pattern):
+                return clear_type
+        elif matches(val, pattern):
+            return clear_type
+
+    return ClearType.OTHER
+
+
 # takes the cell value and the map clear type (i.e. "[C]", "[FC]", or something else irrelevant)
 def cell_value_to_clear_type(cell_value, map_clear_type):
-    val = cell_value.strip().lower()
-
-    is_map_fc = (map_clear_type == "[FC]")
-
-    if is_clear_type(val, "nv fc") or (is_map_fc and is_clear_type(val, "nv")):
-        return ClearType.NO_VIDEO_FC
-    elif is_clear_type(val, "nv"):
-        return ClearType.NO_VIDEO
-    elif is_clear_type_or_repeated(val, "fc") or (is_map_fc and is_clear_type_or_repeated(val, "v")):
-        return ClearType.VIDEO_FC
-    elif is_clear_type(val, "v fc") or (is_map_fc and is_clear_type_or_repeated(val, "v")):
-        return ClearType.VIDEO_AND_FC
-    elif is_clear_type_or_repeated(val, "v"):
-        return ClearType.VIDEO
-    elif is_clear_type(val, "creator [fc]") or (is_map_fc and is_clear_type(val, "creator")):
-        return ClearType.CREATOR_FC
-    elif is_clear_type(val, "creator"):
-        return ClearType.CREATOR
-    elif is_clear_type(val, "fcg"):
-        return ClearType.GOLDEN_FC
-    elif is_clear_type(val, "g & fc"):
-        return ClearType.GOLDEN_AND_FC
-    elif is_clear_type(val, "g"):
-        return ClearType.GOLDEN
-    elif is_clear_type_or_repeated(val, "s"):
-        return ClearType.ALL_SILVERS
-    elif val.endswith(" & fc") and is_clear_type_or_repeated(val.removesuffix(" & fc"), "s"):
-        return ClearType.ALL_SILVERS_AND_FC
+    return normalized_value_to_clear_type(cell_value.strip().lower(), map_clear_type == "[FC]")
 
-    return ClearType.OTHER
+
+# classifies every distinct cell value in a state (e.g. the whole clears page) once.
+# returns a dict of (cell value, map clear type) -> ClearType
+def state_to_clear_types(state):
+    # map name -> map clear type, so we only trim every map name once
+    map_clear_types = {}
+    clear_types = {}
+
+    for (_, map_name), cell_value in state.items():
+        map_clear_type = map_clear_types.get(map_name)
+        if map_clear_type is None:
+            _, map_clear_type = helpers.trim_map_name(map_name)
+            map_clear_types[map_name] = map_clear_type
+        key = (cell_value, map_clear_type)
+        if key not in clear_types:
+            clear_types[key] = cell_value_to_clear_type(cell_value, map_clear_type)
+
+    return clear_types
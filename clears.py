@@ -1,27 +1,59 @@
+import collections
 import itertools
+import operator
 import sys
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 import helpers
-from constants import DiffType, MAP_PREFIXES_TO_IGNORE, MIN_PLAYER_COL_INDEX, FIRST_REAL_MAP_ROW_INDEX, \
-    FIRST_REAL_MAP_STAR_DIFFICULTY
+import lists
+from constants import DiffType
+from maps import MapCatalog
+from state import ClearState
 
 
-def get_current_state_and_maps_from_sheet_values(all_values):
-    if len(all_values) < 1 or len(all_values[0]) < MIN_PLAYER_COL_INDEX:
+# for a whole page, as returned by get_all_values
+def get_current_state_and_maps_from_sheet_values(all_values, previous_map_catalog=None):
+    if len(all_values) < 1:
+        print("ERROR: Sheet is too small or doesn't follow the ID/Label structure.")
+        sys.exit(1)
+
+    # use islice to start at a certain index. more efficient than making a copy of the entire table
+    # (i.e. all_values[first_i:]) or skipping every row up to the first one (if row_i < first_i: continue).
+    first_map_row_i = lists.current().first_real_map_row_index
+    return get_current_state_and_maps_from_clears_rows(all_values[0],
+                                                       itertools.islice(all_values, first_map_row_i, None),
+                                                       previous_map_catalog)
+
+
+# player_names_row is the first row of the clears page, and map_rows are its rows starting at the list's
+# first_real_map_row_index (see sheets.load_current_clears_from_main_sheet). returns (current_state, map_catalog), where
+# the catalog falls back to previous_map_catalog for maps that aren't on the page anymore (see maps.MapCatalog).
+def get_current_state_and_maps_from_clears_rows(player_names_row, map_rows, previous_map_catalog=None):
+    first_player_i = lists.current().min_player_col_index
+    if len(player_names_row) < first_player_i:
         print("ERROR: Sheet is too small or doesn't follow the ID/Label structure.")
         sys.exit(1)
 
     # includes the column label cells, but we utilize this so we don't have to mess with column indices
-    player_names = all_values[0]
-    map_difficulties = {}
-    current_state = {}
+    player_names = player_names_row
+    map_catalog = MapCatalog(previous_map_catalog)
+    current_state = ClearState()
+
+    for map_name, map_star_difficulty, row in iter_map_rows(map_rows):
+        map_catalog.add(map_name, map_star_difficulty)
+        helpers.parse_data_row(row, first_player_i, current_state, player_names)
+
+    return current_state, map_catalog
+
+
+# yields (map name, star difficulty, row) for every real map row of the clears page
+def iter_map_rows(map_rows):
+    list_config = lists.current()
+    map_prefixes_to_ignore = list_config.map_prefixes_to_ignore
     previous_map_empty = False
-    map_star_difficulty = FIRST_REAL_MAP_STAR_DIFFICULTY
+    map_star_difficulty = list_config.first_real_map_star_difficulty
 
-    # use islice to start at a certain index. more efficient than making a copy of the entire table
-    # (i.e. all_values[first_i:]) or skipping every row up to the first one (if row_i < first_i: continue).
-    for row in itertools.islice(all_values, FIRST_REAL_MAP_ROW_INDEX, None):
+    for row in map_rows:
         # skip empty rows (shouldn't happen, but just in case)
         if not row:
             continue
@@ -29,7 +61,7 @@ def get_current_state_and_maps_from_sheet_values(all_values):
         map_name = row[0]
 
         # skip weird rows
-        if any(map_name.startswith(prefix) for prefix in MAP_PREFIXES_TO_IGNORE):
+        if any(map_name.startswith(prefix) for prefix in map_prefixes_to_ignore):
             continue
 
         # two empty map names in a row means we've reached a new star difficulty
@@ -41,63 +73,81 @@ def get_current_state_and_maps_from_sheet_values(all_values):
                 previous_map_empty = True
             continue
 
-        map_difficulties[map_name] = map_star_difficulty
-        first_player_i = MIN_PLAYER_COL_INDEX
-        helpers.parse_data_row(row, first_player_i, current_state, player_names)
+        yield map_name, map_star_difficulty, row
 
-    return current_state, map_difficulties
 
+# yields a (player_name, map_name, value) record for every non-empty cell of the clears page, one map after another,
+# and adds every map to map_catalog as it goes. like the full parse, later rows with the same map name overwrite earlier
+# ones, so those rows are held back and yielded together where the last of them is. map_rows has to be a list, since
+# it's read twice.
+def iter_clears_records(player_names_row, map_rows, map_catalog):
+    first_player_i = lists.current().min_player_col_index
+    if len(player_names_row) < first_player_i:
+        print("ERROR: Sheet is too small or doesn't follow the ID/Label structure.")
+        sys.exit(1)
 
-def get_state_diff_list(previous_state, current_state, map_difficulties):
-    # player_name -> set { map_name }
-    old_player_clears = defaultdict(set)
-    new_player_clears = defaultdict(set)
-    # map_name -> set { player_name }
-    old_map_clearers = defaultdict(set)
-    new_map_clearers = defaultdict(set)
+    map_name_counts = Counter(map_name for map_name, _, _ in iter_map_rows(map_rows))
+    held_rows = defaultdict(list)
 
-    # populate old clear info
-    for (player_name, map_name), old_val in previous_state.items():
-        old_player_clears[player_name].add(map_name)
-        old_map_clearers[map_name].add(player_name)
+    for map_name, map_star_difficulty, row in iter_map_rows(map_rows):
+        map_catalog.add(map_name, map_star_difficulty)
+        if map_name_counts[map_name] == 1:
+            yield from helpers.iter_data_row(row, first_player_i, player_names_row)
+            continue
 
-    # populate new clear info
-    for (player_name, map_name), new_val in current_state.items():
-        new_player_clears[player_name].add(map_name)
-        new_map_clearers[map_name].add(player_name)
+        held_rows[map_name].append(row)
+        if len(held_rows[map_name]) == map_name_counts[map_name]:
+            for held_row in held_rows.pop(map_name):
+                yield from helpers.iter_data_row(held_row, first_player_i, player_names_row)
 
-    # renaming dicts are new -> old name
-    added_players, removed_players, player_renamings = (
-        old_and_new_entities_to_added_removed_renamed(old_player_clears, new_player_clears))
-    added_maps, removed_maps, map_renamings = (
-        old_and_new_entities_to_added_removed_renamed(old_map_clearers, new_map_clearers))
 
-    player_diffs = [(DiffType.ADDED_PLAYER, player) for player in added_players] + \
-                   [(DiffType.REMOVED_PLAYER, player) for player in removed_players] + \
-                   [(DiffType.RENAMED_PLAYER, old_player, new_player) for new_player, old_player in
-                    player_renamings.items()]
-    # can't really get the star value of a removed map unless we also store that in the state sheet. which we could do,
-    # but doesn't really seem necessary right now.
-    map_diffs = [(DiffType.ADDED_MAP, map_name, map_difficulties[map_name]) for map_name in added_maps] + \
-                [(DiffType.REMOVED_MAP, map_name) for map_name in removed_maps] + \
-                [(DiffType.RENAMED_MAP, old_map_name, new_map_name, map_difficulties[new_map_name]) for
-                 new_map_name, old_map_name in map_renamings.items()]
+# parses and diffs the clears page in one pass, a map at a time (see get_state_diff_list_and_cell_changes_from_records).
+# returns (current_state, map_catalog, diff_list, cell_changes).
+def get_current_state_and_diffs_streaming(previous_state, player_names_row, map_rows, previous_map_catalog=None):
+    map_catalog = MapCatalog(previous_map_catalog)
+    current_state = ClearState()
+    diff_list, cell_changes = get_state_diff_list_and_cell_changes_from_records(
+        previous_state, iter_clears_records(player_names_row, map_rows, map_catalog), map_catalog, current_state)
+    return current_state, map_catalog, diff_list, cell_changes
 
-    old_renamed_player_names = player_renamings.values()
-    old_renamed_map_names = map_renamings.values()
+
+def get_state_diff_list(previous_state, current_state, map_catalog):
+    diff_list, _ = get_state_diff_list_and_cell_changes(previous_state, current_state, map_catalog)
+    return diff_list
+
+
+# same as get_state_diff_list, but also returns the list of raw cells that changed, as (player_name, map_name, new_val)
+# tuples using the new names of renamed players and maps. new_val is "" for cells that were emptied. cells of removed
+# players and maps aren't included, since their whole row or column is going away anyway.
+def get_state_diff_list_and_cell_changes(previous_state, current_state, map_catalog):
+    entity_changes = get_entity_changes(previous_state, current_state)
 
     # this won't have duplicates since any (player, map) combinations will be unioned. the only exception is renamed
     # maps or players, which is skipped in the for loop below (for the old name, then we do check the new name).
     old_and_new_keys = previous_state.keys() | current_state.keys()
 
-    # first, store new clears by player/map key. this will allow us to ignore "clears" of [FC] entries as duplicates
-    # of "full clears" of [C] entries. then we can properly format the diff list.
-    # (player, trimmed_map_name) -> set { (diff_type, clear_type, *vals) }
-    # diff_type will be a DiffType, clear_type will be a str "[C]" or "[FC]" or something else, vals will be other
-    # values to pass along
     clear_diffs_by_player_and_map = defaultdict(set)
+    cell_changes = []
 
-    for new_key in old_and_new_keys:
+    for player_name, map_name, old_val, new_val in iter_changed_cells(old_and_new_keys, previous_state, current_state,
+                                                                      entity_changes):
+        cell_changes.append((player_name, map_name, new_val))
+        add_clear_diff(clear_diffs_by_player_and_map, player_name, map_name, old_val, new_val, map_catalog)
+
+    diff_list = (get_entity_diffs(entity_changes, map_catalog) +
+                 merge_clear_diffs(clear_diffs_by_player_and_map))
+    return diff_list, cell_changes
+
+
+# yields (player_name, map_name, old_val, new_val) for every key in keys whose value changed, where keys use the new
+# names and current_values maps them to their new values. keys of removed players and maps and the old names of renamed
+# ones are skipped.
+def iter_changed_cells(keys, previous_state, current_values, entity_changes):
+    _, removed_players, player_renamings, _, removed_maps, map_renamings = entity_changes
+    old_renamed_player_names = player_renamings.values()
+    old_renamed_map_names = map_renamings.values()
+
+    for new_key in keys:
         player_name, map_name = new_key
 
         if player_name in old_renamed_player_names or map_name in old_renamed_map_names:
@@ -107,7 +157,7 @@ def get_state_diff_list(previous_state, current_state, map_difficulties):
             # skip removed (not renamed) players or maps
             continue
 
-        new_val = current_state.get(new_key, "")
+        new_val = current_values.get(new_key, "")
         # before accessing the old state, adjust the key to account for renamings
         old_player_name, old_map_name = new_key
         if player_name in player_renamings:
@@ -117,19 +167,169 @@ def get_state_diff_list(previous_state, current_state, map_difficulties):
         old_key = (old_player_name, old_map_name)
         old_val = previous_state.get(old_key, "")
 
-        map_difficulty = map_difficulties[map_name]
-        trimmed_map_name, clear_type = helpers.trim_map_name(map_name)
+        if new_val == old_val:
+            continue
+        yield player_name, map_name, old_val, new_val
+
+
+# the streaming version of get_state_diff_list_and_cell_changes, which gives the same diffs and cell changes without
+# building indexes of both whole states. previous_state has to be a ClearState, and records are the
+# (player_name, map_name, value) cells of the current state, with the cells of every map coming one after another (like
+# iter_clears_records yields them). cells of players and maps that are in both states are diffed as soon as their map is
+# done. only the cells of players and maps that are in just one of the states (which might be renamed) and the clear
+# diffs (for merging [C] and [FC] entries) are held on to until the end. if current_state is given, the records are
+# also stored in it.
+def get_state_diff_list_and_cell_changes_from_records(previous_state, records, map_catalog, current_state=None):
+    clear_diffs_by_player_and_map = defaultdict(set)
+    cell_changes = []
+
+    # players of previous_state that have had a cell so far, so they're in both states
+    seen_old_players = set()
+    seen_maps = set()
+    # old player -> [(map_name, old_val)] of cells emptied before we knew whether that player is still in the sheet
+    pending_emptied_cells = defaultdict(list)
+    # cells of players or maps that aren't in previous_state, and what they have, for matching renames at the end
+    new_entity_cells = {}
+    new_player_clears = defaultdict(set)
+    new_map_clearers = defaultdict(set)
+
+    def add_cell_change(player_name, map_name, old_val, new_val):
+        cell_changes.append((player_name, map_name, new_val))
+        add_clear_diff(clear_diffs_by_player_and_map, player_name, map_name, old_val, new_val, map_catalog)
+
+    for map_name, map_records in itertools.groupby(records, key=operator.itemgetter(1)):
+        if map_name in seen_maps:
+            print(f"ERROR: The cells of map {map_name} aren't all together.")
+            sys.exit(1)
+        seen_maps.add(map_name)
+
+        # later cells overwrite earlier ones, like they would in a state
+        new_row = {player_name: value for player_name, _, value in map_records}
+        if current_state is not None:
+            for player_name, value in new_row.items():
+                current_state[player_name, map_name] = value
+
+        map_is_old = previous_state.map_cell_count(map_name) > 0
+        for player_name, new_val in new_row.items():
+            player_is_old = previous_state.player_cell_count(player_name) > 0
+            if player_is_old and player_name not in seen_old_players:
+                seen_old_players.add(player_name)
+                for emptied_map_name, old_val in pending_emptied_cells.pop(player_name, ()):
+                    add_cell_change(player_name, emptied_map_name, old_val, "")
+
+            if not player_is_old or not map_is_old:
+                new_entity_cells[player_name, map_name] = new_val
+                if not player_is_old:
+                    new_player_clears[player_name].add(map_name)
+                if not map_is_old:
+                    new_map_clearers[map_name].add(player_name)
+                continue
+
+            old_val = previous_state.get((player_name, map_name), "")
+            if new_val != old_val:
+                add_cell_change(player_name, map_name, old_val, new_val)
+
+        if map_is_old:
+            for player_name, old_val in previous_state.row_items(map_name):
+                if player_name in new_row:
+                    continue
+                if player_name in seen_old_players:
+                    add_cell_change(player_name, map_name, old_val, "")
+                else:
+                    pending_emptied_cells[player_name].append((map_name, old_val))
+
+    # players and maps of previous_state that have no cells anymore were removed or renamed. anything still pending
+    # belongs to one of those players, and gets diffed below with the rest of their cells.
+    old_player_clears = {player_name: set() for player_name in previous_state.player_names()
+                         if player_name not in seen_old_players}
+    old_map_clearers = {map_name: {player_name for player_name, _ in previous_state.row_items(map_name)}
+                        for map_name in previous_state.map_names() if map_name not in seen_maps}
+    remaining_keys = set(new_entity_cells)
+    if old_player_clears:
+        for player_name, map_name in previous_state.keys():
+            if player_name in old_player_clears:
+                old_player_clears[player_name].add(map_name)
+                remaining_keys.add((player_name, map_name))
+    for map_name, player_names in old_map_clearers.items():
+        remaining_keys.update((player_name, map_name) for player_name in player_names)
+
+    entity_changes = (old_and_new_entities_to_added_removed_renamed(old_player_clears, new_player_clears) +
+                      old_and_new_entities_to_added_removed_renamed(old_map_clearers, new_map_clearers))
+    for player_name, map_name, old_val, new_val in iter_changed_cells(remaining_keys, previous_state, new_entity_cells,
+                                                                      entity_changes):
+        add_cell_change(player_name, map_name, old_val, new_val)
+
+    diff_list = (get_entity_diffs(entity_changes, map_catalog) +
+                 merge_clear_diffs(clear_diffs_by_player_and_map))
+    return diff_list, cell_changes
+
+
+# works out which players and maps were added, removed or renamed. returns (added_players, removed_players,
+# player_renamings, added_maps, removed_maps, map_renamings), where the renaming dicts are new -> old name.
+def get_entity_changes(previous_state, current_state):
+    # player_name -> set { map_name }
+    old_player_clears = defaultdict(set)
+    new_player_clears = defaultdict(set)
+    # map_name -> set { player_name }
+    old_map_clearers = defaultdict(set)
+    new_map_clearers = defaultdict(set)
+
+    # populate old clear info
+    for player_name, map_name in previous_state.keys():
+        old_player_clears[player_name].add(map_name)
+        old_map_clearers[map_name].add(player_name)
+
+    # populate new clear info
+    for player_name, map_name in current_state.keys():
+        new_player_clears[player_name].add(map_name)
+        new_map_clearers[map_name].add(player_name)
+
+    added_players, removed_players, player_renamings = (
+        old_and_new_entities_to_added_removed_renamed(old_player_clears, new_player_clears))
+    added_maps, removed_maps, map_renamings = (
+        old_and_new_entities_to_added_removed_renamed(old_map_clearers, new_map_clearers))
+
+    return added_players, removed_players, player_renamings, added_maps, removed_maps, map_renamings
+
+
+def get_entity_diffs(entity_changes, map_catalog):
+    added_players, removed_players, player_renamings, added_maps, removed_maps, map_renamings = entity_changes
+
+    player_diffs = [(DiffType.ADDED_PLAYER, player) for player in added_players] + \
+                   [(DiffType.REMOVED_PLAYER, player) for player in removed_players] + \
+                   [(DiffType.RENAMED_PLAYER, old_player, new_player) for new_player, old_player in
+                    player_renamings.items()]
+    # removed maps get their star difficulty from the previous state's catalog, or None if it wasn't saved
+    map_diffs = [(DiffType.ADDED_MAP, map_name, map_catalog[map_name][0]) for map_name in added_maps] + \
+                [(DiffType.REMOVED_MAP, map_name, map_catalog.star_difficulty(map_name)) for
+                 map_name in removed_maps] + \
+                [(DiffType.RENAMED_MAP, old_map_name, new_map_name, map_catalog[new_map_name][0]) for
+                 new_map_name, old_map_name in map_renamings.items()]
+
+    return player_diffs + map_diffs
 
-        if new_val and not old_val:
-            clear_diffs_by_player_and_map[(player_name, trimmed_map_name)].add((
-                DiffType.ADDED_CLEAR, clear_type, new_val, map_difficulty))
-        elif not new_val and old_val:
-            clear_diffs_by_player_and_map[(player_name, trimmed_map_name)].add(
-                (DiffType.REMOVED_CLEAR, clear_type, old_val, map_difficulty))
-        elif new_val != old_val:
-            clear_diffs_by_player_and_map[(player_name, trimmed_map_name)].add(
-                (DiffType.CHANGED_CLEAR, clear_type, old_val, new_val, map_difficulty))
 
+# store a changed cell by player/trimmed map key. this will allow us to ignore "clears" of [FC] entries as duplicates
+# of "full clears" of [C] entries in merge_clear_diffs. mutates clear_diffs_by_player_and_map, which is
+# (player, trimmed_map_name) -> set { (diff_type, clear_type, *vals) }
+# diff_type will be a DiffType, clear_type will be a str "[C]" or "[FC]" or something else, vals will be other
+# values to pass along
+def add_clear_diff(clear_diffs_by_player_and_map, player_name, map_name, old_val, new_val, map_catalog):
+    map_difficulty, trimmed_map_name, clear_type = map_catalog[map_name]
+
+    if new_val and not old_val:
+        clear_diffs_by_player_and_map[(player_name, trimmed_map_name)].add((
+            DiffType.ADDED_CLEAR, clear_type, new_val, map_difficulty))
+    elif not new_val and old_val:
+        clear_diffs_by_player_and_map[(player_name, trimmed_map_name)].add(
+            (DiffType.REMOVED_CLEAR, clear_type, old_val, map_difficulty))
+    elif new_val != old_val:
+        clear_diffs_by_player_and_map[(player_name, trimmed_map_name)].add(
+            (DiffType.CHANGED_CLEAR, clear_type, old_val, new_val, map_difficulty))
+
+
+# turns the changed cells stored by add_clear_diff into the final clear diffs
+def merge_clear_diffs(clear_diffs_by_player_and_map):
     clear_diffs = []
     # we only care about if a set has 2 entries, one is FC, one is C, the FC one is DiffType.ADDED_CLEAR,
     # and the C one is CHANGED_CLEAR or ADDED_CLEAR.
@@ -160,16 +360,23 @@ def get_state_diff_list(previous_state, current_state, map_difficulties):
             for clear_entry in clear_entries:
                 clear_diffs.append((clear_entry[0], player_name, trimmed_map_name, *clear_entry[1:]))
 
-    return player_diffs + map_diffs + clear_diffs
+    return clear_diffs
+
+
+# whether two diff lists have the same diffs, ignoring order (which depends on set iteration order)
+def diff_lists_match(diff_list1, diff_list2):
+    return Counter(diff_list1) == Counter(diff_list2)
 
 
 def old_and_new_entities_to_added_removed_renamed(old_entities, new_entities):
     removed_or_renamed_entities = old_entities.keys() - new_entities.keys()
     added_or_renamed_entities = new_entities.keys() - old_entities.keys()
+    # sorted, so that when several renamings would fit equally well, the same one gets picked no matter how the
+    # entities were collected (see get_subset_graph)
     removed_or_renamed_entity_values = {entity_name: old_entities[entity_name] for entity_name in
-                                        removed_or_renamed_entities}
+                                        sorted(removed_or_renamed_entities)}
     added_or_renamed_entity_values = {entity_name: new_entities[entity_name] for entity_name in
-                                      added_or_renamed_entities}
+                                      sorted(added_or_renamed_entities)}
 
     entity_matchings = maybe_pair_removed_and_added_entities(removed_or_renamed_entity_values,
                                                              added_or_renamed_entity_values)
@@ -183,15 +390,12 @@ def old_and_new_entities_to_added_removed_renamed(old_entities, new_entities):
 
 
 # try to pair up removed players or maps with added players or maps to see if they were renamed
-# use kuhn's algorithm for a maximum bipartite matching
+# use hopcroft-karp for a maximum bipartite matching
 # returns a dict of new name -> old name
 def maybe_pair_removed_and_added_entities(removed_dict, added_dict):
     if not removed_dict or not added_dict:
         return {}
 
-    # adjacency list
-    graph = defaultdict(set)
-
     # populate edges: a removed entity can be mapped to an added entity if its set is a subset of the added entity's set
     # IMPORTANT NOTE: this assumes that when a player or map is renamed, no clears are removed from them. if a clear
     # is removed from a renamed player or map, this script will consider it to be a removal of the old name and an
@@ -199,40 +403,117 @@ def maybe_pair_removed_and_added_entities(removed_dict, added_dict):
     # RENAMING A PLAYER OR MAP. this is an extremely rare scenario, but they should know just in case.
     # another possible rare scenario is that a player was truly removed and another player with the same clears was
     # truly added, but this is also extremely rare. helpers and mods should still be told this.
-    for removed_entity, clears in removed_dict.items():
-        for added_entity, new_clears in added_dict.items():
-            if clears <= new_clears:
-                graph[removed_entity].add(added_entity)
+    graph = get_subset_graph(removed_dict, added_dict)
 
-    # maps from an added entity to a removed entity
-    matching = {}
-
-    # side effect: mutates matching
-    # noinspection PyShadowingNames
-    def dfs(removed_entity, visited):
-        for added_entity in graph[removed_entity]:
-            if added_entity not in visited:
-                visited.add(added_entity)
+    # maps from new -> old name
+    return hopcroft_karp(graph, removed_dict.keys())
 
-                if added_entity not in matching or dfs(matching[added_entity], visited):
-                    matching[added_entity] = removed_entity
-                    return True
-        return False
 
-    for removed_entity in removed_dict:
-        dfs(removed_entity, set())
+# returns an adjacency list from every removed entity to the added entities whose sets contain its set. instead of
+# comparing every removed/added pair, this intersects the sets of added entities that have each of the removed
+# entity's clears (from an inverted index), starting from the rarest clear, so most pairs are never looked at.
+def get_subset_graph(removed_dict, added_dict):
+    # keep the added entities in a fixed order, so the matching doesn't depend on set iteration order
+    added_entity_order = {added_entity: i for i, added_entity in enumerate(added_dict)}
 
-    # maps from new -> old name
-    return matching
+    # clear -> set { added entities that have it }
+    added_entities_by_clear = defaultdict(set)
+    for added_entity, new_clears in added_dict.items():
+        for clear in new_clears:
+            added_entities_by_clear[clear].add(added_entity)
 
+    graph = {}
+    for removed_entity, clears in removed_dict.items():
+        candidate_sets = sorted((added_entities_by_clear.get(clear, set()) for clear in clears), key=len)
+        if not candidate_sets:
+            # an empty set is a subset of everything
+            candidates = set(added_dict)
+        else:
+            candidates = set(candidate_sets[0])
+            for candidate_set in itertools.islice(candidate_sets, 1, None):
+                if not candidates:
+                    break
+                candidates &= candidate_set
+        graph[removed_entity] = sorted(candidates, key=added_entity_order.__getitem__)
+
+    return graph
+
+
+# maximum bipartite matching from graph's left vertices (removed entities) to right vertices (added entities).
+# iterative, so it can't hit the recursion limit no matter how many entities change at once.
+# returns a dict of right vertex -> left vertex
+def hopcroft_karp(graph, left_vertices):
+    match_left = {}
+    match_right = {}
+
+    while True:
+        # bfs from every unmatched left vertex to layer the graph by alternating path length
+        dist = {}
+        queue = collections.deque()
+        for u in left_vertices:
+            if u not in match_left:
+                dist[u] = 0
+                queue.append(u)
+
+        found_augmenting_path = False
+        while queue:
+            u = queue.popleft()
+            for v in graph[u]:
+                w = match_right.get(v)
+                if w is None:
+                    found_augmenting_path = True
+                elif w not in dist:
+                    dist[w] = dist[u] + 1
+                    queue.append(w)
+
+        if not found_augmenting_path:
+            return match_right
+
+        # dfs along the layers for vertex-disjoint augmenting paths. every stack entry is
+        # [left vertex, iterator over its edges, right vertex we went through to get to the next entry]
+        for root in left_vertices:
+            if dist.get(root) != 0:
+                continue
+
+            stack = [[root, iter(graph[root]), None]]
+            while stack:
+                entry = stack[-1]
+                u, edges, _ = entry
+                for v in edges:
+                    w = match_right.get(v)
+                    if w is None:
+                        # found a free right vertex, so flip every edge along the path
+                        entry[2] = v
+                        for path_u, _, path_v in stack:
+                            match_left[path_u] = path_v
+                            match_right[path_v] = path_u
+                        stack = []
+                        break
+                    if dist.get(w) == dist[u] + 1:
+                        entry[2] = v
+                        stack.append([w, iter(graph[w]), None])
+                        break
+                else:
+                    # dead end, don't try this vertex again in this phase
+                    dist[u] = None
+                    stack.pop()
+
+
+# returns the sets of player and map names that have at least one cell in state
+def get_player_and_map_names(state):
+    if isinstance(state, ClearState):
+        return set(state.player_names()), set(state.map_names())
 
-def save_state_as_grid(current_state):
     player_names = set()
     map_names = set()
-
-    for (player_name, map_name), value in current_state.items():
+    for player_name, map_name in state.keys():
         player_names.add(player_name)
         map_names.add(map_name)
+    return player_names, map_names
+
+
+def save_state_as_grid(current_state):
+    player_names, map_names = get_player_and_map_names(current_state)
 
     player_names = list(sorted(player_names))
     map_names = list(sorted(map_names))
@@ -254,3 +535,116 @@ def save_state_as_grid(current_state):
         state_grid[row_index][col_index] = value
 
     return state_grid
+
+
+# works out how to turn the state sheet (as read into state_table) into the current state without rewriting the whole
+# grid: which rows/cols to delete, how many to append, and which cells to overwrite. players and maps keep their
+# current positions, renames happen in place, and added players and maps are appended at the end in sorted order.
+# returns None if the state sheet doesn't look like something we wrote for previous_state (i.e. the layout drifted),
+# in which case the caller should fall back to a full rewrite with save_state_as_grid.
+# all returned indices are 0-based and include the label row/col. deleted indices refer to the sheet as it is now,
+# appended rows/cols go after the remaining ones, and cell updates refer to the sheet after deleting and appending.
+def get_state_grid_updates(state_table, previous_state, diff_list, cell_changes):
+    if not state_table or not state_table[0] or state_table[0][0]:
+        return None
+
+    old_player_names = state_table[0][1:]
+    old_map_names = [row[0] if row else "" for row in itertools.islice(state_table, 1, None)]
+
+    old_players, old_maps = get_player_and_map_names(previous_state)
+
+    # every label has to be non-empty, unique, and have at least one clear, otherwise it's not our layout
+    if (len(set(old_player_names)) != len(old_player_names) or set(old_player_names) != old_players or
+            len(set(old_map_names)) != len(old_map_names) or set(old_map_names) != old_maps):
+        return None
+
+    # renaming dicts are old -> new name here, since we're walking the old layout
+    player_renamings = {}
+    map_renamings = {}
+    removed_players = set()
+    removed_maps = set()
+    added_players = []
+    added_maps = []
+
+    for diff_type, *values in diff_list:
+        match diff_type:
+            case DiffType.ADDED_PLAYER:
+                added_players.append(values[0])
+            case DiffType.REMOVED_PLAYER:
+                removed_players.add(values[0])
+            case DiffType.RENAMED_PLAYER:
+                player_renamings[values[0]] = values[1]
+            case DiffType.ADDED_MAP:
+                added_maps.append(values[0])
+            case DiffType.REMOVED_MAP:
+                removed_maps.add(values[0])
+            case DiffType.RENAMED_MAP:
+                map_renamings[values[0]] = values[1]
+
+    player_col_indices, deleted_col_indices, cell_updates = get_state_axis_updates(
+        old_player_names, removed_players, player_renamings, sorted(added_players),
+        lambda i, name: (0, i, name))
+    map_row_indices, deleted_row_indices, map_label_updates = get_state_axis_updates(
+        old_map_names, removed_maps, map_renamings, sorted(added_maps),
+        lambda i, name: (i, 0, name))
+    cell_updates += map_label_updates
+
+    for player_name, map_name, new_val in cell_changes:
+        if player_name not in player_col_indices or map_name not in map_row_indices:
+            # a cell for a player or map we don't know about means the diff doesn't match this sheet
+            return None
+        cell_updates.append((map_row_indices[map_name], player_col_indices[player_name], new_val))
+
+    num_appended_rows = len(added_maps)
+    num_appended_cols = len(added_players)
+
+    return deleted_row_indices, deleted_col_indices, num_appended_rows, num_appended_cols, cell_updates
+
+
+# helper for get_state_grid_updates that handles one axis (the players in the header row or the maps in the label col)
+# returns the new index of every remaining label, the indices of deleted labels, and the label cells to update, using
+# make_cell_update(new_index, new_name) to turn a label into a (row_index, col_index, value) tuple.
+def get_state_axis_updates(old_names, removed_names, renamings, added_names, make_cell_update):
+    new_indices = {}
+    deleted_indices = []
+    label_updates = []
+
+    # start at 1 to account for the label row/col
+    new_i = 1
+    for old_i, old_name in enumerate(old_names, start=1):
+        if old_name in removed_names:
+            deleted_indices.append(old_i)
+            continue
+
+        new_name = renamings.get(old_name, old_name)
+        new_indices[new_name] = new_i
+        if new_name != old_name:
+            label_updates.append(make_cell_update(new_i, new_name))
+        new_i += 1
+
+    for added_name in added_names:
+        new_indices[added_name] = new_i
+        label_updates.append(make_cell_update(new_i, added_name))
+        new_i += 1
+
+    return new_indices, deleted_indices, label_updates
+
+
+# applies the output of get_state_grid_updates to an in-memory copy of the state table, so the result matches what the
+# state sheet looks like after sheets.save_clear_updates_to_state_sheet
+def apply_state_grid_updates(state_table, grid_updates):
+    deleted_row_indices, deleted_col_indices, num_appended_rows, num_appended_cols, cell_updates = grid_updates
+    deleted_row_indices = set(deleted_row_indices)
+    deleted_col_indices = set(deleted_col_indices)
+
+    new_table = [[value for col_i, value in enumerate(row) if col_i not in deleted_col_indices]
+                 for row_i, row in enumerate(state_table) if row_i not in deleted_row_indices]
+    num_cols = len(new_table[0]) + num_appended_cols
+    for row in new_table:
+        row.extend([""] * (num_cols - len(row)))
+    new_table.extend([""] * num_cols for _ in range(num_appended_rows))
+
+    for row_i, col_i, value in cell_updates:
+        new_table[row_i][col_i] = value
+
+    return new_table
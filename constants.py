@@ -10,6 +10,7 @@ FIRST_REAL_MAP_STAR_DIFFICULTY = MAX_STAR_DIFFICULTY
 CLD_COLS_PER_STAR = 6
 CLD_MAP_NAME_OFFSET = 1
 CLD_INFO_END_OFFSET = 4
+CLD_FIRST_TIER_ROW_INDEX = 9
 MAP_PREFIXES_TO_IGNORE = [
     "# of Challenges / People / Clears",
     "⭐⭐⭐⭐⭐",
@@ -45,6 +46,7 @@ STAR_ROLE_PINGS = [
 GOLDEN_ROLE_PING = "<@&1458661811967758396>"
 SILVER_ROLE_PING = "<@&1463412684438507707>"
 NEW_PLAYER_ROLE_PING = "<@&1463413197968248924>"
+DISCORD_MAX_MESSAGE_LENGTH = 2000
 
 
 class DiffType(enum.Enum):
@@ -57,6 +59,9 @@ class DiffType(enum.Enum):
     ADDED_MAP = 7
     REMOVED_MAP = 8
     RENAMED_MAP = 9
+    # milestones found by aggregates.update_aggregates rather than by diffing
+    CLEAR_MILESTONE = 10
+    FIRST_GOLDEN = 11
 
 
 class ClearType(enum.Enum):
@@ -1,39 +1,360 @@
-import os
+import concurrent.futures
+import json
+import re
 import sys
 import time
-
-import requests
+from collections import Counter
 
 import clear_types
 import goldens
+import lists
+import outbox
+import ratelimit
+import timing
 from constants import DiffType, ClearType, NotificationType, FULL_CLEAR_EMOJI, SILVER_EMOJI, GOLDEN_EMOJI, \
     CLEAR_EMOJI, ANIMATED_GOLDEN_EMOJI, STAR_EMOJIS, STAR_ROLE_PINGS, GOLDEN_ROLE_PING, SILVER_ROLE_PING, \
-    NEW_PLAYER_ROLE_PING
+    NEW_PLAYER_ROLE_PING, DISCORD_MAX_MESSAGE_LENGTH
+
+# how many times to retry a message after discord rate limits us before giving up on it for this run
+MAX_RATE_LIMITED_RETRIES = 5
+# how many times to try a message that fails with a connection error or a 5xx before leaving it for the next run
+MAX_DELIVERY_ATTEMPTS = 4
+# seconds to wait after the first failed attempt, doubled after every further one
+DELIVERY_BACKOFF_BASE = 1.0
+# (connect, read) timeouts in seconds for webhook requests
+WEBHOOK_TIMEOUT = (5, 20)
+
+# how messages bound for the same webhook are packed into discord messages:
+# "none": one discord message per diff
+# "lines": one line per diff, packed into as few discord messages as fit
+# "stars": like "lines", but every discord message only has diffs of one star difficulty (hardest first)
+BATCH_MODES = ["none", "lines", "stars"]
+DEFAULT_BATCH_MODE = "lines"
+
+# when a run has more than this many discord messages for one webhook (e.g. after a bulk edit of the sheet, or on the
+# first run against an empty state sheet), that webhook gets a digest of them instead (see render_digest_messages), so
+# delivering them takes about as long however many diffs there are
+DEFAULT_DIGEST_AFTER = 20
+DIGEST_FILE_NAME = "changes.txt"
+# discord takes attachments of up to 10 MiB from webhooks, so leave some room
+DIGEST_MAX_FILE_SIZE = 8 * 2 ** 20
+DIGEST_TOP_PLAYERS = 5
+# <:name:id> or <a:name:id>, which only shows up as an emoji in discord itself
+CUSTOM_EMOJI_RE = re.compile(r"<a?(:\w+:)\d+>")
+
+# shared by every webhook we send to, so it can keep one bucket per webhook url
+_rate_limiter = ratelimit.RateLimiter()
+_outbox = outbox.Outbox()
+_session = None
 
 
-def send_diff_messages_to_webhook(diff_list, only_print=False):
-    primary_discord_url = os.environ.get('PRIMARY_DISCORD_WEBHOOK_URL')
-    secondary_discord_url = os.environ.get('SECONDARY_DISCORD_WEBHOOK_URL')
+# one pooled session for every webhook request, so we only do the tls handshake once per webhook host. requests is
+# imported here, since print mode and runs with nothing to send never need it.
+def get_session():
+    global _session
+    if _session is None:
+        import requests
+
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def get_discord_urls():
+    list_config = lists.current()
+    primary_discord_url = list_config.primary_webhook_url
+    secondary_discord_url = list_config.secondary_webhook_url
 
     if not primary_discord_url or not secondary_discord_url:
         print("Warning: PRIMARY_DISCORD_WEBHOOK_URL or SECONDARY_DISCORD_WEBHOOK_URL not set. Skipping notification.")
-        return
+        return None
 
-    for i, (diff_type, *values) in enumerate(diff_list):
-        if i > 0 and not only_print:
-            # webhooks have a rate limit of 5 requests per 2 seconds per webhook
-            # send 4 requests per 2 seconds just to be safe
-            time.sleep(0.5)
-        msg, notif_type = diff_to_message(diff_type, values)
-        if only_print:
-            print("[PRIMARY]  " if notif_type == NotificationType.PRIMARY else "[SECONDARY]", msg)
+    return {NotificationType.PRIMARY: primary_discord_url, NotificationType.SECONDARY: secondary_discord_url}
+
+
+def send_diff_messages_to_webhook(diff_list, only_print=False, batch_mode=DEFAULT_BATCH_MODE):
+    if only_print:
+        print_diff_messages(diff_list, batch_mode)
+    else:
+        queue_diff_messages(diff_list, batch_mode)
+        send_queued_messages()
+
+
+# returns a list of (notif_type, message content, files), batched according to batch_mode, where files is a list of
+# [file name, text] to attach. if digest_after is given and a webhook would get more discord messages than that, it gets
+# a digest instead, with every message in an attached file if digest_file is True.
+def render_diff_messages(diff_list, batch_mode=DEFAULT_BATCH_MODE, digest_after=None, digest_file=True):
+    # notification type -> list of (message, pings, map difficulty), in the order they should be sent
+    message_parts_by_notif_type = {NotificationType.PRIMARY: [], NotificationType.SECONDARY: []}
+    # notification type -> the diffs its message parts are for
+    diffs_by_notif_type = {NotificationType.PRIMARY: [], NotificationType.SECONDARY: []}
+
+    for diff in diff_list:
+        diff_type, *values = diff
+        msg, pings, notif_type = diff_to_message_and_pings(diff_type, values)
+        message_parts_by_notif_type[notif_type].append((msg, pings, diff_to_map_difficulty(diff_type, values)))
+        diffs_by_notif_type[notif_type].append(diff)
+
+    rendered_messages = []
+    for notif_type, message_parts in message_parts_by_notif_type.items():
+        messages = batch_messages(message_parts, batch_mode)
+        if digest_after is not None and len(messages) > digest_after:
+            timing.count("discord_digests")
+            rendered_messages += [(notif_type, msg, files) for msg, files in
+                                  render_digest_messages(diffs_by_notif_type[notif_type], message_parts, digest_file)]
         else:
-            payload = {"content": msg}
-            try:
-                discord_url = primary_discord_url if notif_type == NotificationType.PRIMARY else secondary_discord_url
-                requests.post(discord_url, json=payload)
-            except Exception as e:
-                print(f"ERROR: Failed to send Discord message: {e}")
+            rendered_messages += [(notif_type, msg, []) for msg in messages]
+    return rendered_messages
+
+
+# sums up diffs whose (message, pings, map difficulty) parts are message_parts in a few lines: how many of each kind of
+# change there were per star difficulty, and who had the most changed clears. the pings of all the messages are kept,
+# but only once each. returns a list of (message content, files), where files is the file with every message for the
+# first message (if with_file is True) and empty for the rest.
+def render_digest_messages(diff_list, message_parts, with_file):
+    # star difficulty (None for player diffs) -> emoji of the kind of change -> number of diffs
+    counts_by_star = {}
+    num_clear_diffs_by_player = Counter()
+    pings = []
+    for (diff_type, *values), (msg, msg_pings, map_difficulty) in zip(diff_list, message_parts):
+        # every message starts with the emoji for its kind of change
+        emoji = msg.split(" ", 1)[0]
+        star_counts = counts_by_star.setdefault(map_difficulty, {})
+        star_counts[emoji] = star_counts.get(emoji, 0) + 1
+        if diff_type in {DiffType.ADDED_CLEAR, DiffType.REMOVED_CLEAR, DiffType.CHANGED_CLEAR}:
+            num_clear_diffs_by_player[values[0]] += 1
+        pings += msg_pings
+
+    lines = [f"📦 **{len(diff_list)} changes** are too many to post one by one, so here's a summary:"]
+    for map_difficulty in sorted(counts_by_star, key=lambda difficulty: -1 if difficulty is None else difficulty,
+                                 reverse=True):
+        label = STAR_EMOJIS[map_difficulty] if map_difficulty is not None else "👥"
+        star_counts = sorted(counts_by_star[map_difficulty].items(), key=lambda emoji_and_count: -emoji_and_count[1])
+        lines.append(f"{label} " + ", ".join(f"{count}× {emoji}" for emoji, count in star_counts))
+    if num_clear_diffs_by_player:
+        lines.append("Most changed clears: " + ", ".join(
+            f"{format_player_or_map_name(player_name)} ({count})"
+            for player_name, count in num_clear_diffs_by_player.most_common(DIGEST_TOP_PLAYERS)))
+
+    files = []
+    if with_file:
+        lines.append("Every change is in the attached file.")
+        files = [[DIGEST_FILE_NAME, get_digest_file_text(message_parts)]]
+
+    # the pings go with the first line, so they end up at the end of the first message
+    digest_parts = [(lines[0], list(dict.fromkeys(pings)), None)] + [(line, (), None) for line in lines[1:]]
+    return [(msg, files if i == 0 else []) for i, msg in enumerate(batch_messages(digest_parts, "lines"))]
+
+
+# one message per line, with custom emojis as their :name:, cut off before the file gets too big for discord
+def get_digest_file_text(message_parts):
+    lines = []
+    size = 0
+    for i, (msg, _, _) in enumerate(message_parts):
+        line = CUSTOM_EMOJI_RE.sub(r"\1", msg)
+        size += len(line.encode()) + 1
+        if size > DIGEST_MAX_FILE_SIZE - 100:
+            lines.append(f"... and {len(message_parts) - i} more")
+            break
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+# renders the leaderboard from aggregates.get_leaderboard as a list of (notif_type, message content, files), with one
+# line per star difficulty and one for goldens
+def render_leaderboard_messages(leaderboard):
+    lines = ["🏆 **Leaderboard** 🏆"]
+    for map_difficulty, top_players in leaderboard:
+        emoji = STAR_EMOJIS[map_difficulty] if map_difficulty is not None else GOLDEN_EMOJI
+        lines.append(f"{emoji} " + ", ".join(f"{i}. {format_player_or_map_name(player_name)} ({count})"
+                                              for i, (player_name, count) in enumerate(top_players, 1)))
+    return [(NotificationType.PRIMARY, msg, []) for msg in
+            batch_messages([(line, (), None) for line in lines], "lines")]
+
+
+def print_diff_messages(diff_list, batch_mode=DEFAULT_BATCH_MODE, digest_after=None, digest_file=True):
+    print_rendered_messages(render_diff_messages(diff_list, batch_mode, digest_after, digest_file))
+
+
+def print_rendered_messages(rendered_messages):
+    for notif_type, msg, files in rendered_messages:
+        print("[PRIMARY]  " if notif_type == NotificationType.PRIMARY else "[SECONDARY]", msg)
+        for file_name, text in files:
+            num_lines = text.count("\n")
+            print(f"            (attached {file_name}, {num_lines} lines)")
+
+
+# renders the messages and durably adds them to the outbox. this should happen before the state is saved, so that
+# once the state says a clear was seen, the message about it is guaranteed to be sent eventually. returns the ids of the
+# queued messages, for unqueue_messages if saving the state fails.
+def queue_diff_messages(diff_list, batch_mode=DEFAULT_BATCH_MODE, digest_after=None, digest_file=True):
+    return queue_rendered_messages(render_diff_messages(diff_list, batch_mode, digest_after, digest_file))
+
+
+# rendered_messages is a list of (notif_type, message content, files). returns the ids of the queued messages.
+def queue_rendered_messages(rendered_messages):
+    if get_discord_urls() is None:
+        return []
+    messages = []
+    for notif_type, msg, files in rendered_messages:
+        payload = {"content": msg}
+        if files:
+            payload["attachments"] = [{"id": i, "filename": file_name} for i, (file_name, _) in enumerate(files)]
+        messages.append((notif_type.name, payload, files))
+    message_ids = _outbox.add(messages)
+    timing.count("discord_messages_queued", len(messages))
+    return message_ids
+
+
+# takes queued messages out of the outbox before they're sent. the next run finds the same changes again, and queues
+# them again.
+def unqueue_messages(message_ids):
+    _outbox.withdraw(message_ids)
+    timing.count("discord_messages_unqueued", len(message_ids))
+
+
+def has_queued_messages():
+    return bool(_outbox.pending())
+
+
+# sends everything in the outbox, including messages left over from earlier runs. messages that still can't be
+# delivered stay in the outbox for the next run.
+def send_queued_messages():
+    discord_urls = get_discord_urls()
+    if discord_urls is None:
+        return
+
+    # discord url -> list of (message_id, payload, files), in the order they should be sent
+    messages_by_url = {url: [] for url in discord_urls.values()}
+    for message_id, notif_type_name, payload, files in _outbox.pending():
+        messages_by_url[discord_urls[NotificationType[notif_type_name]]].append((message_id, payload, files))
+
+    # each webhook has its own rate limit, so send to all of them in parallel (but in order within each one)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(messages_by_url)) as executor:
+        futures = [lists.submit_in_context(executor, send_messages_to_webhook, url, messages)
+                   for url, messages in messages_by_url.items()]
+        num_undelivered = sum(future.result() for future in futures)
+
+    _outbox.compact()
+    if num_undelivered:
+        print(f"WARNING: {num_undelivered} Discord messages couldn't be delivered, will retry on the next run.")
+
+
+# returns how many messages are left undelivered
+def send_messages_to_webhook(discord_url, messages):
+    for i, (message_id, payload, files) in enumerate(messages):
+        delivered = send_message_to_webhook(discord_url, payload, files)
+        if delivered is None:
+            # stop here instead of skipping ahead, so messages never arrive out of order
+            return len(messages) - i
+        _outbox.mark_done(message_id)
+    return 0
+
+
+# returns True if discord accepted the message, False if it rejected it for good (so there's no point retrying it),
+# and None if it should be retried later. files ([file name, text]) are sent as attachments, which needs a multipart
+# request with the payload as its payload_json field.
+def send_message_to_webhook(discord_url, payload, files=()):
+    import requests
+
+    num_rate_limited = 0
+    num_failed = 0
+
+    while True:
+        waited = _rate_limiter.wait(discord_url)
+        if waited:
+            timing.count("discord_rate_limit_wait_seconds", waited)
+        timing.count("discord_requests")
+        try:
+            if files:
+                response = get_session().post(
+                    discord_url, data={"payload_json": json.dumps(payload)}, timeout=WEBHOOK_TIMEOUT,
+                    files={f"files[{i}]": (file_name, text.encode()) for i, (file_name, text) in enumerate(files)})
+            else:
+                response = get_session().post(discord_url, json=payload, timeout=WEBHOOK_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"ERROR: Failed to send Discord message: {e}")
+            response = None
+
+        if response is not None:
+            retry_after = _rate_limiter.update(discord_url, response)
+            if retry_after is not None:
+                timing.count("discord_rate_limited")
+                num_rate_limited += 1
+                if num_rate_limited > MAX_RATE_LIMITED_RETRIES:
+                    print(f"ERROR: Still rate limited by Discord after {MAX_RATE_LIMITED_RETRIES} retries.")
+                    return None
+                print(f"WARNING: Rate limited by Discord, retrying in {retry_after:.2f} sec")
+                continue
+            if response.ok:
+                timing.count("discord_messages_sent")
+                return True
+            if response.status_code < 500:
+                timing.count("discord_messages_rejected")
+                print(f"ERROR: Discord rejected message ({response.status_code}: {response.text}): "
+                      f"{payload['content']}")
+                return False
+            print(f"ERROR: Discord returned {response.status_code} for message.")
+
+        num_failed += 1
+        if num_failed >= MAX_DELIVERY_ATTEMPTS:
+            return None
+        time.sleep(DELIVERY_BACKOFF_BASE * 2 ** (num_failed - 1))
+
+
+# packs (message, pings, map difficulty) tuples into as few discord messages as possible according to batch_mode.
+# every role is pinged at most once per discord message, on its own line at the end.
+def batch_messages(message_parts, batch_mode):
+    if batch_mode == "none":
+        return [" ".join((msg, *pings)) for msg, pings, _ in message_parts]
+
+    if batch_mode == "stars":
+        # group by star difficulty, hardest first, with non-map diffs (players) at the end
+        message_parts = sorted(message_parts, key=lambda parts: -1 if parts[2] is None else parts[2], reverse=True)
+
+    batched_messages = []
+    lines = []
+    batch_pings = []
+    batch_difficulty = None
+
+    for msg, pings, map_difficulty in message_parts:
+        new_batch_pings = batch_pings + [ping for ping in pings if ping and ping not in batch_pings]
+        starts_new_group = batch_mode == "stars" and lines and map_difficulty != batch_difficulty
+        if lines and (starts_new_group or
+                      len(join_batched_message(lines + [msg], new_batch_pings)) > DISCORD_MAX_MESSAGE_LENGTH):
+            batched_messages.append(join_batched_message(lines, batch_pings))
+            lines = []
+            new_batch_pings = list(dict.fromkeys(ping for ping in pings if ping))
+
+        lines.append(msg)
+        batch_pings = new_batch_pings
+        batch_difficulty = map_difficulty
+
+    if lines:
+        batched_messages.append(join_batched_message(lines, batch_pings))
+
+    return batched_messages
+
+
+def join_batched_message(lines, pings):
+    msg = "\n".join(lines)
+    if pings:
+        msg += "\n" + " ".join(pings)
+    return msg
+
+
+# the star difficulty a diff is about, or None for player diffs
+def diff_to_map_difficulty(diff_type, values):
+    match diff_type:
+        case DiffType.ADDED_CLEAR | DiffType.REMOVED_CLEAR | DiffType.CHANGED_CLEAR:
+            return values[-1]
+        case DiffType.ADDED_MAP | DiffType.REMOVED_MAP:
+            return values[1]
+        case DiffType.RENAMED_MAP | DiffType.CLEAR_MILESTONE | DiffType.FIRST_GOLDEN:
+            return values[2]
+    return None
 
 
 def format_player_or_map_name(value):
@@ -77,8 +398,8 @@ def normal_clear_message(player_name, map_name, map_emoji, clear_type, map_diffi
 
     if clear_type in [ClearType.GOLDEN, ClearType.GOLDEN_AND_FC, ClearType.GOLDEN_FC]:
         secondary_ping = GOLDEN_ROLE_PING
-        # get_golden_tiers is cached, so this is fine
-        golden_tiers = goldens.get_golden_tiers()
+        # get_golden_tiers is cached in memory and on disk, so this is fine
+        golden_tiers = goldens.get_golden_tiers(map_name)
         index = 1 if clear_type == ClearType.GOLDEN_FC else 0
         if map_name in golden_tiers and golden_tiers[map_name][index]:
             msg += f" ({golden_tiers[map_name][index]})"
@@ -87,10 +408,16 @@ def normal_clear_message(player_name, map_name, map_emoji, clear_type, map_diffi
     elif clear_type in [ClearType.ALL_SILVERS, ClearType.ALL_SILVERS_AND_FC]:
         secondary_ping = SILVER_ROLE_PING
 
-    return f"{msg}! {STAR_ROLE_PINGS[map_difficulty]} {secondary_ping}"
+    return f"{msg}!", (STAR_ROLE_PINGS[map_difficulty], secondary_ping)
 
 
 def diff_to_message(diff_type, values):
+    msg, pings, notif_type = diff_to_message_and_pings(diff_type, values)
+    return " ".join((msg, *pings)), notif_type
+
+
+# like diff_to_message, but keeps the role pings separate from the message so they can be deduplicated when batching
+def diff_to_message_and_pings(diff_type, values):
     match diff_type:
         case DiffType.ADDED_CLEAR:
             player_name, map_name, map_clear_type, cell_value, map_difficulty = values
@@ -100,9 +427,9 @@ def diff_to_message(diff_type, values):
                 return (f"⚠️ An unrecognized value ({cell_value}) was added to "
                         f"{format_player_or_map_name(player_name)}'s cell for "
                         f"{map_emoji} {format_player_or_map_name(map_name)}!",
-                        NotificationType.SECONDARY)
+                        (), NotificationType.SECONDARY)
             else:
-                return (normal_clear_message(player_name, map_name, map_emoji, clear_type, map_difficulty),
+                return (*normal_clear_message(player_name, map_name, map_emoji, clear_type, map_difficulty),
                         NotificationType.PRIMARY)
 
         case DiffType.REMOVED_CLEAR:
@@ -111,7 +438,7 @@ def diff_to_message(diff_type, values):
             map_emoji = STAR_EMOJIS[map_difficulty]
             return (f"🔴 {format_player_or_map_name(player_name)}'s clear of {map_emoji} "
                     f"{format_player_or_map_name(map_name)} was REMOVED (was {old_cell_value} ({clear_type}))!",
-                    NotificationType.SECONDARY)
+                    (), NotificationType.SECONDARY)
 
         case DiffType.CHANGED_CLEAR:
             player_name, map_name, map_clear_type, old_cell_value, new_cell_value, map_difficulty = values
@@ -121,41 +448,54 @@ def diff_to_message(diff_type, values):
             _, new_tier, _ = clear_type_to_action_tier_emoji(new_clear_type)
             map_emoji = STAR_EMOJIS[map_difficulty]
             if new_tier > old_tier:
-                return (normal_clear_message(player_name, map_name, map_emoji, new_clear_type, map_difficulty),
+                return (*normal_clear_message(player_name, map_name, map_emoji, new_clear_type, map_difficulty),
                         NotificationType.PRIMARY)
             else:
                 return (f"🟡 {format_player_or_map_name(player_name)}'s clear of {map_emoji} "
                         f"{format_player_or_map_name(map_name)} was changed from "
                         f"{old_cell_value} ({old_clear_type}) to {new_cell_value} ({new_clear_type})",
-                        NotificationType.SECONDARY)
+                        (), NotificationType.SECONDARY)
 
         case DiffType.ADDED_PLAYER:
             player_name, = values
-            return (f"👋 A new player was added: {format_player_or_map_name(player_name)} {NEW_PLAYER_ROLE_PING}",
+            return (f"👋 A new player was added: {format_player_or_map_name(player_name)}", (NEW_PLAYER_ROLE_PING,),
                     NotificationType.PRIMARY)
         case DiffType.REMOVED_PLAYER:
             player_name, = values
-            return f"🪦 A player was removed: {format_player_or_map_name(player_name)}", NotificationType.SECONDARY
+            return f"🪦 A player was removed: {format_player_or_map_name(player_name)}", (), NotificationType.SECONDARY
         case DiffType.RENAMED_PLAYER:
             old_player_name, new_player_name = values
             return (f"🤷 Player {format_player_or_map_name(old_player_name)} was RENAMED to "
                     f"{format_player_or_map_name(new_player_name)}!",
-                    NotificationType.SECONDARY)
+                    (), NotificationType.SECONDARY)
 
         case DiffType.ADDED_MAP:
             map_name, map_difficulty = values
             map_emoji = STAR_EMOJIS[map_difficulty]
             return (f"🗺️ A new map was added: {map_emoji} {format_player_or_map_name(map_name)}",
-                    NotificationType.PRIMARY)
+                    (), NotificationType.PRIMARY)
         case DiffType.REMOVED_MAP:
-            map_name, = values
-            return f"❌ A map was removed: {format_player_or_map_name(map_name)}", NotificationType.PRIMARY
+            map_name, map_difficulty = values
+            # the star difficulty is None if the state was saved before the map catalog was
+            map_emoji = f"{STAR_EMOJIS[map_difficulty]} " if map_difficulty is not None else ""
+            return (f"❌ A map was removed: {map_emoji}{format_player_or_map_name(map_name)}",
+                    (), NotificationType.PRIMARY)
         case DiffType.RENAMED_MAP:
             old_map_name, new_map_name, map_difficulty = values
             map_emoji = STAR_EMOJIS[map_difficulty]
             return (f"📋 Map {format_player_or_map_name(old_map_name)} was RENAMED to "
                     f"{map_emoji} {format_player_or_map_name(new_map_name)}!",
-                    NotificationType.SECONDARY)
+                    (), NotificationType.SECONDARY)
+
+        case DiffType.CLEAR_MILESTONE:
+            player_name, clear_count, map_difficulty = values
+            return (f"🏆 {format_player_or_map_name(player_name)} has cleared {clear_count} "
+                    f"{STAR_EMOJIS[map_difficulty]} maps!", (), NotificationType.PRIMARY)
+        case DiffType.FIRST_GOLDEN:
+            player_name, map_name, map_difficulty = values
+            return (f"{ANIMATED_GOLDEN_EMOJI} {format_player_or_map_name(player_name)} got the FIRST EVER golden of "
+                    f"{STAR_EMOJIS[map_difficulty]} {format_player_or_map_name(map_name)}!",
+                    (), NotificationType.PRIMARY)
 
     print(f"ERROR: unknown diff type {diff_type} (values: {values})")
     sys.exit(1)
@@ -0,0 +1,433 @@
+import argparse
+import datetime
+import gzip
+import json
+import os
+import re
+import sys
+import time
+import uuid
+
+import clear_types
+import helpers
+import local_cache
+import timing
+from constants import DiffType
+from state import ClearState
+
+# a local history of every diff that was saved to the state sheet, so questions like "all goldens this month" or "a
+# player's clear history" can be answered without going back to the sheets. it lives in the list's cache directory:
+#   segment-000001.jsonl.gz, ...  the events, one json object per line. every run appends one gzip member to the last
+#                                 segment, and a segment that's full is recompressed as a single member.
+#   segment-000001.index.json     where in the segment to find the events of every player, map, star difficulty, clear
+#                                 type and diff type (see index_event), so queries only decompress segments with matches
+#   snapshot-0000000123.json.gz   the whole state as of some event, so rebuild_state only has to replay what came after
+# every event is {"seq": ..., "batch": ..., "time": ..., "type": <DiffType name>, "values": [...]}, where values are
+# the diff's values. every batch (one run's save) ends with a "cells" event with the raw cell changes of the run (see
+# clears.get_state_diff_list_and_cell_changes), which are what rebuild_state replays, since the diffs themselves leave
+# out the [C]/[FC] details of clears.
+# the id of every batch is saved in the state sheet's metadata together with the state, so the log can tell when the
+# state sheet was saved without it (a crash right after saving, --no-event-log, or a lost cache) and take a snapshot
+# instead of replaying a history with a hole in it.
+
+EVENT_LOG_DIR_NAME = "events"
+# the state metadata section with the id of the batch the state was saved with, as ["event_log", "batch", <id>]
+EVENT_LOG_SECTION = "event_log"
+CELLS_EVENT_TYPE = "cells"
+# a segment gets sealed (and a snapshot taken) once it has this many events
+SEGMENT_MAX_EVENTS = 20000
+SNAPSHOTS_TO_KEEP = 2
+GZIP_COMPRESS_LEVEL = 6
+INDEX_KEYS = ("player", "map", "stars", "clear_type", "type")
+
+SEGMENT_FILE_NAME_FORMAT = "segment-{:06d}.jsonl.gz"
+SEGMENT_FILE_NAME_RE = re.compile(r"segment-(\d+)\.jsonl\.gz")
+SEGMENT_INDEX_FILE_NAME_FORMAT = "segment-{:06d}.index.json"
+SNAPSHOT_FILE_NAME_FORMAT = "snapshot-{:010d}.json.gz"
+SNAPSHOT_FILE_NAME_RE = re.compile(r"snapshot-(\d+)\.json\.gz")
+
+
+class EventLog:
+    def __init__(self, log_dir=None):
+        self.log_dir = log_dir if log_dir is not None else local_cache.cache_path(EVENT_LOG_DIR_NAME)
+        os.makedirs(self.log_dir, exist_ok=True)
+
+    def path(self, file_name_format, number):
+        return os.path.join(self.log_dir, file_name_format.format(number))
+
+    # the numbers in the names of the files that fully match file_name_re, in order
+    def file_numbers(self, file_name_re):
+        return sorted(int(match.group(1)) for match in map(file_name_re.fullmatch, os.listdir(self.log_dir)) if match)
+
+    def segment_numbers(self):
+        return self.file_numbers(SEGMENT_FILE_NAME_RE)
+
+    def snapshot_seqs(self):
+        return self.file_numbers(SNAPSHOT_FILE_NAME_RE)
+
+    # returns the index of a segment, first dropping anything a crash left in the segment after the last indexed batch.
+    # a segment that's smaller than its index says was sealed (see seal_segment) right before a crash.
+    def load_index(self, segment_number):
+        index_path = self.path(SEGMENT_INDEX_FILE_NAME_FORMAT, segment_number)
+        segment_path = self.path(SEGMENT_FILE_NAME_FORMAT, segment_number)
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = new_index(segment_number)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Event log index {index_path} is unreadable: {e}")
+            sys.exit(1)
+
+        size = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+        if size > index["size"]:
+            print(f"WARNING: Dropping the unindexed end of event log segment {segment_number}.")
+            with open(segment_path, "r+b") as f:
+                f.truncate(index["size"])
+        elif size < index["size"]:
+            index["size"] = size
+        return index
+
+    def save_index(self, index):
+        timing.write_file_atomically(self.path(SEGMENT_INDEX_FILE_NAME_FORMAT, index["segment"]),
+                                     json.dumps(index, separators=(",", ":")))
+
+    # the index of the segment new events go to
+    def last_index(self):
+        segment_numbers = self.segment_numbers()
+        if not segment_numbers:
+            return new_index(1)
+        return self.load_index(segment_numbers[-1])
+
+    # appends a run's diffs to the log as batch_id, once the state was saved with it. previous_state and current_state
+    # are the whole states before and after the run, cell_changes are the run's raw cell changes, and previous_batch_id
+    # is the batch the previous state was saved with. if the log doesn't end with that batch, a snapshot of
+    # previous_state is taken first, so rebuilding from the log still gives the right state. returns the number of
+    # events appended.
+    def append(self, previous_state, current_state, diff_list, cell_changes, batch_id, previous_batch_id,
+               event_time=None):
+        event_time = round(event_time if event_time is not None else time.time(), 3)
+        index = self.last_index()
+        if index["num_events"] >= SEGMENT_MAX_EVENTS:
+            index = new_index(index["segment"] + 1, index)
+
+        if index["last_batch"] != previous_batch_id or not self.snapshot_seqs():
+            self.save_snapshot(previous_state, index["last_seq"], event_time)
+
+        seq = index["last_seq"]
+        lines = []
+        events = [(diff_type.name, list(values)) for diff_type, *values in diff_list]
+        events.append((CELLS_EVENT_TYPE, [list(cell_change) for cell_change in cell_changes]))
+        for event_type, values in events:
+            seq += 1
+            event = {"seq": seq, "batch": batch_id, "time": event_time, "type": event_type, "values": values}
+            index_event(index, index["num_events"], event)
+            index["num_events"] += 1
+            lines.append(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+        segment_path = self.path(SEGMENT_FILE_NAME_FORMAT, index["segment"])
+        with gzip.open(segment_path, "at", encoding="utf-8", compresslevel=GZIP_COMPRESS_LEVEL) as f:
+            f.writelines(lines)
+        # the index is only saved once the events are, so an index never points at events that aren't there
+        index.update(last_seq=seq, last_batch=batch_id, size=os.path.getsize(segment_path))
+        if index["first_time"] is None:
+            index["first_time"] = event_time
+        index["last_time"] = event_time
+        self.save_index(index)
+
+        if index["num_events"] >= SEGMENT_MAX_EVENTS:
+            self.seal_segment(index)
+            self.save_snapshot(current_state, seq, event_time)
+        return len(lines)
+
+    # recompresses a full segment as a single gzip member, which is smaller and faster to read than one per run
+    def seal_segment(self, index):
+        segment_path = self.path(SEGMENT_FILE_NAME_FORMAT, index["segment"])
+        tmp_path = f"{segment_path}.tmp"
+        with gzip.open(segment_path, "rb") as f_in, gzip.open(tmp_path, "wb", GZIP_COMPRESS_LEVEL) as f_out:
+            f_out.write(f_in.read())
+        os.replace(tmp_path, segment_path)
+        index["size"] = os.path.getsize(segment_path)
+        self.save_index(index)
+
+    # saves the whole state as of event seq, and deletes all but the newest SNAPSHOTS_TO_KEEP snapshots
+    def save_snapshot(self, state, seq, snapshot_time):
+        snapshot = {"seq": seq, "time": snapshot_time, "cells": [[*key, value] for key, value in state.items()]}
+        snapshot_path = self.path(SNAPSHOT_FILE_NAME_FORMAT, seq)
+        tmp_path = f"{snapshot_path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=GZIP_COMPRESS_LEVEL) as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, snapshot_path)
+
+        for old_seq in self.snapshot_seqs()[:-SNAPSHOTS_TO_KEEP]:
+            os.remove(self.path(SNAPSHOT_FILE_NAME_FORMAT, old_seq))
+
+    # yields the events with the given ordinals (line numbers) of a segment, in order
+    def read_segment(self, segment_number, ordinals=None):
+        wanted = set(ordinals) if ordinals is not None else None
+        last_wanted = max(wanted, default=-1) if wanted is not None else None
+        with gzip.open(self.path(SEGMENT_FILE_NAME_FORMAT, segment_number), "rt", encoding="utf-8") as f:
+            for ordinal, line in enumerate(f):
+                if wanted is None or ordinal in wanted:
+                    yield json.loads(line)
+                if last_wanted is not None and ordinal >= last_wanted:
+                    return
+
+    # yields the diff events (oldest first) that match every given filter. a filter can be one value or a list of
+    # values that each match: player and map_name are trimmed names (renames match both names), stars is a star
+    # difficulty, clear_type a ClearType, diff_type a DiffType, and since/until are unix times.
+    def query(self, player=None, map_name=None, stars=None, clear_type=None, diff_type=None, since=None, until=None):
+        filters = {
+            "player": player,
+            "map": map_name,
+            "stars": None if stars is None else [str(value) for value in as_list(stars)],
+            "clear_type": None if clear_type is None else [value.name for value in as_list(clear_type)],
+            "type": None if diff_type is None else [value.name for value in as_list(diff_type)],
+        }
+
+        for segment_number in self.segment_numbers():
+            index = self.load_index(segment_number)
+            if index["first_time"] is None or (since is not None and index["last_time"] < since) or \
+                    (until is not None and index["first_time"] > until):
+                continue
+
+            ordinals = None
+            for key, values in filters.items():
+                if values is None:
+                    continue
+                key_ordinals = set()
+                for value in as_list(values):
+                    key_ordinals.update(index[key].get(value, ()))
+                ordinals = key_ordinals if ordinals is None else ordinals & key_ordinals
+                if not ordinals:
+                    break
+            if ordinals is not None and not ordinals:
+                continue
+
+            for event in self.read_segment(segment_number, sorted(ordinals) if ordinals is not None else None):
+                if event["type"] == CELLS_EVENT_TYPE or (since is not None and event["time"] < since) or \
+                        (until is not None and event["time"] > until):
+                    continue
+                yield event
+
+    # the state as of the end of the log: the newest snapshot with every later batch's changes replayed on top
+    def rebuild_state(self):
+        snapshot_seqs = self.snapshot_seqs()
+        if not snapshot_seqs:
+            return None
+        with gzip.open(self.path(SNAPSHOT_FILE_NAME_FORMAT, snapshot_seqs[-1]), "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        cells = {(player_name, map_name): value for player_name, map_name, value in snapshot["cells"]}
+
+        batch_events = []
+        for segment_number in self.segment_numbers():
+            index = self.load_index(segment_number)
+            if index["last_seq"] <= snapshot["seq"]:
+                continue
+            for event in self.read_segment(segment_number):
+                if event["seq"] <= snapshot["seq"]:
+                    continue
+                batch_events.append(event)
+                if event["type"] == CELLS_EVENT_TYPE:
+                    cells = replay_batch(cells, batch_events)
+                    batch_events = []
+
+        return ClearState(cells.items())
+
+
+def new_index(segment_number, previous_index=None):
+    return {
+        "segment": segment_number,
+        "size": 0,
+        "num_events": 0,
+        "last_seq": previous_index["last_seq"] if previous_index is not None else 0,
+        # the id of the last batch, or None if nothing's been logged yet
+        "last_batch": previous_index["last_batch"] if previous_index is not None else None,
+        "first_time": None,
+        "last_time": None,
+        **{key: {} for key in INDEX_KEYS},
+    }
+
+
+# adds the event at ordinal to the index of every player, map, star difficulty, clear type and diff type it's about
+def index_event(index, ordinal, event):
+    if event["type"] == CELLS_EVENT_TYPE:
+        return
+    for key, value in event_index_values(event):
+        index[key].setdefault(value, []).append(ordinal)
+
+
+# yields (index key, value) pairs for an event
+def event_index_values(event):
+    diff_type = DiffType[event["type"]]
+    values = event["values"]
+    yield "type", diff_type.name
+
+    match diff_type:
+        case DiffType.ADDED_CLEAR | DiffType.REMOVED_CLEAR | DiffType.CHANGED_CLEAR:
+            player_name, map_name, map_clear_type, *cell_values, map_difficulty = values
+            yield "player", player_name
+            yield "map", map_name
+            yield "stars", str(map_difficulty)
+            # the new value, or the one that was removed
+            yield "clear_type", clear_types.cell_value_to_clear_type(cell_values[-1], map_clear_type).name
+        case DiffType.ADDED_PLAYER | DiffType.REMOVED_PLAYER:
+            yield "player", values[0]
+        case DiffType.RENAMED_PLAYER:
+            yield "player", values[0]
+            yield "player", values[1]
+        case DiffType.ADDED_MAP:
+            yield "map", helpers.trim_map_name(values[0])[0]
+            yield "stars", str(values[1])
+        case DiffType.REMOVED_MAP:
+            yield "map", helpers.trim_map_name(values[0])[0]
+            # events logged before the map catalog existed don't have one
+            if len(values) > 1 and values[1] is not None:
+                yield "stars", str(values[1])
+        case DiffType.RENAMED_MAP:
+            yield "map", helpers.trim_map_name(values[0])[0]
+            yield "map", helpers.trim_map_name(values[1])[0]
+            yield "stars", str(values[2])
+        case DiffType.CLEAR_MILESTONE:
+            yield "player", values[0]
+            yield "stars", str(values[2])
+        case DiffType.FIRST_GOLDEN:
+            yield "player", values[0]
+            yield "map", values[1]
+            yield "stars", str(values[2])
+
+
+# applies one batch (its diff events, then its cells event) to cells, which is (player, map) -> value. removed and
+# renamed players and maps come from the diffs, and the cell changes already use the new names.
+def replay_batch(cells, batch_events):
+    removed_players = set()
+    removed_maps = set()
+    player_renamings = {}
+    map_renamings = {}
+    for event in batch_events[:-1]:
+        values = event["values"]
+        match DiffType[event["type"]]:
+            case DiffType.REMOVED_PLAYER:
+                removed_players.add(values[0])
+            case DiffType.REMOVED_MAP:
+                removed_maps.add(values[0])
+            case DiffType.RENAMED_PLAYER:
+                player_renamings[values[0]] = values[1]
+            case DiffType.RENAMED_MAP:
+                map_renamings[values[0]] = values[1]
+
+    if removed_players or removed_maps or player_renamings or map_renamings:
+        cells = {(player_renamings.get(player_name, player_name), map_renamings.get(map_name, map_name)): value
+                 for (player_name, map_name), value in cells.items()
+                 if player_name not in removed_players and map_name not in removed_maps}
+
+    for player_name, map_name, value in batch_events[-1]["values"]:
+        if value:
+            cells[player_name, map_name] = value
+        else:
+            cells.pop((player_name, map_name), None)
+    return cells
+
+
+def new_batch_id():
+    return uuid.uuid4().hex
+
+
+# the batch the state in the state sheet was saved with, or None
+def get_saved_batch_id(metadata):
+    return metadata.get(EVENT_LOG_SECTION, "batch")
+
+
+def event_to_diff(event):
+    return DiffType[event["type"]], *event["values"]
+
+
+def as_list(value):
+    return list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+
+
+# "2026-10-01" or "2026-10-01T12:00" (utc unless it says otherwise) -> unix time
+def parse_time(value):
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date or time: {value}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def format_time(unix_time):
+    return datetime.datetime.fromtimestamp(unix_time, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+# noinspection PyShadowingNames
+def query_command(args):
+    from constants import ClearType
+
+    event_log = EventLog(args.log_dir)
+    events = event_log.query(
+        player=args.player, map_name=args.map, stars=args.stars,
+        clear_type=[ClearType[name] for name in args.clear_type] if args.clear_type else None,
+        diff_type=[DiffType[name] for name in args.diff_type] if args.diff_type else None,
+        since=args.since, until=args.until)
+    num_events = 0
+    for event in events:
+        print(f"{format_time(event['time'])}  {event['type']:<15} {' | '.join(map(str, event['values']))}")
+        num_events += 1
+    print(f"{num_events} events.")
+
+
+# noinspection PyShadowingNames
+def rebuild_command(args):
+    event_log = EventLog(args.log_dir)
+    state = event_log.rebuild_state()
+    if state is None:
+        print("ERROR: The event log has no snapshot to rebuild the state from.")
+        sys.exit(1)
+    print(f"Rebuilt a state with {len(state)} cells, {len(state.player_names())} players and "
+          f"{len(state.map_names())} maps.")
+    if not args.save:
+        return
+
+    import clears
+    import fingerprints
+    import sheets
+
+    state_sheet, _, _, metadata = sheets.load_previous_state_from_state_sheet()
+    # the fingerprints are for whatever the state sheet had, so make the next run parse the whole clears page. the
+    # state is now the one at the end of the log, so the log can carry on from its last batch.
+    metadata_values = {(EVENT_LOG_SECTION, "batch"): event_log.last_index()["last_batch"]}
+    sheets.save_clears_to_state_sheet(state_sheet, clears.save_state_as_grid(state),
+                                      (metadata, fingerprints.FINGERPRINT_SECTIONS | {EVENT_LOG_SECTION},
+                                       metadata_values))
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Query the clear event log or rebuild the state from it")
+    parser.add_argument("--log-dir", help="Event log directory (default: the events directory in the cache)")
+    subparsers = parser.add_subparsers(required=True)
+
+    query_parser = subparsers.add_parser("query", help="Print the events that match every given filter")
+    query_parser.add_argument("--player", action="append", help="Player name (can be given more than once)")
+    query_parser.add_argument("--map", action="append", help="Map name without [C]/[FC] (can be given more than once)")
+    query_parser.add_argument("--stars", type=int, action="append",
+                              help="Star difficulty (can be given more than once)")
+    query_parser.add_argument("--clear-type", action="append", help="ClearType name, e.g. GOLDEN (can be repeated)")
+    query_parser.add_argument("--diff-type", action="append", help="DiffType name, e.g. ADDED_CLEAR (can be repeated)")
+    query_parser.add_argument("--since", type=parse_time, help="Only events at or after this ISO date or time (UTC)")
+    query_parser.add_argument("--until", type=parse_time, help="Only events at or before this ISO date or time (UTC)")
+    query_parser.set_defaults(func=query_command)
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="Rebuild the state from the newest snapshot and the events "
+                                                           "after it")
+    rebuild_parser.add_argument("--save", action="store_true",
+                                help="Overwrite the state sheet (STATE_SHEET_ID) with the rebuilt state")
+    rebuild_parser.set_defaults(func=rebuild_command)
+
+    args = parser.parse_args()
+    args.func(args)
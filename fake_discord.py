@@ -0,0 +1,190 @@
+import argparse
+import email.parser
+import email.policy
+import http.server
+import json
+import random
+import threading
+import time
+
+from constants import DISCORD_MAX_MESSAGE_LENGTH
+
+# a local stand-in for discord webhooks, for offline runs and load tests. every path is its own webhook with its own
+# rate limit bucket, answered with the same X-RateLimit-* headers and 429 bodies discord sends, so discord.py's rate
+# limiter and retries get exercised too. messages that discord would reject (empty or too long) get a 400. messages
+# with attachments come as multipart requests like discord expects them, with the message in the payload_json field.
+
+DEFAULT_PORT = 8765
+DEFAULT_LIMIT = 5
+DEFAULT_RESET_AFTER = 2.0
+
+
+class FakeDiscord:
+    def __init__(self, limit=DEFAULT_LIMIT, reset_after=DEFAULT_RESET_AFTER, error_rate=0.0, rate_limit_rate=0.0,
+                 latency=0.0, seed=None):
+        self.limit = limit
+        self.reset_after = reset_after
+        # fraction of requests that get a 500 or a 429 regardless of the bucket
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        # seconds to wait before answering every request
+        self.latency = latency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        # path -> [remaining, reset_at]
+        self._buckets = {}
+        # every accepted message as (time.monotonic() it arrived at, path, payload)
+        self.messages = []
+        # every accepted attachment as (path, file name, size in bytes)
+        self.attachments = []
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_errors = 0
+        self.num_rejected = 0
+
+    # returns (status, headers, body) for a request to path. files is file name -> contents of the attachments.
+    def handle(self, path, payload, files=None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.num_requests += 1
+            now = time.monotonic()
+            remaining, reset_at = self._buckets.get(path, (self.limit, now + self.reset_after))
+            if now >= reset_at:
+                remaining, reset_at = self.limit, now + self.reset_after
+
+            headers = {
+                "X-RateLimit-Limit": str(self.limit),
+                "X-RateLimit-Bucket": f"fake-{abs(hash(path)) % 10 ** 8}",
+            }
+            roll = self._rng.random()
+
+            if remaining <= 0 or roll < self.rate_limit_rate:
+                self.num_rate_limited += 1
+                retry_after = max(reset_at - now, 0.0) if remaining <= 0 else self.reset_after / self.limit
+                headers.update({
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset-After": f"{retry_after:.3f}",
+                    "Retry-After": str(max(int(retry_after + 0.999), 1)),
+                    "X-RateLimit-Scope": "user",
+                })
+                return 429, headers, {"message": "You are being rate limited.", "retry_after": round(retry_after, 3),
+                                      "global": False}
+
+            remaining -= 1
+            self._buckets[path] = (remaining, reset_at)
+            headers.update({
+                "X-RateLimit-Remaining": str(remaining),
+                "X-RateLimit-Reset-After": f"{reset_at - now:.3f}",
+                "X-RateLimit-Reset": f"{time.time() + reset_at - now:.3f}",
+            })
+
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.num_errors += 1
+                return 500, headers, {"message": "500: Internal Server Error", "code": 0}
+
+            content = payload.get("content", "") if isinstance(payload, dict) else ""
+            if not content or len(content) > DISCORD_MAX_MESSAGE_LENGTH:
+                self.num_rejected += 1
+                return 400, headers, {"message": "Invalid Form Body", "code": 50035}
+
+            self.messages.append((now, path, payload))
+            self.attachments += [(path, file_name, len(data)) for file_name, data in (files or {}).items()]
+            return 204, headers, None
+
+    def make_handler(self):
+        fake_discord = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep connections alive like discord does, so the pooled session gets used
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                content_type = self.headers.get("Content-Type", "")
+                files = None
+                try:
+                    if content_type.startswith("multipart/form-data"):
+                        payload, files = parse_multipart(content_type, body)
+                    else:
+                        payload = json.loads(body)
+                except ValueError:
+                    payload = None
+                status, headers, response_body = fake_discord.handle(self.path.split("?")[0], payload, files)
+
+                data = json.dumps(response_body).encode() if response_body is not None else b""
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if data:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format_string, *args):
+                pass
+
+        return Handler
+
+    # starts serving on a background thread. returns the server, whose server_address has the actual port.
+    def start(self, host="127.0.0.1", port=0):
+        server = http.server.ThreadingHTTPServer((host, port), self.make_handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# returns (payload from the payload_json field, file name -> contents of every file field)
+def parse_multipart(content_type, body):
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    payload = None
+    files = {}
+    for part in message.iter_parts():
+        if part.get_param("name", header="content-disposition") == "payload_json":
+            payload = json.loads(part.get_payload(decode=True))
+        elif part.get_filename():
+            files[part.get_filename()] = part.get_payload(decode=True)
+    return payload, files
+
+
+def webhook_url(server, name):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/api/webhooks/{name}/fake-token"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fake Discord webhooks locally")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT,
+                        help=f"Requests per bucket window (default: {DEFAULT_LIMIT})")
+    parser.add_argument("--reset-after", type=float, default=DEFAULT_RESET_AFTER,
+                        help=f"Seconds per bucket window (default: {DEFAULT_RESET_AFTER})")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that get a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of requests that get a 429 even with room left in the bucket")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before every response")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print every accepted message")
+    args = parser.parse_args()
+
+    fake_discord = FakeDiscord(args.limit, args.reset_after, args.error_rate, args.rate_limit_rate, args.latency)
+    server = fake_discord.start(args.host, args.port)
+    print("Serving fake Discord webhooks. Use them with:")
+    print(f"  PRIMARY_DISCORD_WEBHOOK_URL={webhook_url(server, 'primary')}")
+    print(f"  SECONDARY_DISCORD_WEBHOOK_URL={webhook_url(server, 'secondary')}")
+
+    num_printed = 0
+    try:
+        while True:
+            time.sleep(1)
+            if args.verbose:
+                for _, path, payload in fake_discord.messages[num_printed:]:
+                    print(f"{path}: {payload.get('content')}")
+                num_printed = len(fake_discord.messages)
+    except KeyboardInterrupt:
+        print(f"\n{len(fake_discord.messages)} messages accepted, {fake_discord.num_rate_limited} rate limited, "
+              f"{fake_discord.num_errors} errors, {fake_discord.num_rejected} rejected.")
+        server.shutdown()
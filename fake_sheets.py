@@ -0,0 +1,435 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+
+import synthetic
+import timing
+from constants import CLEARS_PAGE_NAME, CLD_PAGE_NAME, MAX_STAR_DIFFICULTY, CLD_COLS_PER_STAR, CLD_MAP_NAME_OFFSET, \
+    CLD_FIRST_TIER_ROW_INDEX
+
+# a file-backed stand-in for the parts of gspread that sheets.py uses, so the whole pipeline can run offline. every
+# spreadsheet is a json file named after its id in one directory:
+# {"modified_time": ..., "worksheets": [{"id": ..., "title": ..., "row_count": ..., "col_count": ..., "values": [...]}]}
+# sheets.get_gspread_client returns a FakeClient instead of a real one when HISTCORD_FAKE_SHEETS_DIR is set.
+# like sheets.py, gspread (for its exceptions and range helpers) is only imported by the methods that need it.
+
+FAKE_SHEETS_DIR_ENV_VAR = "HISTCORD_FAKE_SHEETS_DIR"
+DEFAULT_CLEARS_SHEET_ID = "clears"
+DEFAULT_STATE_SHEET_ID = "state"
+
+# one lock for every fake spreadsheet, since the pipeline reads the state and main sheets from different threads
+_lock = threading.RLock()
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+# splits "'Page name'!A1:B2" into ("Page name", "A1:B2"). ranges without a page name are on the first page.
+def split_range(range_name):
+    if "!" not in range_name:
+        return None, range_name
+    title, a1 = range_name.rsplit("!", 1)
+    if title.startswith("'") and title.endswith("'"):
+        title = title[1:-1].replace("''", "'")
+    return title, a1
+
+
+class FakeClient:
+    def __init__(self, sheets_dir):
+        self.sheets_dir = sheets_dir
+        self.http_client = FakeHTTPClient(self)
+
+    def path(self, spreadsheet_id):
+        return os.path.join(self.sheets_dir, f"{spreadsheet_id}.json")
+
+    def load(self, spreadsheet_id):
+        timing.count("google_api_calls")
+        try:
+            with open(self.path(spreadsheet_id), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            import gspread
+            raise gspread.exceptions.SpreadsheetNotFound(f"No fake spreadsheet {self.path(spreadsheet_id)}")
+
+    def save(self, spreadsheet_id, data):
+        data["modified_time"] = now_iso()
+        os.makedirs(self.sheets_dir, exist_ok=True)
+        tmp_path = f"{self.path(spreadsheet_id)}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path(spreadsheet_id))
+
+    def open_by_key(self, spreadsheet_id):
+        with _lock:
+            return FakeSpreadsheet(self, spreadsheet_id, self.load(spreadsheet_id))
+
+    def get_file_drive_metadata(self, spreadsheet_id):
+        with _lock:
+            return {"id": spreadsheet_id, "modifiedTime": self.load(spreadsheet_id)["modified_time"]}
+
+
+# the lower level calls that sheets.py makes through gc.http_client
+class FakeHTTPClient:
+    def __init__(self, client):
+        self.client = client
+
+    def values_batch_get(self, spreadsheet_id, ranges, params=None):
+        with _lock:
+            return FakeSpreadsheet(self.client, spreadsheet_id, self.client.load(spreadsheet_id)).get_value_ranges(
+                ranges)
+
+    def fetch_sheet_metadata(self, spreadsheet_id, params=None):
+        with _lock:
+            data = self.client.load(spreadsheet_id)
+            return {"spreadsheetId": spreadsheet_id, "sheets": [{"properties": {
+                "sheetId": worksheet["id"],
+                "title": worksheet["title"],
+                "gridProperties": {"rowCount": worksheet["row_count"], "columnCount": worksheet["col_count"]},
+            }} for worksheet in data["worksheets"]]}
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, spreadsheet_id, data):
+        self.client = client
+        self.id = spreadsheet_id
+        self.data = data
+
+    def save(self):
+        self.client.save(self.id, self.data)
+
+    @property
+    def sheet1(self):
+        return FakeWorksheet(self, self.data["worksheets"][0])
+
+    def worksheets(self):
+        return [FakeWorksheet(self, worksheet) for worksheet in self.data["worksheets"]]
+
+    def worksheet(self, title):
+        for worksheet in self.data["worksheets"]:
+            if worksheet["title"] == title:
+                return FakeWorksheet(self, worksheet)
+        import gspread
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def get_worksheet_by_id(self, worksheet_id):
+        for worksheet in self.data["worksheets"]:
+            if worksheet["id"] == worksheet_id:
+                return FakeWorksheet(self, worksheet)
+        import gspread
+        raise gspread.exceptions.WorksheetNotFound(worksheet_id)
+
+    # splits a range into its worksheet and a1 range, where a range that's only a page name is the whole page
+    def resolve_range(self, range_name):
+        title, a1 = split_range(range_name)
+        if title is None:
+            unquoted = a1[1:-1].replace("''", "'") if a1.startswith("'") and a1.endswith("'") else a1
+            if any(worksheet["title"] == unquoted for worksheet in self.data["worksheets"]):
+                return self.worksheet(unquoted), None
+            return self.sheet1, a1
+        return self.worksheet(title), a1
+
+    def get_value_ranges(self, ranges):
+        value_ranges = []
+        for range_name in ranges:
+            worksheet, a1 = self.resolve_range(range_name)
+            values = worksheet.get_values_in_range(a1) if a1 is not None else trim_values(worksheet.data["values"])
+            value_range = {"range": range_name, "majorDimension": "ROWS"}
+            if values:
+                value_range["values"] = values
+            value_ranges.append(value_range)
+        return {"spreadsheetId": self.id, "valueRanges": value_ranges}
+
+    def values_batch_get(self, ranges, params=None):
+        timing.count("google_api_calls")
+        with _lock:
+            return self.get_value_ranges(ranges)
+
+    def values_batch_update(self, body):
+        timing.count("google_api_calls")
+        with _lock:
+            for value_range in body["data"]:
+                worksheet, a1 = self.resolve_range(value_range["range"])
+                worksheet.write_values(a1 or "A1", value_range["values"])
+            self.save()
+        return {"spreadsheetId": self.id, "totalUpdatedCells": sum(
+            len(row) for value_range in body["data"] for row in value_range["values"])}
+
+    # only the structural requests that sheets.py sends
+    def batch_update(self, body):
+        timing.count("google_api_calls")
+        replies = []
+        with _lock:
+            for request in body["requests"]:
+                reply = {}
+                if "addSheet" in request:
+                    properties = request["addSheet"]["properties"]
+                    grid_properties = properties.get("gridProperties", {})
+                    worksheet = make_worksheet(max(worksheet["id"] for worksheet in self.data["worksheets"]) + 1,
+                                               properties["title"], [])
+                    worksheet["row_count"] = grid_properties.get("rowCount", 1000)
+                    worksheet["col_count"] = grid_properties.get("columnCount", 26)
+                    self.data["worksheets"].append(worksheet)
+                    reply = {"addSheet": {"properties": {
+                        "sheetId": worksheet["id"],
+                        "title": worksheet["title"],
+                        "gridProperties": {"rowCount": worksheet["row_count"], "columnCount": worksheet["col_count"]},
+                    }}}
+                elif "deleteDimension" in request:
+                    grid_range = request["deleteDimension"]["range"]
+                    worksheet = self.get_worksheet_by_id(grid_range["sheetId"])
+                    worksheet.delete_dimension(grid_range["dimension"], grid_range["startIndex"],
+                                               grid_range["endIndex"])
+                elif "appendDimension" in request:
+                    append = request["appendDimension"]
+                    worksheet = self.get_worksheet_by_id(append["sheetId"])
+                    worksheet.append_dimension(append["dimension"], append["length"])
+                else:
+                    raise NotImplementedError(f"Fake sheets don't support {list(request)}")
+                replies.append(reply)
+            self.save()
+        return {"spreadsheetId": self.id, "replies": replies}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, data):
+        self.spreadsheet = spreadsheet
+        self.data = data
+
+    @property
+    def id(self):
+        return self.data["id"]
+
+    @property
+    def title(self):
+        return self.data["title"]
+
+    @property
+    def row_count(self):
+        return self.data["row_count"]
+
+    @property
+    def col_count(self):
+        return self.data["col_count"]
+
+    # like gspread: every row up to the last non-empty one, padded to the same width
+    def get_all_values(self):
+        timing.count("google_api_calls")
+        values = trim_values(self.data["values"])
+        width = max((len(row) for row in values), default=0)
+        return [row + [""] * (width - len(row)) for row in values]
+
+    # like the values api: trailing empty cells and rows are left out
+    def get_values_in_range(self, a1):
+        import gspread
+        grid_range = gspread.utils.a1_range_to_grid_range(a1)
+        start_row = grid_range.get("startRowIndex", 0)
+        end_row = grid_range.get("endRowIndex", self.row_count)
+        start_col = grid_range.get("startColumnIndex", 0)
+        end_col = grid_range.get("endColumnIndex", self.col_count)
+        if end_row > self.row_count or end_col > self.col_count:
+            raise gspread.exceptions.GSpreadException(f"Range ('{self.title}'!{a1}) exceeds grid limits.")
+        return trim_values([row[start_col:end_col] for row in self.data["values"][start_row:end_row]])
+
+    def set_cell(self, row_i, col_i, value):
+        values = self.data["values"]
+        while len(values) <= row_i:
+            values.append([])
+        row = values[row_i]
+        if len(row) <= col_i:
+            row.extend([""] * (col_i + 1 - len(row)))
+        row[col_i] = value
+        # writing past the end of the grid grows it, like the values api does
+        self.data["row_count"] = max(self.row_count, row_i + 1)
+        self.data["col_count"] = max(self.col_count, col_i + 1)
+
+    def write_values(self, a1, values):
+        import gspread
+        grid_range = gspread.utils.a1_range_to_grid_range(a1)
+        start_row = grid_range.get("startRowIndex", 0)
+        start_col = grid_range.get("startColumnIndex", 0)
+        for row_i, row in enumerate(values):
+            for col_i, value in enumerate(row):
+                self.set_cell(start_row + row_i, start_col + col_i, "" if value is None else str(value))
+
+    def update(self, range_name, values, value_input_option=None):
+        timing.count("google_api_calls")
+        with _lock:
+            self.write_values(split_range(range_name)[1], values)
+            self.spreadsheet.save()
+
+    def batch_update(self, data, value_input_option=None):
+        timing.count("google_api_calls")
+        with _lock:
+            for value_range in data:
+                self.write_values(split_range(value_range["range"])[1], value_range["values"])
+            self.spreadsheet.save()
+
+    def batch_clear(self, ranges):
+        import gspread
+        timing.count("google_api_calls")
+        with _lock:
+            for range_name in ranges:
+                grid_range = gspread.utils.a1_range_to_grid_range(split_range(range_name)[1])
+                start_row = grid_range.get("startRowIndex", 0)
+                end_row = grid_range.get("endRowIndex", self.row_count)
+                start_col = grid_range.get("startColumnIndex", 0)
+                end_col = grid_range.get("endColumnIndex", self.col_count)
+                for row in self.data["values"][start_row:end_row]:
+                    for col_i in range(start_col, min(end_col, len(row))):
+                        row[col_i] = ""
+            self.spreadsheet.save()
+
+    def delete_dimension(self, dimension, start_index, end_index):
+        if dimension == "ROWS":
+            del self.data["values"][start_index:end_index]
+            self.data["row_count"] -= end_index - start_index
+        else:
+            for row in self.data["values"]:
+                del row[start_index:end_index]
+            self.data["col_count"] -= end_index - start_index
+
+    def append_dimension(self, dimension, length):
+        if dimension == "ROWS":
+            self.data["row_count"] += length
+        else:
+            self.data["col_count"] += length
+
+
+def trim_values(values):
+    trimmed = []
+    for row in values:
+        end = len(row)
+        while end and row[end - 1] == "":
+            end -= 1
+        trimmed.append(row[:end])
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return trimmed
+
+
+def make_worksheet(worksheet_id, title, values):
+    return {
+        "id": worksheet_id,
+        "title": title,
+        "row_count": max(len(values), 1),
+        "col_count": max((len(row) for row in values), default=1),
+        "values": [list(row) for row in values],
+    }
+
+
+# lays cld star groups (see sheets.load_cld_from_main_sheet) back out the way the cld page has them
+def cld_to_page(cld):
+    width = CLD_COLS_PER_STAR * MAX_STAR_DIFFICULTY
+    num_rows = max((len(star_group) for star_group in cld), default=0)
+    page = [[""] * width for _ in range(CLD_FIRST_TIER_ROW_INDEX + num_rows)]
+    for star_i, star_group in enumerate(cld):
+        for row_i, cells in enumerate(star_group):
+            first_col = CLD_COLS_PER_STAR * star_i + CLD_MAP_NAME_OFFSET
+            page[CLD_FIRST_TIER_ROW_INDEX + row_i][first_col:first_col + len(cells)] = cells
+    return page
+
+
+def write_main_sheet(client, spreadsheet_id, clears_page, cld_page):
+    client.save(spreadsheet_id, {"worksheets": [
+        make_worksheet(0, CLEARS_PAGE_NAME, clears_page),
+        make_worksheet(1, CLD_PAGE_NAME, cld_page),
+    ]})
+
+
+def write_state_sheet(client, spreadsheet_id, state_grid):
+    client.save(spreadsheet_id, {"worksheets": [make_worksheet(0, "Sheet1", state_grid)]})
+
+
+def print_env(args):
+    print("Use the fake sheets with:")
+    print(f"  {FAKE_SHEETS_DIR_ENV_VAR}={os.path.abspath(args.sheets_dir)}")
+    print(f"  CLEARS_SHEET_ID={args.clears_sheet_id}")
+    print(f"  STATE_SHEET_ID={args.state_sheet_id}")
+
+
+# noinspection PyShadowingNames
+def generate(args):
+    client = FakeClient(args.sheets_dir)
+    clears_page = synthetic.make_clears_page(args.players, args.maps, args.fill, args.fc_pairs, args.seed)
+    write_main_sheet(client, args.clears_sheet_id, clears_page, cld_to_page(synthetic.make_cld(clears_page)))
+    if args.with_state:
+        import clears
+        current_state, _ = clears.get_current_state_and_maps_from_sheet_values(clears_page)
+        write_state_sheet(client, args.state_sheet_id, clears.save_state_as_grid(current_state))
+    else:
+        write_state_sheet(client, args.state_sheet_id, [])
+    print(f"Generated a {args.players} x {args.maps} list in {args.sheets_dir}.")
+    print_env(args)
+
+
+# noinspection PyShadowingNames
+def edit(args):
+    client = FakeClient(args.sheets_dir)
+    with _lock:
+        spreadsheet = client.open_by_key(args.clears_sheet_id)
+        clears_page = spreadsheet.worksheet(CLEARS_PAGE_NAME).get_all_values()
+        edited_page = synthetic.edit_clears_page(clears_page, args.edits, args.renames, args.seed)
+        write_main_sheet(client, args.clears_sheet_id, edited_page,
+                         cld_to_page(synthetic.make_cld(edited_page, seed=args.seed)))
+    print(f"Edited the clears page in {args.sheets_dir}.")
+
+
+# copies the clears and cld pages of a real spreadsheet (e.g. the fake clears sheet the test notebooks use) into a
+# local fake one, so runs against it can be replayed offline
+# noinspection PyShadowingNames
+def snapshot(args):
+    from dotenv import load_dotenv
+    load_dotenv()
+    # make sure we get a real client
+    os.environ.pop(FAKE_SHEETS_DIR_ENV_VAR, None)
+    import sheets
+
+    source_sheet_id = args.source_sheet_id or os.environ.get('CLEARS_SHEET_ID')
+    if not source_sheet_id:
+        print("ERROR: No source sheet given and CLEARS_SHEET_ID isn't set.")
+        sys.exit(1)
+    source_sheet = sheets.get_gspread_client().open_by_key(source_sheet_id)
+    write_main_sheet(FakeClient(args.sheets_dir), args.clears_sheet_id,
+                     source_sheet.worksheet(CLEARS_PAGE_NAME).get_all_values(),
+                     source_sheet.worksheet(CLD_PAGE_NAME).get_all_values())
+    if not os.path.exists(FakeClient(args.sheets_dir).path(args.state_sheet_id)):
+        write_state_sheet(FakeClient(args.sheets_dir), args.state_sheet_id, [])
+    print(f"Copied {source_sheet_id} to {args.sheets_dir}.")
+    print_env(args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage local fake spreadsheets for offline runs")
+    parser.add_argument("sheets_dir", help="Directory with the fake spreadsheets")
+    parser.add_argument("--clears-sheet-id", default=DEFAULT_CLEARS_SHEET_ID,
+                        help=f"Id of the fake main sheet (default: {DEFAULT_CLEARS_SHEET_ID})")
+    parser.add_argument("--state-sheet-id", default=DEFAULT_STATE_SHEET_ID,
+                        help=f"Id of the fake state sheet (default: {DEFAULT_STATE_SHEET_ID})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Generate a synthetic list (see synthetic.py)")
+    generate_parser.add_argument("--players", type=int, default=500)
+    generate_parser.add_argument("--maps", type=int, default=1000)
+    generate_parser.add_argument("--fill", type=float, default=0.05)
+    generate_parser.add_argument("--fc-pairs", type=float, default=0.3)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.add_argument("--with-state", action="store_true",
+                                 help="Also save the list to the state sheet, so the next run only sees later edits")
+    generate_parser.set_defaults(func=generate)
+
+    edit_parser = subparsers.add_parser("edit", help="Randomly edit the clears page, like list helpers would")
+    edit_parser.add_argument("--edits", type=float, default=0.01)
+    edit_parser.add_argument("--renames", type=float, default=0.005)
+    edit_parser.add_argument("--seed", type=int, default=1)
+    edit_parser.set_defaults(func=edit)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Copy a real spreadsheet's pages (needs credentials)")
+    snapshot_parser.add_argument("--source-sheet-id", help="Real spreadsheet to copy (default: CLEARS_SHEET_ID)")
+    snapshot_parser.set_defaults(func=snapshot)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,112 @@
+import hashlib
+
+import clears
+import helpers
+import lists
+from maps import MapCatalog
+from state import ClearState
+
+# fingerprints of the clears page rows that the saved state was parsed from, so the next run only has to parse and
+# diff the rows that changed since. they're saved in the state sheet's metadata (see state_metadata.py) as:
+#   ["fingerprint", "header", <hash of the player names row>]
+#   ["fingerprint", "cells", <number of cells in the state>]
+#   ["row", <map name>, <hash of the map row>]
+# as a dict: {"header": ..., "cells": ..., "rows": {map name: hash}}
+FINGERPRINT_SECTION = "fingerprint"
+ROW_SECTION = "row"
+FINGERPRINT_SECTIONS = {FINGERPRINT_SECTION, ROW_SECTION}
+
+# a map name that can't show up in the clears page, for the cells that keep players with clears in unchanged rows
+# around in both partial states
+UNCHANGED_ROWS_MAP_NAME = "\0unchanged rows"
+
+
+# prefixed so sheets never reads it as a number
+def row_fingerprint(row):
+    return "h" + hashlib.blake2b("\x1f".join(row).encode(), digest_size=8).hexdigest()
+
+
+def get_fingerprints(player_names_row, map_rows, num_cells):
+    return {
+        "header": row_fingerprint(player_names_row),
+        "cells": str(num_cells),
+        "rows": {map_name: row_fingerprint(row) for map_name, _, row in clears.iter_map_rows(map_rows)},
+    }
+
+
+# returns None if the metadata has no (complete) fingerprints
+def fingerprints_from_metadata(metadata):
+    if metadata is None:
+        return None
+    header = metadata.get(FINGERPRINT_SECTION, "header")
+    num_cells = metadata.get(FINGERPRINT_SECTION, "cells")
+    if not header or not num_cells:
+        return None
+    return {"header": header, "cells": num_cells, "rows": metadata.section(ROW_SECTION)}
+
+
+# {(section, key): value} for StateMetadata.get_updates
+def fingerprints_to_metadata_values(fingerprints):
+    values = {
+        (FINGERPRINT_SECTION, "header"): fingerprints["header"],
+        (FINGERPRINT_SECTION, "cells"): fingerprints["cells"],
+    }
+    values.update(((ROW_SECTION, map_name), fingerprint) for map_name, fingerprint in fingerprints["rows"].items())
+    return values
+
+
+# parses only the rows of the clears page whose fingerprint changed since previous_state was saved. returns None if
+# that can't be done safely (no fingerprints, the player names row changed, duplicate map names or the fingerprints
+# don't belong to previous_state), in which case the caller should parse the whole page. otherwise returns
+# (current_state, map_catalog, changed_previous_state, changed_current_state, new_fingerprints), where the changed
+# states only have the rows of changed, added and removed maps. diffing the changed states gives the same diffs as
+# diffing the whole states. previous_map_catalog is passed on to the map catalog (see maps.MapCatalog).
+def parse_changed_rows(previous_state, fingerprints, player_names_row, map_rows, previous_map_catalog=None):
+    if fingerprints is None or fingerprints["header"] != row_fingerprint(player_names_row) or \
+            fingerprints["cells"] != str(len(previous_state)):
+        return None
+
+    old_row_fingerprints = fingerprints["rows"]
+    first_player_i = lists.current().min_player_col_index
+    row_fingerprints = {}
+    map_catalog = MapCatalog(previous_map_catalog)
+    unchanged_map_names = set()
+    changed_current_state = ClearState()
+
+    for map_name, map_star_difficulty, row in clears.iter_map_rows(map_rows):
+        if map_name in map_catalog:
+            # the full parse lets the last row win, but we can't tell which row the fingerprint was for
+            return None
+        map_catalog.add(map_name, map_star_difficulty)
+
+        fingerprint = row_fingerprint(row)
+        row_fingerprints[map_name] = fingerprint
+        if old_row_fingerprints.get(map_name) == fingerprint:
+            unchanged_map_names.add(map_name)
+        else:
+            helpers.parse_data_row(row, first_player_i, changed_current_state, player_names_row)
+
+    # the old rows of every map that changed, was added, was removed or was renamed
+    changed_previous_state = ClearState()
+    changed_map_names = [map_name for map_name in previous_state.map_names() if map_name not in unchanged_map_names]
+    for map_name in changed_map_names:
+        for player_name, value in previous_state.row_items(map_name):
+            changed_previous_state[player_name, map_name] = value
+
+    # a player with clears in unchanged rows exists before and after no matter what happened to their changed rows, so
+    # put them in both changed states with the same placeholder cell. otherwise losing every clear in the changed rows
+    # would look like the player was removed.
+    for player_name in changed_previous_state.player_names() + changed_current_state.player_names():
+        if previous_state.player_cell_count(player_name) > changed_previous_state.player_cell_count(player_name):
+            changed_previous_state[player_name, UNCHANGED_ROWS_MAP_NAME] = ""
+            changed_current_state[player_name, UNCHANGED_ROWS_MAP_NAME] = ""
+
+    current_state = previous_state.copy()
+    for map_name in changed_map_names:
+        current_state.clear_row(map_name)
+    for key, value in changed_current_state.items():
+        if key[1] != UNCHANGED_ROWS_MAP_NAME:
+            current_state[key] = value
+
+    new_fingerprints = {"header": fingerprints["header"], "cells": str(len(current_state)), "rows": row_fingerprints}
+    return current_state, map_catalog, changed_previous_state, changed_current_state, new_fingerprints
@@ -1,9 +1,25 @@
-import functools
+import hashlib
 import itertools
+import time
 
+import clear_types
 import helpers
+import lists
+import local_cache
 import sheets
-from constants import MAX_STAR_DIFFICULTY, CLD_COLS_PER_STAR, CLD_MAP_NAME_OFFSET, CLD_INFO_END_OFFSET
+from constants import DiffType, ClearType
+
+GOLDEN_CLEAR_TYPES = {ClearType.GOLDEN, ClearType.GOLDEN_AND_FC, ClearType.GOLDEN_FC}
+
+GOLDEN_TIERS_CACHE_FILE_NAME = "golden_tiers.json"
+# how long to trust the cached golden tiers before checking whether the main sheet changed since they were built
+GOLDEN_TIERS_CACHE_TTL = 24 * 60 * 60
+
+# list name -> trimmed map name -> [c tier, fc tier]. loaded lazily, since most runs don't have any goldens to announce.
+_golden_tiers = {}
+# names of the lists whose golden tiers were built from a cld page downloaded during this run, so there's no point in
+# refreshing them
+_lists_with_current_golden_tiers = set()
 
 
 def str_to_tier(s):
@@ -28,29 +44,135 @@ def populate_golden_tier(golden_tiers, trimmed_map_name, index, new_tier_str):
                 tier_list[index] = new_tier_str
 
 
-@functools.cache
-def get_golden_tiers():
-    cld = sheets.load_cld_from_main_sheet()
+# returns the golden tiers from memory, then from the on-disk cache, and only downloads the cld page if the cache is
+# missing or stale. if map_name is given and the tiers don't have it (e.g. a map that was added to cld after the cache
+# was built), they're refreshed once.
+def get_golden_tiers(map_name=None):
+    list_name = lists.current().name
+    if list_name not in _golden_tiers:
+        cache = local_cache.load_json(GOLDEN_TIERS_CACHE_FILE_NAME)
+        if cache is not None and is_golden_tiers_cache_fresh(cache):
+            _golden_tiers[list_name] = cache["golden_tiers"]
+        else:
+            refresh_golden_tiers(cache)
+
+    if (map_name is not None and map_name not in _golden_tiers[list_name] and
+            list_name not in _lists_with_current_golden_tiers):
+        refresh_golden_tiers(local_cache.load_json(GOLDEN_TIERS_CACHE_FILE_NAME))
+
+    return _golden_tiers[list_name]
+
+
+# use an already downloaded cld page (e.g. one fetched alongside the clears page) instead of downloading it again
+def prime_golden_tiers(cld, modified_time=None):
+    build_golden_tiers(cld, modified_time, local_cache.load_json(GOLDEN_TIERS_CACHE_FILE_NAME))
+
+
+# forget the golden tiers of every list so the next get_golden_tiers call reloads them (e.g. between checks in watch
+# mode)
+def clear_golden_tiers():
+    _golden_tiers.clear()
+    _lists_with_current_golden_tiers.clear()
+
+
+# whether the on-disk cache can be used without even checking the main sheet's modified time
+def golden_tiers_cache_is_within_ttl():
+    cache = local_cache.load_json(GOLDEN_TIERS_CACHE_FILE_NAME)
+    return cache is not None and time.time() - cache["checked_at"] < GOLDEN_TIERS_CACHE_TTL
+
+
+# the cache is fresh if it's within its ttl, or if the main sheet hasn't been modified since it was built (in which
+# case it's good for another ttl)
+def is_golden_tiers_cache_fresh(cache):
+    if time.time() - cache["checked_at"] < GOLDEN_TIERS_CACHE_TTL:
+        return True
+
+    modified_time = sheets.get_main_sheet_modified_time()
+    if modified_time is not None and modified_time == cache["modified_time"]:
+        cache["checked_at"] = time.time()
+        local_cache.save_json(GOLDEN_TIERS_CACHE_FILE_NAME, cache)
+        return True
+
+    return False
 
-    golden_tiers = {}
 
-    # prevent a copy
-    cld_rows = itertools.islice(cld, 9, None)
+def refresh_golden_tiers(cache):
+    # get the modified time before downloading, so an edit made during the download makes the next check refresh again
+    modified_time = sheets.get_main_sheet_modified_time()
+    build_golden_tiers(sheets.load_cld_from_main_sheet(), modified_time, cache)
 
-    for cld_row in cld_rows:
-        for i in range(MAX_STAR_DIFFICULTY):
-            map_name, c_tier, fc_tier = cld_row[CLD_COLS_PER_STAR * i + CLD_MAP_NAME_OFFSET:
-                                                CLD_COLS_PER_STAR * i + CLD_INFO_END_OFFSET]
-            trimmed_map_name, clear_type = helpers.trim_map_name(map_name)
-            if clear_type == "[FC]":
-                c_tier, fc_tier = "", c_tier
-            elif not fc_tier or fc_tier == "<<<":
-                fc_tier = c_tier
 
+# parses the cld page into golden tiers and saves them to the on-disk cache
+def build_golden_tiers(cld, modified_time, cache):
+    list_name = lists.current().name
+
+    old_row_tiers = cache["row_tiers"] if cache is not None else {}
+    golden_tiers, row_tiers = parse_golden_tiers_reusing_rows(cld, old_row_tiers)
+    _golden_tiers[list_name] = golden_tiers
+    _lists_with_current_golden_tiers.add(list_name)
+
+    try:
+        local_cache.save_json(GOLDEN_TIERS_CACHE_FILE_NAME, {
+            "modified_time": modified_time,
+            "checked_at": time.time(),
+            "row_tiers": row_tiers,
+            "golden_tiers": golden_tiers,
+        })
+    except OSError as e:
+        print(f"WARNING: Could not save the golden tiers cache: {e}")
+
+
+# cld is a list of star groups, each a list of [map name, c tier, fc tier] rows (see sheets.load_cld_from_main_sheet)
+def parse_golden_tiers(cld):
+    golden_tiers, _ = parse_golden_tiers_reusing_rows(cld, {})
+    return golden_tiers
+
+
+# old_row_tiers maps row hashes to parse_golden_tier_row results from an earlier parse, so rows that haven't changed
+# since then aren't parsed again. returns the golden tiers and the row tiers for this parse.
+def parse_golden_tiers_reusing_rows(cld, old_row_tiers):
+    golden_tiers = {}
+    row_tiers = {}
+
+    # put the star groups back together into rows, since the groups can have different lengths
+    for cld_row in itertools.zip_longest(*cld, fillvalue=("", "", "")):
+        row_hash = hashlib.blake2b("\x1f".join(itertools.chain.from_iterable(cld_row)).encode(),
+                                   digest_size=16).hexdigest()
+        tiers = row_tiers.get(row_hash) or old_row_tiers.get(row_hash)
+        if tiers is None:
+            tiers = parse_golden_tier_row(cld_row)
+        row_tiers[row_hash] = tiers
+
+        for trimmed_map_name, c_tier, fc_tier in tiers:
             if trimmed_map_name not in golden_tiers:
                 golden_tiers[trimmed_map_name] = [None, None]
 
             populate_golden_tier(golden_tiers, trimmed_map_name, 0, c_tier)
             populate_golden_tier(golden_tiers, trimmed_map_name, 1, fc_tier)
 
-    return golden_tiers
+    return golden_tiers, row_tiers
+
+
+# returns a list of [trimmed map name, c tier, fc tier] for every star group in one cld row
+def parse_golden_tier_row(cld_row):
+    tiers = []
+    for map_name, c_tier, fc_tier in cld_row:
+        trimmed_map_name, clear_type = helpers.trim_map_name(map_name)
+        if clear_type == "[FC]":
+            c_tier, fc_tier = "", c_tier
+        elif not fc_tier or fc_tier == "<<<":
+            fc_tier = c_tier
+        tiers.append([trimmed_map_name, c_tier, fc_tier])
+    return tiers
+
+
+# whether any diff adds or changes a clear to a golden, i.e. whether announcing it needs the golden tiers
+def diff_list_has_golden_clears(diff_list):
+    for diff_type, *values in diff_list:
+        if diff_type not in {DiffType.ADDED_CLEAR, DiffType.CHANGED_CLEAR}:
+            continue
+        # the new cell value is always second to last, and the map clear type is always third
+        map_clear_type, cell_value = values[2], values[-2]
+        if clear_types.cell_value_to_clear_type(cell_value, map_clear_type) in GOLDEN_CLEAR_TYPES:
+            return True
+    return False
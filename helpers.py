@@ -22,3 +22,12 @@ def parse_data_row(data_row, start_index, state, player_names):
         if player_index < len(player_names) and value:
             unique_key = (player_names[player_index], map_name)
             state[unique_key] = value
+
+
+# the streaming version of parse_data_row: yields (player_name, map_name, value) for every cell it would store
+def iter_data_row(data_row, start_index, player_names):
+    map_name = data_row[0]
+    for player_index, value in enumerate(itertools.islice(data_row, start_index, None), start=start_index):
+        value = value.strip()
+        if player_index < len(player_names) and value:
+            yield player_names[player_index], map_name, value
@@ -0,0 +1,181 @@
+import contextlib
+import contextvars
+import json
+import os
+import re
+import sys
+import threading
+import tomllib
+
+import constants
+
+# the settings of every monitored list. without a config file (see load_list_configs), there's one list that takes its
+# sheets and webhooks from the environment like before. with one, main checks every list in it at the same time, each
+# in its own thread, and the code that works on a list asks current() which one it's working on.
+
+DEFAULT_LIST_NAME = "default"
+# where the caches of lists from a config file go, inside local_cache.CACHE_DIR
+LISTS_CACHE_DIR_NAME = "lists"
+
+_current_list = contextvars.ContextVar("current_list", default=None)
+
+
+class ListConfig:
+    def __init__(self, name, clears_sheet_id=None, state_sheet_id=None, primary_webhook_url=None,
+                 secondary_webhook_url=None, clears_page_name=constants.CLEARS_PAGE_NAME,
+                 cld_page_name=constants.CLD_PAGE_NAME, min_player_col_index=constants.MIN_PLAYER_COL_INDEX,
+                 first_real_map_row_index=constants.FIRST_REAL_MAP_ROW_INDEX,
+                 max_star_difficulty=constants.MAX_STAR_DIFFICULTY, cld_cols_per_star=constants.CLD_COLS_PER_STAR,
+                 cld_map_name_offset=constants.CLD_MAP_NAME_OFFSET, cld_info_end_offset=constants.CLD_INFO_END_OFFSET,
+                 cld_first_tier_row_index=constants.CLD_FIRST_TIER_ROW_INDEX,
+                 map_prefixes_to_ignore=tuple(constants.MAP_PREFIXES_TO_IGNORE), cache_subdir=None):
+        self.name = name
+        self.clears_sheet_id = clears_sheet_id
+        self.state_sheet_id = state_sheet_id
+        self.primary_webhook_url = primary_webhook_url
+        self.secondary_webhook_url = secondary_webhook_url
+        self.clears_page_name = clears_page_name
+        self.cld_page_name = cld_page_name
+        self.min_player_col_index = min_player_col_index
+        self.first_real_map_row_index = first_real_map_row_index
+        self.max_star_difficulty = max_star_difficulty
+        # the first real maps are the hardest ones
+        self.first_real_map_star_difficulty = max_star_difficulty
+        self.cld_cols_per_star = cld_cols_per_star
+        self.cld_map_name_offset = cld_map_name_offset
+        self.cld_info_end_offset = cld_info_end_offset
+        self.cld_first_tier_row_index = cld_first_tier_row_index
+        self.map_prefixes_to_ignore = tuple(map_prefixes_to_ignore)
+        # relative to local_cache.CACHE_DIR, so every list has its own outbox, golden tiers and last run
+        if cache_subdir is None:
+            cache_subdir = os.path.join(LISTS_CACHE_DIR_NAME, re.sub(r"[^A-Za-z0-9_.-]+", "_", name))
+        self.cache_subdir = cache_subdir
+
+    def __repr__(self):
+        return f"ListConfig({self.name!r})"
+
+
+# the single list of a run without a config file, which keeps its caches where they always were
+def get_default_list_config():
+    return ListConfig(
+        DEFAULT_LIST_NAME,
+        clears_sheet_id=os.environ.get('CLEARS_SHEET_ID'),
+        state_sheet_id=os.environ.get('STATE_SHEET_ID'),
+        primary_webhook_url=os.environ.get('PRIMARY_DISCORD_WEBHOOK_URL'),
+        secondary_webhook_url=os.environ.get('SECONDARY_DISCORD_WEBHOOK_URL'),
+        cache_subdir="",
+    )
+
+
+# the list the current thread is working on
+def current():
+    list_config = _current_list.get()
+    return list_config if list_config is not None else get_default_list_config()
+
+
+# makes list_config the current list inside the with block
+@contextlib.contextmanager
+def use(list_config):
+    token = _current_list.set(list_config)
+    try:
+        yield list_config
+    finally:
+        _current_list.reset(token)
+
+
+# runs func on executor in a copy of the current context, so it works on the same list and counts to the same timing
+# spans as the code that submitted it. every call needs its own copy, since a context can't be entered twice at once.
+def submit_in_context(executor, func, *args):
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+# reads a json or toml file (picked by extension) like:
+#   {"lists": [{"name": "histcord", "clears_sheet_id": "$CLEARS_SHEET_ID", "state_sheet_id": "...", ...}]}
+# where every list needs a unique name, the sheet ids and webhook urls, and can override any other ListConfig setting.
+# values that start with $ are read from that environment variable, so secrets can stay out of the file.
+def load_list_configs(path):
+    try:
+        if path.endswith(".toml"):
+            with open(path, "rb") as f:
+                config = tomllib.load(f)
+        else:
+            with open(path, encoding="utf-8") as f:
+                config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Could not read list config {path}: {e}")
+        sys.exit(1)
+
+    list_settings = config.get("lists") if isinstance(config, dict) else None
+    if not list_settings or not isinstance(list_settings, list):
+        print(f"ERROR: List config {path} has no lists.")
+        sys.exit(1)
+
+    list_configs = []
+    for i, settings in enumerate(list_settings):
+        if not isinstance(settings, dict) or not settings.get("name"):
+            print(f"ERROR: List {i + 1} in {path} has no name.")
+            sys.exit(1)
+        settings = {key: resolve_setting(value) for key, value in settings.items()}
+        try:
+            list_config = ListConfig(**settings)
+        except TypeError as e:
+            print(f"ERROR: Bad settings for list {settings['name']} in {path}: {e}")
+            sys.exit(1)
+
+        for setting in ("clears_sheet_id", "state_sheet_id", "primary_webhook_url", "secondary_webhook_url"):
+            if not getattr(list_config, setting):
+                print(f"ERROR: List {list_config.name} in {path} has no {setting}.")
+                sys.exit(1)
+        list_configs.append(list_config)
+
+    names = [list_config.name for list_config in list_configs]
+    if len(set(names)) != len(names):
+        print(f"ERROR: List names in {path} aren't unique.")
+        sys.exit(1)
+    cache_subdirs = [list_config.cache_subdir for list_config in list_configs]
+    if len(set(cache_subdirs)) != len(cache_subdirs):
+        print(f"ERROR: List names in {path} are too similar to give every list its own cache.")
+        sys.exit(1)
+
+    return list_configs
+
+
+def resolve_setting(value):
+    if isinstance(value, str) and value.startswith("$"):
+        env_value = os.environ.get(value[1:])
+        if env_value is None:
+            print(f"WARNING: Environment variable {value[1:]} isn't set.")
+        return env_value
+    return value
+
+
+# a stand-in for sys.stdout while several lists are checked at once. every line gets the name of the list it's about,
+# and a line that's printed in parts (like a Timer's "Loading... " and "Done") is held back until it's complete, so the
+# lists' lines don't run into each other.
+class ListOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+        # thread id -> the start of a line it hasn't finished yet
+        self._partial_lines = {}
+
+    def write(self, text):
+        list_config = _current_list.get()
+        if list_config is None:
+            return self.stream.write(text)
+
+        thread_id = threading.get_ident()
+        with self._lock:
+            *lines, partial_line = (self._partial_lines.pop(thread_id, "") + text).split("\n")
+            if partial_line:
+                self._partial_lines[thread_id] = partial_line
+            for line in lines:
+                self.stream.write(f"[{list_config.name}] {line}\n")
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import clears
+import discord
+import fake_discord
+import fake_sheets
+import local_cache
+import main
+import synthetic
+import timing
+
+# runs the whole pipeline (main.main) on one machine with no network: a synthetic list is saved to the fake state
+# sheet, an edited copy of it goes in the fake main sheet, and the messages go to a fake discord server. reports how
+# long every stage took, how fast messages got through the rate limits, and how long after the start of the run they
+# arrived.
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+# noinspection PyShadowingNames
+def run_load_test(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="histcord_load_test_")
+    sheets_dir = os.path.join(work_dir, "sheets")
+    metrics_dir = os.path.join(work_dir, "metrics")
+    local_cache.CACHE_DIR = os.path.join(work_dir, "cache")
+
+    with timing.Timer(f"Generating a {args.players} x {args.maps} list with {args.edits:.1%} edits... "):
+        client = fake_sheets.FakeClient(sheets_dir)
+        page = synthetic.make_clears_page(args.players, args.maps, args.fill, args.fc_pairs, args.seed)
+        previous_state, _ = clears.get_current_state_and_maps_from_sheet_values(page)
+        fake_sheets.write_state_sheet(client, fake_sheets.DEFAULT_STATE_SHEET_ID,
+                                      clears.save_state_as_grid(previous_state))
+        edited_page = synthetic.edit_clears_page(page, args.edits, args.renames, args.seed + 1)
+        fake_sheets.write_main_sheet(client, fake_sheets.DEFAULT_CLEARS_SHEET_ID, edited_page,
+                                     fake_sheets.cld_to_page(synthetic.make_cld(edited_page, seed=args.seed)))
+
+    fake = fake_discord.FakeDiscord(args.limit, args.reset_after, args.error_rate, args.rate_limit_rate, args.latency,
+                                    args.seed)
+    server = fake.start()
+    os.environ.update({
+        fake_sheets.FAKE_SHEETS_DIR_ENV_VAR: sheets_dir,
+        "CLEARS_SHEET_ID": fake_sheets.DEFAULT_CLEARS_SHEET_ID,
+        "STATE_SHEET_ID": fake_sheets.DEFAULT_STATE_SHEET_ID,
+        "PRIMARY_DISCORD_WEBHOOK_URL": fake_discord.webhook_url(server, "primary"),
+        "SECONDARY_DISCORD_WEBHOOK_URL": fake_discord.webhook_url(server, "secondary"),
+    })
+
+    run_args = ["--metrics-dir", metrics_dir, "--batch-mode", args.batch_mode, "--diff-engine", args.diff_engine,
+                "--digest-after", str(args.digest_after)]
+    if args.full_save:
+        run_args.append("--full-save")
+
+    start_time = time.monotonic()
+    try:
+        main.main(main.get_arg_parser().parse_args(run_args))
+    finally:
+        end_time = time.monotonic()
+        server.shutdown()
+
+    with open(os.path.join(metrics_dir, timing.RUN_REPORT_FILE_NAME), encoding="utf-8") as f:
+        run_report = json.load(f)
+
+    arrival_times = [arrived_at - start_time for arrived_at, _, _ in fake.messages]
+    send_duration = (max(arrival_times) - min(arrival_times)) if len(arrival_times) > 1 else 0.0
+    results = {
+        "settings": vars(args),
+        "work_dir": work_dir,
+        "duration": end_time - start_time,
+        "counters": run_report["counters"],
+        "spans": {span["name"]: span["duration"] for span in run_report["spans"][0]["children"]}
+        if run_report["spans"] else {},
+        "discord": {
+            "messages": len(fake.messages),
+            "attachments": len(fake.attachments),
+            "requests": fake.num_requests,
+            "rate_limited": fake.num_rate_limited,
+            "errors": fake.num_errors,
+            "rejected": fake.num_rejected,
+            "messages_per_sec": len(fake.messages) / send_duration if send_duration else None,
+            "first_message_after": min(arrival_times, default=None),
+            "median_message_after": statistics.median(arrival_times) if arrival_times else None,
+            "p95_message_after": percentile(arrival_times, 0.95),
+            "last_message_after": max(arrival_times, default=None),
+        },
+    }
+    return results
+
+
+def print_results(results):
+    print(f"\nWhole run took {results['duration']:.3f} sec:")
+    for name, duration in results["spans"].items():
+        print(f"  {name:<40} {duration:9.3f} sec")
+    print("Counters:")
+    for name, value in sorted(results["counters"].items()):
+        print(f"  {name:<40} {value:>12,.{0 if isinstance(value, int) else 3}f}")
+    print("Discord:")
+    for name, value in results["discord"].items():
+        print(f"  {name:<40} {'-' if value is None else f'{value:,.3f}' if isinstance(value, float) else value:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the whole pipeline against fake sheets and a fake Discord")
+    parser.add_argument("--players", type=int, default=2000)
+    parser.add_argument("--maps", type=int, default=2500)
+    parser.add_argument("--fill", type=float, default=0.05, help="Fraction of cells with a clear (default: 0.05)")
+    parser.add_argument("--fc-pairs", type=float, default=0.3,
+                        help="Fraction of maps that come as a [C]/[FC] pair (default: 0.3)")
+    parser.add_argument("--edits", type=float, default=0.01,
+                        help="Fraction of clears removed, changed or added since the last run (default: 0.01)")
+    parser.add_argument("--renames", type=float, default=0.005,
+                        help="Fraction of players and maps renamed since the last run (default: 0.005)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-b", "--batch-mode", choices=discord.BATCH_MODES, default=discord.DEFAULT_BATCH_MODE)
+    parser.add_argument("--diff-engine", choices=main.DIFF_ENGINES, default="python")
+    parser.add_argument("--digest-after", type=int, default=discord.DEFAULT_DIGEST_AFTER,
+                        help="Send a digest instead above this many messages per webhook, or 0 to never do that "
+                             f"(default: {discord.DEFAULT_DIGEST_AFTER})")
+    parser.add_argument("-f", "--full-save", action="store_true", help="Rewrite the whole fake state sheet")
+    parser.add_argument("--limit", type=int, default=fake_discord.DEFAULT_LIMIT,
+                        help="Fake Discord requests per bucket window (default: 5)")
+    parser.add_argument("--reset-after", type=float, default=fake_discord.DEFAULT_RESET_AFTER,
+                        help="Fake Discord seconds per bucket window (default: 2.0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake Discord requests that fail")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of fake Discord requests that get an unexpected 429")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds fake Discord takes to answer")
+    parser.add_argument("--work-dir", help="Where to put the fake sheets, cache and metrics (default: a temp dir)")
+    parser.add_argument("-o", "--output", help="Save the results as JSON here")
+    args = parser.parse_args()
+
+    results = run_load_test(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,43 @@
+import json
+import os
+
+import lists
+
+# small files that should survive between runs (the workflow restores this directory with actions/cache). nothing in
+# here is required: losing it only makes the next run do a bit more work. every list from a config file gets its own
+# subdirectory (see lists.ListConfig).
+CACHE_DIR = os.environ.get('HISTCORD_CACHE_DIR', '.histcord_cache')
+
+LAST_RUN_FILE_NAME = "last_run.json"
+
+
+def cache_path(file_name):
+    cache_dir = os.path.join(CACHE_DIR, lists.current().cache_subdir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, file_name)
+
+
+def load_json(file_name, default=None):
+    try:
+        with open(cache_path(file_name), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        print(f"WARNING: Ignoring unreadable cache file {file_name}: {e}")
+        return default
+
+
+# write to a temp file and rename it over the old one, so a crash can't leave a half-written file behind
+def save_json(file_name, value):
+    path = cache_path(file_name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def update_last_run(**values):
+    last_run = load_json(LAST_RUN_FILE_NAME, {})
+    last_run.update(values)
+    save_json(LAST_RUN_FILE_NAME, last_run)
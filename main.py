@@ -1,45 +1,485 @@
 import argparse
+import concurrent.futures
+import signal
+import sys
+import threading
+import time
 
 from dotenv import load_dotenv
 
+import aggregates
 import clears
 import discord
+import event_log
+import fingerprints
+import goldens
+import lists
+import local_cache
+import maps
 import sheets
 import timing
 
+DIFF_ENGINES = ["python", "stream", "numpy", "check"]
+# the sections of the state's metadata that describe the clears page the state was parsed from
+PAGE_METADATA_SECTIONS = fingerprints.FINGERPRINT_SECTIONS | {maps.MAP_SECTION}
 
+
+# runs one check of the clears sheet against the saved state. saved_state is the (state_sheet, state_table,
+# previous_state, metadata) tuple returned by the last check, or None to load it from the state sheet. returns the
+# saved state to pass to the next check and whether anything changed.
 # noinspection PyShadowingNames
-def main(args):
-    with timing.Timer("Starting script!\n\n", lambda d: f"\nScript done in {d:.3f} sec!"):
-        with timing.Timer("Loading previous and current states... "):
-            state_sheet, previous_state = sheets.load_previous_state_from_state_sheet()
-            current_clears_sheet = sheets.load_current_clears_from_main_sheet()
-            current_state, map_difficulties = clears.get_current_state_and_maps_from_sheet_values(current_clears_sheet)
-
-        with timing.Timer("Calculating diffs... "):
-            diff_list = clears.get_state_diff_list(previous_state, current_state, map_difficulties)
-
-        if diff_list:
-            with timing.Timer("Printing messages...\n" if args.print else "Sending Discord messages... "):
-                discord.send_diff_messages_to_webhook(diff_list, args.print)
-            if args.dry_run:
-                print("Dry run - not saving current state to state sheet")
-            else:
-                with timing.Timer("Saving current state to state sheet... "):
-                    state_grid = clears.save_state_as_grid(current_state)
-                    sheets.save_clears_to_state_sheet(state_sheet, state_grid)
+def check_for_changes(args, saved_state=None):
+    # one drive metadata request tells us if the main sheet was edited at all since the state was last saved. if it
+    # wasn't, there's nothing to download, parse or diff (but the outbox might still have messages to deliver).
+    main_sheet_modified_time = None
+    if not args.no_probe:
+        with timing.Timer("Checking if the main sheet was modified... "):
+            main_sheet_modified_time = sheets.get_main_sheet_modified_time()
+        if main_sheet_is_unmodified(main_sheet_modified_time) and not (
+                args.leaderboard_every is not None and leaderboard_is_due(args)):
+            print("No changes detected since last run (the main sheet wasn't modified).")
+            timing.count("unmodified_skips")
+            send_queued_messages(args)
+            return saved_state, False
+
+    with timing.Timer("Loading previous and current states... "):
+        # goldens are usually added in bursts, so if the last run had some, this one probably will too
+        # (unless the cached golden tiers are recent enough that we won't need the cld page anyway)
+        prefetch_cld = (local_cache.load_json(local_cache.LAST_RUN_FILE_NAME, {}).get("saw_golden_clears", False) and
+                        not goldens.golden_tiers_cache_is_within_ttl())
+        loaded_state, current_clears_sheet, cld = sheets.load_pages_concurrently(saved_state is None, prefetch_cld)
+        if saved_state is None:
+            saved_state = loaded_state
+        if cld is not None:
+            # the modified time was fetched before the download, like refresh_golden_tiers does, so the cache can be
+            # kept past its ttl for as long as the main sheet stays unmodified
+            goldens.prime_golden_tiers(cld, main_sheet_modified_time)
+        state_sheet, state_table, previous_state, metadata = saved_state
+        old_fingerprints = fingerprints.fingerprints_from_metadata(metadata)
+        previous_map_catalog = maps.catalog_from_metadata(metadata)
+
+        # only parse and diff the rows that changed since the last save, if we can
+        changed_rows = None
+        if not args.full_parse:
+            changed_rows = fingerprints.parse_changed_rows(previous_state, old_fingerprints, *current_clears_sheet,
+                                                           previous_map_catalog)
+        if changed_rows is not None:
+            current_state, map_catalog, changed_previous_state, changed_current_state, new_fingerprints = changed_rows
+            timing.count("cells_parsed", len(changed_current_state))
+            timing.count("rows_skipped", sum(old_fingerprints["rows"].get(map_name) == fingerprint
+                                             for map_name, fingerprint in new_fingerprints["rows"].items()))
+        elif args.diff_engine == "stream":
+            # parsed while diffing, below
+            current_state = None
         else:
-            print("No changes detected since last run.")
+            current_state, map_catalog = clears.get_current_state_and_maps_from_clears_rows(*current_clears_sheet,
+                                                                                            previous_map_catalog)
+            changed_previous_state, changed_current_state = previous_state, current_state
+            timing.count("cells_parsed", len(current_state))
 
+    with timing.Timer("Calculating diffs... "):
+        if current_state is None:
+            current_state, map_catalog, diff_list, cell_changes = clears.get_current_state_and_diffs_streaming(
+                previous_state, *current_clears_sheet, previous_map_catalog)
+            timing.count("cells_parsed", len(current_state))
+        else:
+            diff_list, cell_changes = calculate_diffs(args, changed_previous_state, changed_current_state,
+                                                      map_catalog)
+        if changed_rows is None:
+            new_fingerprints = fingerprints.get_fingerprints(*current_clears_sheet, len(current_state))
+        timing.count("maps_parsed", len(map_catalog))
+        timing.count("diffs", len(diff_list))
+        timing.count("cell_changes", len(cell_changes))
+        local_cache.update_last_run(saw_golden_clears=goldens.diff_list_has_golden_clears(diff_list))
 
-if __name__ == "__main__":
-    load_dotenv()
+    # the state sheet save the previous state came from (see event_log.py), which the aggregates have to match
+    previous_batch_id = event_log.get_saved_batch_id(metadata)
+    current_aggregates = None
+    # False if the state got saved, but the state sheet might not be exactly what we think it is (see
+    # sheets.save_clears_to_state_sheet), so the next run has to look at everything again
+    state_saved_completely = True
+
+    if diff_list:
+        with timing.Timer("Updating aggregates... "):
+            current_aggregates, milestone_diffs = aggregates.update_saved_aggregates(
+                previous_batch_id, previous_state, current_state, diff_list, cell_changes, map_catalog)
+            if not args.no_milestones:
+                diff_list = diff_list + milestone_diffs
+
+        queued_message_ids = []
+        if args.print:
+            with timing.Timer("Printing messages...\n"):
+                discord.print_diff_messages(diff_list, args.batch_mode, args.digest_after or None,
+                                            not args.no_digest_file)
+        else:
+            with timing.Timer("Queueing Discord messages... "):
+                queued_message_ids = discord.queue_diff_messages(diff_list, args.batch_mode, args.digest_after or None,
+                                                                 not args.no_digest_file)
+
+        if args.dry_run:
+            print("Dry run - not saving current state to state sheet")
+        else:
+            with timing.Timer("Saving current state to state sheet... "):
+                metadata_values = get_page_metadata_values(new_fingerprints, map_catalog)
+                # save the state with a new batch id, which the event log and the aggregates go with
+                batch_id = event_log.new_batch_id()
+                metadata_values[event_log.EVENT_LOG_SECTION, "batch"] = batch_id
+                metadata_update = (metadata, PAGE_METADATA_SECTIONS | {event_log.EVENT_LOG_SECTION}, metadata_values)
+                grid_updates = None
+                if not args.full_save:
+                    grid_updates = clears.get_state_grid_updates(state_table, previous_state, diff_list, cell_changes)
+                new_state_table = None if grid_updates is not None else clears.save_state_as_grid(current_state)
+                try:
+                    if grid_updates is not None:
+                        sheets.save_clear_updates_to_state_sheet(state_sheet, grid_updates, metadata_update)
+                    else:
+                        state_saved_completely = sheets.save_clears_to_state_sheet(state_sheet, new_state_table,
+                                                                                   metadata_update)
+                except (Exception, SystemExit):
+                    # the state wasn't written, so the next run diffs against whatever the state sheet has then and
+                    # queues these changes again. sending the messages of this run as well would post them twice.
+                    discord.unqueue_messages(queued_message_ids)
+                    raise
+                if grid_updates is not None:
+                    state_table = clears.apply_state_grid_updates(state_table, grid_updates)
+                else:
+                    state_table = new_state_table
+
+            # only what made it into the state sheet goes in the history and the aggregates
+            aggregates.save_aggregates(current_aggregates, batch_id)
+            if not args.no_event_log:
+                with timing.Timer("Appending to event log... "):
+                    timing.count("events_logged", event_log.EventLog().append(
+                        previous_state, current_state, diff_list, cell_changes, batch_id, previous_batch_id))
+
+        # in a dry run, carry on from the current state anyway, so watch mode doesn't repeat the same messages on
+        # every tick
+        saved_state = (state_sheet, state_table, current_state, metadata)
+    else:
+        print("No changes detected since last run.")
+
+    # rows and star difficulties can change without changing any clears (or they're missing, e.g. on the first run),
+    # and then they're worth saving so the next run can skip those rows again and knows where removed maps were
+    metadata_values = get_page_metadata_values(new_fingerprints, map_catalog)
+    metadata_updates = metadata.get_updates(PAGE_METADATA_SECTIONS, metadata_values)
+    if metadata_updates[0] and state_saved_completely:
+        if args.dry_run:
+            # keep them in memory only, so watch mode still only parses what changed since the last tick
+            metadata.apply_updates(*metadata_updates)
+        else:
+            with timing.Timer("Saving row fingerprints and map catalog to state sheet... "):
+                sheets.save_state_metadata(state_sheet, metadata, PAGE_METADATA_SECTIONS, metadata_values)
+
+    if args.leaderboard_every is not None and leaderboard_is_due(args):
+        queue_leaderboard(args, current_aggregates, saved_state, map_catalog)
+
+    # only now does the state sheet match the main sheet as of the modified time, which was fetched before downloading
+    # it, so an edit made during the download still makes the next run look
+    if main_sheet_modified_time is not None and not args.dry_run and state_saved_completely:
+        local_cache.update_last_run(main_sheet=[lists.current().clears_sheet_id, main_sheet_modified_time])
+
+    send_queued_messages(args)
+
+    if not state_saved_completely:
+        saved_state = None
+    return saved_state, bool(diff_list)
+
+
+# whether the main sheet still has the modified time it had when the state was last saved. always False if the modified
+# time couldn't be fetched.
+def main_sheet_is_unmodified(modified_time):
+    if modified_time is None:
+        return False
+    last_main_sheet = local_cache.load_json(local_cache.LAST_RUN_FILE_NAME, {}).get("main_sheet")
+    return last_main_sheet == [lists.current().clears_sheet_id, modified_time]
+
+
+# messages are only sent after the state is saved, and this also picks up anything earlier runs failed to deliver
+# noinspection PyShadowingNames
+def send_queued_messages(args):
+    if not args.print and discord.has_queued_messages():
+        with timing.Timer("Sending Discord messages... "):
+            discord.send_queued_messages()
+
+
+# {(section, key): value} for the PAGE_METADATA_SECTIONS of the state's metadata
+def get_page_metadata_values(new_fingerprints, map_catalog):
+    metadata_values = fingerprints.fingerprints_to_metadata_values(new_fingerprints)
+    metadata_values.update(map_catalog.to_metadata_values())
+    return metadata_values
+
+
+# noinspection PyShadowingNames
+def leaderboard_is_due(args):
+    last_posted_at = local_cache.load_json(local_cache.LAST_RUN_FILE_NAME, {}).get("leaderboard_posted_at", 0)
+    return time.time() >= last_posted_at + args.leaderboard_every * 3600
+
+
+# current_aggregates are the ones updated by this run, or None if there weren't any changes
+# noinspection PyShadowingNames
+def queue_leaderboard(args, current_aggregates, saved_state, map_catalog):
+    with timing.Timer("Printing leaderboard...\n" if args.print else "Queueing leaderboard... "):
+        _, _, state, metadata = saved_state
+        if current_aggregates is None:
+            batch_id = event_log.get_saved_batch_id(metadata)
+            current_aggregates = aggregates.load_aggregates(batch_id)
+            if current_aggregates is None:
+                current_aggregates = aggregates.build_aggregates(state, map_catalog)
+                if batch_id is not None:
+                    aggregates.save_aggregates(current_aggregates, batch_id)
+
+        leaderboard_messages = discord.render_leaderboard_messages(aggregates.get_leaderboard(current_aggregates))
+        if args.print:
+            discord.print_rendered_messages(leaderboard_messages)
+        else:
+            discord.queue_rendered_messages(leaderboard_messages)
+            if not args.dry_run:
+                local_cache.update_last_run(leaderboard_posted_at=time.time())
+
+
+# noinspection PyShadowingNames
+def calculate_diffs(args, previous_state, current_state, map_catalog):
+    if args.diff_engine == "python":
+        return clears.get_state_diff_list_and_cell_changes(previous_state, current_state, map_catalog)
+    if args.diff_engine == "stream":
+        records = ((player_name, map_name, value) for (player_name, map_name), value in current_state.items())
+        return clears.get_state_diff_list_and_cell_changes_from_records(previous_state, records, map_catalog)
+
+    try:
+        import numpy_diff
+    except ImportError:
+        print(f"ERROR: The {args.diff_engine} diff engine needs numpy. Install it with `pip install numpy`.")
+        sys.exit(1)
+
+    diff_list, cell_changes = numpy_diff.get_state_diff_list_and_cell_changes(
+        previous_state, current_state, map_catalog)
+
+    if args.diff_engine == "check":
+        python_diff_list, python_cell_changes = clears.get_state_diff_list_and_cell_changes(
+            previous_state, current_state, map_catalog)
+        if not clears.diff_lists_match(diff_list, python_diff_list) or \
+                sorted(cell_changes) != sorted(python_cell_changes):
+            print("ERROR: The numpy and python diff engines disagree!")
+            print(f"numpy:  {diff_list}")
+            print(f"python: {python_diff_list}")
+            sys.exit(1)
+
+    return diff_list, cell_changes
 
+
+# checks every list for changes. list_configs is None without a config file, in which case the one list from the
+# environment is checked on this thread like it always was. otherwise every list is checked at the same time in its own
+# thread, sharing the gspread client, the discord session and the webhook rate limits, and a list whose check fails
+# doesn't stop the others. saved_states is list name -> saved state from the last check of that list (see
+# check_for_changes), or None to load it from the state sheet again. returns (list name -> saved state, whether any
+# list changed, names of the lists that failed).
+# noinspection PyShadowingNames
+def check_lists(args, list_configs, saved_states):
+    if list_configs is None:
+        saved_state, changed = check_for_changes(args, saved_states.get(lists.DEFAULT_LIST_NAME))
+        return {lists.DEFAULT_LIST_NAME: saved_state}, changed, []
+
+    # make the shared client before the threads want it
+    sheets.get_gspread_client()
+
+    saved_states = dict(saved_states)
+    changed = False
+    failed_list_names = []
+    stdout = sys.stdout
+    sys.stdout = lists.ListOutput(stdout)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(list_configs)) as executor:
+            futures = {list_config.name: lists.submit_in_context(executor, check_list, args, list_config,
+                                                                 saved_states.get(list_config.name))
+                       for list_config in list_configs}
+    finally:
+        sys.stdout = stdout
+
+    for list_name, future in futures.items():
+        try:
+            saved_states[list_name], list_changed = future.result()
+            changed = changed or list_changed
+        except (Exception, SystemExit) as e:
+            print(f"ERROR: Checking list {list_name} failed: {e!r}")
+            failed_list_names.append(list_name)
+            # the check might have failed halfway through saving the state sheet, so the next one has to load it again
+            # instead of trusting the saved state (lists whose first check failed stay missing, see watch)
+            if list_name in saved_states:
+                saved_states[list_name] = None
+
+    return saved_states, changed, failed_list_names
+
+
+# noinspection PyShadowingNames
+def check_list(args, list_config, saved_state):
+    with lists.use(list_config):
+        timing.start_branch()
+        with timing.Timer("Checking list...\n", lambda d: f"List done in {d:.3f} sec!",
+                          name=f"list_{timing.message_to_span_name(list_config.name)}", stage=False):
+            return check_for_changes(args, saved_state)
+
+
+# noinspection PyShadowingNames
+def main(args):
+    list_configs = lists.load_list_configs(args.config) if args.config else None
+
+    start_run(args)
+    try:
+        with timing.Timer("Starting script!\n\n", lambda d: f"\nScript done in {d:.3f} sec!", name="script",
+                          stage=False):
+            _, _, failed_list_names = check_lists(args, list_configs, {})
+    finally:
+        finish_run(args)
+
+    if failed_list_names:
+        sys.exit(1)
+
+
+# noinspection PyShadowingNames
+def start_run(args, name="run"):
+    timing.start_run(name)
+    if args.profile:
+        import profiling
+        profiling.start_profiling()
+
+
+# writes the metrics (and the profile) of the run (or check, in watch mode) if asked to. this also happens for failed
+# runs, since those are the interesting ones.
+# noinspection PyShadowingNames
+def finish_run(args):
+    timing.finish_run()
+    if args.metrics_dir:
+        timing.write_run_report(args.metrics_dir)
+    if args.profile:
+        import profiling
+        profiling.finish_profiling(args.profile)
+
+
+# poll quickly while the list is being edited, and back off gradually while it's quiet
+# noinspection PyShadowingNames
+def next_poll_interval(interval, changed, args):
+    if changed:
+        return args.min_interval
+    return min(interval * args.backoff, args.max_interval)
+
+
+# keeps the gspread client and the previous state in memory and checks for changes until we get SIGINT or SIGTERM.
+# a signal lets the current check finish (so we never stop between sending messages and saving the state), and a
+# second one stops immediately.
+# noinspection PyShadowingNames
+def watch(args):
+    stop_event = threading.Event()
+
+    def handle_signal(signum, _frame):
+        if stop_event.is_set():
+            raise KeyboardInterrupt
+        print(f"\nReceived {signal.Signals(signum).name}, stopping after the current check...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    list_configs = lists.load_list_configs(args.config) if args.config else None
+    saved_states = {}
+    interval = args.min_interval
+
+    while not stop_event.is_set():
+        # golden tiers might have been updated since the last check
+        goldens.clear_golden_tiers()
+
+        start_run(args, "check")
+        try:
+            with timing.Timer("Checking for changes...\n", lambda d: f"Check done in {d:.3f} sec!", stage=False):
+                saved_states, changed, _ = check_lists(args, list_configs, saved_states)
+        except (Exception, SystemExit) as e:
+            # errors on the first check are almost always configuration problems, so don't keep retrying those
+            if not saved_states:
+                raise
+            print(f"ERROR: Check failed, will retry: {e!r}")
+            # like in check_lists, load the states again instead of trusting them after a failed check
+            saved_states = dict.fromkeys(saved_states)
+            changed = False
+        finally:
+            finish_run(args)
+
+        # same for lists whose first check failed, but the other lists keep going
+        if list_configs is not None:
+            dropped_list_names = [list_config.name for list_config in list_configs
+                                  if list_config.name not in saved_states]
+            if dropped_list_names:
+                print(f"ERROR: Not checking {', '.join(dropped_list_names)} anymore, since the first check failed.")
+                list_configs = [list_config for list_config in list_configs if list_config.name in saved_states]
+            if not list_configs:
+                sys.exit(1)
+
+        interval = next_poll_interval(interval, changed, args)
+        print(f"Next check in {interval:.0f} sec.\n")
+        stop_event.wait(interval)
+
+    print("Stopped watching.")
+
+
+def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--dry-run", action="store_true",
                         help="Dry run mode - do not save diffs to state sheet")
     parser.add_argument("-p", "--print", action="store_true",
                         help="Print mode - print messages instead of sending to Discord")
-    args = parser.parse_args()
+    parser.add_argument("-f", "--full-save", action="store_true",
+                        help="Full save mode - rewrite the whole state sheet instead of only the changed cells")
+    parser.add_argument("-b", "--batch-mode", choices=discord.BATCH_MODES, default=discord.DEFAULT_BATCH_MODE,
+                        help="How to pack messages into Discord messages: one per diff (none), as many lines as fit "
+                             "(lines), or as many lines as fit per star difficulty (stars) (default: lines)")
+    parser.add_argument("--digest-after", type=int, default=discord.DEFAULT_DIGEST_AFTER, metavar="N",
+                        help="Send a summary of the changes instead when there are more than this many Discord "
+                             "messages for one webhook, or 0 to never do that "
+                             f"(default: {discord.DEFAULT_DIGEST_AFTER})")
+    parser.add_argument("--no-digest-file", action="store_true",
+                        help="Don't attach a file with every change to digests")
+    parser.add_argument("--full-parse", action="store_true",
+                        help="Full parse mode - parse and diff every row of the clears page, even the ones that "
+                             "haven't changed since the last run")
+    parser.add_argument("--diff-engine", choices=DIFF_ENGINES, default="python",
+                        help="How to calculate diffs: in plain python, in plain python while parsing the clears page "
+                             "a map at a time (stream), with numpy, or with numpy and python and checking that they "
+                             "agree (default: python)")
+    parser.add_argument("--no-probe", action="store_true",
+                        help="Download and check the clears page even if the main sheet's modified time says it "
+                             "wasn't edited since the last run")
+    parser.add_argument("--no-event-log", action="store_true",
+                        help="Don't append the saved diffs to the local event log (see event_log.py)")
+    parser.add_argument("--no-milestones", action="store_true",
+                        help="Don't announce clear count milestones and first goldens (see aggregates.py)")
+    parser.add_argument("--leaderboard-every", type=float, metavar="HOURS",
+                        help="Post a leaderboard of the most clears per star difficulty and the most goldens at most "
+                             "once every this many hours (default: never)")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="Watch mode - keep running and poll for changes until interrupted")
+    parser.add_argument("--min-interval", type=float, default=60,
+                        help="Watch mode - seconds between checks right after a change (default: 60)")
+    parser.add_argument("--max-interval", type=float, default=900,
+                        help="Watch mode - maximum seconds between checks while quiet (default: 900)")
+    parser.add_argument("--backoff", type=float, default=1.5,
+                        help="Watch mode - factor to grow the interval by after each quiet check (default: 1.5)")
+    parser.add_argument("--config",
+                        help="Check every list in this JSON or TOML file at the same time, instead of the one list "
+                             "from the environment (see lists.load_list_configs)")
+    parser.add_argument("--metrics-dir",
+                        help="Write a JSON report and a Prometheus text file with timings and counters of every run "
+                             "(or check, in watch mode) to this directory")
+    parser.add_argument("--profile", nargs="?", const="profile", metavar="DIR",
+                        help="Profile every stage of the run (or check, in watch mode) with cProfile and tracemalloc, "
+                             "and write a report of the slowest functions and biggest allocation sites of each to "
+                             "this directory (default: profile). Works with --print and --dry-run.")
+    return parser
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    args = get_arg_parser().parse_args()
 
-    main(args)
+    if args.watch:
+        watch(args)
+    else:
+        main(args)
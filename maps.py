@@ -0,0 +1,68 @@
+import helpers
+
+# every map of one snapshot of the clears page, with what the diff, aggregate and message stages need to know about it
+# worked out once while the page is parsed, instead of trimming map names again for every cell that changed.
+# the star difficulties are saved in the state sheet's metadata (see state_metadata.py) next to the state, as
+#   ["map", <map name>, <star difficulty>]
+# so the catalog the previous state was saved with can be loaded back, and maps that were removed since still have a
+# star difficulty.
+MAP_SECTION = "map"
+
+
+class MapCatalog:
+    __slots__ = ("maps", "previous_catalog")
+
+    # previous_catalog is the catalog of the previous state (see catalog_from_metadata), which is used to look up maps
+    # that aren't in this one, like removed maps and the old names of renamed ones
+    def __init__(self, previous_catalog=None):
+        # map name -> (star difficulty, trimmed map name, clear type), see helpers.trim_map_name
+        self.maps = {}
+        self.previous_catalog = previous_catalog
+
+    def __len__(self):
+        return len(self.maps)
+
+    def __contains__(self, map_name):
+        return map_name in self.maps
+
+    def __iter__(self):
+        return iter(self.maps)
+
+    # (star difficulty, trimmed map name, clear type) of a map of this snapshot
+    def __getitem__(self, map_name):
+        return self.maps[map_name]
+
+    def add(self, map_name, star_difficulty):
+        self.maps[map_name] = (star_difficulty, *helpers.trim_map_name(map_name))
+
+    # like __getitem__, but also finds maps of the previous catalog. the star difficulty is None for maps neither of
+    # them has (e.g. removed maps, if the previous state was saved before the catalog was).
+    def get(self, map_name):
+        info = self.maps.get(map_name)
+        if info is None and self.previous_catalog is not None:
+            info = self.previous_catalog.maps.get(map_name)
+        if info is None:
+            info = (None, *helpers.trim_map_name(map_name))
+        return info
+
+    def star_difficulty(self, map_name):
+        return self.get(map_name)[0]
+
+    def trimmed_name(self, map_name):
+        return self.get(map_name)[1]
+
+    def clear_type(self, map_name):
+        return self.get(map_name)[2]
+
+    # {(section, key): value} for StateMetadata.get_updates
+    def to_metadata_values(self):
+        return {(MAP_SECTION, map_name): str(info[0]) for map_name, info in self.maps.items()}
+
+
+# the catalog saved with the state, which is empty if the state was saved before there was one
+def catalog_from_metadata(metadata):
+    map_catalog = MapCatalog()
+    if metadata is not None:
+        for map_name, star_difficulty in metadata.section(MAP_SECTION).items():
+            map_catalog.add(map_name, int(star_difficulty))
+    return map_catalog
@@ -0,0 +1,108 @@
+from collections import defaultdict
+
+import numpy as np
+
+import clears
+from state import ClearState
+
+
+# an alternative to clears.get_state_diff_list_and_cell_changes that finds the changed cells with numpy instead of
+# walking every key in python. renames are resolved first, then both states are turned into sorted arrays of
+# (map index * number of players + player index) keys on the current state's player and map axes, with old names
+# translated to new ones. only the cells whose values differ go through the usual [C]/[FC] merging, so the output is
+# the same as the python engine's (up to order, see clears.diff_lists_match).
+def get_state_diff_list_and_cell_changes(previous_state, current_state, map_catalog):
+    entity_changes = clears.get_entity_changes(previous_state, current_state)
+    added_players, removed_players, player_renamings, added_maps, removed_maps, map_renamings = entity_changes
+
+    player_names, map_names = clears.get_player_and_map_names(current_state)
+    player_names = sorted(player_names)
+    map_names = sorted(map_names)
+    player_indices = {player_name: i for i, player_name in enumerate(player_names)}
+    map_indices = {map_name: i for i, map_name in enumerate(map_names)}
+
+    # old names of renamed players and maps point at the index of their new name. removed players and maps aren't in
+    # here at all, so their cells get dropped.
+    old_player_indices = {player_name: i for player_name, i in player_indices.items() if player_name not in
+                          added_players}
+    old_player_indices.update({old_name: player_indices[new_name] for new_name, old_name in player_renamings.items()})
+    old_map_indices = {map_name: i for map_name, i in map_indices.items() if map_name not in added_maps}
+    old_map_indices.update({old_name: map_indices[new_name] for new_name, old_name in map_renamings.items()})
+
+    # cell value -> id, where 0 is the empty cell
+    value_ids = {"": 0}
+    num_players = max(len(player_names), 1)
+
+    old_keys, old_value_ids = state_to_key_arrays(previous_state, old_player_indices, old_map_indices, value_ids,
+                                                  num_players)
+    new_keys, new_value_ids = state_to_key_arrays(current_state, player_indices, map_indices, value_ids, num_players)
+
+    all_keys = np.union1d(old_keys, new_keys)
+    old_values_at_keys = values_at_keys(old_keys, old_value_ids, all_keys)
+    new_values_at_keys = values_at_keys(new_keys, new_value_ids, all_keys)
+    changed_keys = all_keys[old_values_at_keys != new_values_at_keys]
+
+    value_names = list(value_ids.keys())
+    clear_diffs_by_player_and_map = defaultdict(set)
+    cell_changes = []
+
+    for key, old_value_id, new_value_id in zip(changed_keys.tolist(),
+                                               values_at_keys(old_keys, old_value_ids, changed_keys).tolist(),
+                                               values_at_keys(new_keys, new_value_ids, changed_keys).tolist()):
+        map_i, player_i = divmod(key, num_players)
+        player_name = player_names[player_i]
+        map_name = map_names[map_i]
+        old_val = value_names[old_value_id]
+        new_val = value_names[new_value_id]
+
+        cell_changes.append((player_name, map_name, new_val))
+        clears.add_clear_diff(clear_diffs_by_player_and_map, player_name, map_name, old_val, new_val, map_catalog)
+
+    diff_list = (clears.get_entity_diffs(entity_changes, map_catalog) +
+                 clears.merge_clear_diffs(clear_diffs_by_player_and_map))
+    return diff_list, cell_changes
+
+
+# returns the state's cells as a sorted int64 array of keys and a matching int32 array of value ids, skipping cells
+# whose player or map isn't in player_indices/map_indices. mutates value_ids to add new values.
+def state_to_key_arrays(state, player_indices, map_indices, value_ids, num_players):
+    if isinstance(state, ClearState):
+        # translate the state's own interned ids to our indices once, then do every row with array operations
+        player_id_to_index = np.array([player_indices.get(player_name, -1) for player_name in state.players.names],
+                                      dtype=np.int64)
+        value_id_to_id = np.array([value_ids.setdefault(value, len(value_ids)) for value in state.values.names],
+                                  dtype=np.int32)
+        key_chunks = []
+        value_id_chunks = []
+        for map_name, row in zip(state.maps.names, state.rows):
+            map_i = map_indices.get(map_name)
+            if map_i is None or not row:
+                continue
+            row_player_indices = player_id_to_index[np.asarray(row.player_ids, dtype=np.int64)]
+            kept = row_player_indices >= 0
+            key_chunks.append(map_i * num_players + row_player_indices[kept])
+            value_id_chunks.append(value_id_to_id[np.asarray(row.value_ids, dtype=np.int64)][kept])
+        keys = np.concatenate(key_chunks) if key_chunks else np.empty(0, dtype=np.int64)
+        state_value_ids = np.concatenate(value_id_chunks) if value_id_chunks else np.empty(0, dtype=np.int32)
+    else:
+        keys = []
+        state_value_ids = []
+        for (player_name, map_name), value in state.items():
+            player_i = player_indices.get(player_name)
+            map_i = map_indices.get(map_name)
+            if player_i is not None and map_i is not None:
+                keys.append(map_i * num_players + player_i)
+                state_value_ids.append(value_ids.setdefault(value, len(value_ids)))
+        keys = np.array(keys, dtype=np.int64)
+        state_value_ids = np.array(state_value_ids, dtype=np.int32)
+
+    order = np.argsort(keys, kind="stable")
+    return keys[order], state_value_ids[order]
+
+
+# looks up the value id of every key in lookup_keys (0 if the key has no cell)
+def values_at_keys(keys, key_value_ids, lookup_keys):
+    if not len(keys):
+        return np.zeros(len(lookup_keys), dtype=np.int32)
+    positions = np.minimum(np.searchsorted(keys, lookup_keys), len(keys) - 1)
+    return np.where(keys[positions] == lookup_keys, key_value_ids[positions], 0)
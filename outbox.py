@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+import uuid
+
+import local_cache
+
+OUTBOX_FILE_NAME = "outbox.jsonl"
+
+
+# an append-only journal of rendered discord messages that haven't been delivered yet. messages are added (and synced
+# to disk) before the state is saved, and only marked as delivered once discord accepted them, so a crash or a discord
+# outage means they get sent on the next run instead of never.
+# every line is either {"id": ..., "notif_type": ..., "payload": {...}} for a new message or {"done": id} once a
+# message was delivered, permanently rejected or withdrawn. messages with attachments also have
+# "files": [[file name, text]]. the attachments are kept in the journal itself, so a message and its files are always
+# added (and synced) together.
+class Outbox:
+    def __init__(self, file_name=OUTBOX_FILE_NAME):
+        self.file_name = file_name
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return local_cache.cache_path(self.file_name)
+
+    # returns the undelivered messages as a list of (message_id, notif_type_name, payload, files), oldest first, where
+    # files is a list of [file name, text]
+    def pending(self):
+        messages = {}
+        with self._lock:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # a line we were in the middle of writing when we crashed
+                            continue
+                        if "done" in entry:
+                            messages.pop(entry["done"], None)
+                        else:
+                            messages[entry["id"]] = (entry["id"], entry["notif_type"], entry["payload"],
+                                                     entry.get("files", []))
+            except FileNotFoundError:
+                pass
+        return list(messages.values())
+
+    # messages is a list of (notif_type_name, payload, files), like pending returns them. returns their message ids.
+    def add(self, messages):
+        message_ids = [uuid.uuid4().hex for _ in messages]
+        lines = [entry_to_line(message_id, notif_type_name, payload, files)
+                 for message_id, (notif_type_name, payload, files) in zip(message_ids, messages)]
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        return message_ids
+
+    def mark_done(self, message_id):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"done": message_id}) + "\n")
+
+    # takes back messages that shouldn't be sent after all, e.g. because the state they were about couldn't be saved
+    def withdraw(self, message_ids):
+        if not message_ids:
+            return
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps({"done": message_id}) + "\n" for message_id in message_ids)
+                f.flush()
+                os.fsync(f.fileno())
+
+    # rewrites the journal with only the undelivered messages (or deletes it if there are none)
+    def compact(self):
+        pending = self.pending()
+        with self._lock:
+            if not pending:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+                return
+
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(entry_to_line(*message) for message in pending)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+
+def entry_to_line(message_id, notif_type_name, payload, files):
+    entry = {"id": message_id, "notif_type": notif_type_name, "payload": payload}
+    if files:
+        entry["files"] = files
+    return json.dumps(entry) + "\n"
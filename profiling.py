@@ -0,0 +1,112 @@
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import threading
+import tracemalloc
+
+import timing
+
+# profiles a run stage by stage, where the stages are the Timers the run already has (see timing.Timer). every stage
+# gets its own cProfile profile and the allocations it left behind, from tracemalloc snapshots taken before and after
+# it. only one stage is profiled at a time: a stage that starts while another one is being profiled (a nested timer, or
+# another list checked at the same time) counts towards that one. before python 3.12, cProfile only sees the thread it
+# was started in, so work a stage hands to other threads only shows up as the time spent waiting for it.
+PROFILE_REPORT_FILE_NAME = "profile_report.txt"
+TOP_FUNCTIONS = 25
+TOP_ALLOCATION_SITES = 15
+# allocation sites that are tracemalloc's own bookkeeping rather than the stage's. they're skipped in the results
+# instead of filtered out of the snapshots, since filtering a snapshot goes through every trace in python.
+IGNORED_ALLOCATION_FILE_NAMES = {tracemalloc.__file__, "<unknown>"}
+
+
+class ProfiledStage:
+    __slots__ = ("path", "profile", "start_snapshot", "duration", "allocations", "peak_memory")
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.start_snapshot = None
+        self.duration = None
+        # tracemalloc.StatisticDiffs of the biggest allocation sites, by how much more they held after the stage
+        self.allocations = []
+        self.peak_memory = None
+
+
+class RunProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active_stage = None
+        # finished stages, in the order they finished in
+        self.stages = []
+
+    # returns the ProfiledStage to pass to stop_stage, or None if another stage is already being profiled
+    def start_stage(self, path):
+        with self.lock:
+            if self.active_stage is not None:
+                return None
+            stage = ProfiledStage(path)
+            self.active_stage = stage
+
+        tracemalloc.reset_peak()
+        stage.start_snapshot = tracemalloc.take_snapshot()
+        stage.profile.enable()
+        return stage
+
+    def stop_stage(self, stage, duration):
+        stage.profile.disable()
+        stage.duration = duration
+        stage.peak_memory = tracemalloc.get_traced_memory()[1]
+        allocations = (statistic for statistic in tracemalloc.take_snapshot().compare_to(stage.start_snapshot, "lineno")
+                       if statistic.traceback[0].filename not in IGNORED_ALLOCATION_FILE_NAMES)
+        stage.allocations = list(itertools.islice(allocations, TOP_ALLOCATION_SITES))
+        stage.start_snapshot = None
+
+        with self.lock:
+            self.active_stage = None
+            self.stages.append(stage)
+
+    def get_report(self):
+        lines = []
+        for stage in self.stages:
+            lines += [f"===== {stage.path} ({stage.duration:.3f} sec, peak memory {stage.peak_memory / 2 ** 20:.1f} "
+                      f"MiB) =====", "", f"Top {TOP_FUNCTIONS} functions by cumulative time:"]
+            stream = io.StringIO()
+            pstats.Stats(stage.profile, stream=stream).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            lines.append(stream.getvalue().strip("\n"))
+            lines += ["", f"Top {TOP_ALLOCATION_SITES} allocation sites by memory still held after the stage:"]
+            for statistic in stage.allocations:
+                frame = statistic.traceback[0]
+                lines.append(f"{statistic.size_diff / 1024:+12.1f} KiB {statistic.count_diff:+9d} blocks  "
+                             f"{frame.filename}:{frame.lineno}")
+            lines += ["", ""]
+        return "\n".join(lines)
+
+    # writes the report, and every stage's profile as a .prof file for other tools (e.g. snakeviz), to profile_dir
+    def write_report(self, profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+        timing.write_file_atomically(os.path.join(profile_dir, PROFILE_REPORT_FILE_NAME), self.get_report())
+        for i, stage in enumerate(self.stages):
+            stage_name = stage.path.rsplit("/", 1)[-1]
+            stage.profile.dump_stats(os.path.join(profile_dir, f"{i:02d}_{stage_name}.prof"))
+
+
+# profiles the stages of the current run until finish_profiling
+def start_profiling():
+    tracemalloc.start()
+    timing.set_profiler(RunProfiler())
+
+
+def finish_profiling(profile_dir):
+    profiler = timing.get_profiler()
+    timing.set_profiler(None)
+    tracemalloc.stop()
+    if profiler is None:
+        return
+
+    try:
+        profiler.write_report(profile_dir)
+        print(f"Wrote profile of {len(profiler.stages)} stages to {profile_dir}")
+    except OSError as e:
+        print(f"WARNING: Could not write the profile to {profile_dir}: {e}")
@@ -0,0 +1,96 @@
+import threading
+import time
+
+# discord's documented webhook limit is 5 requests per 2 seconds. we assume that until a response tells us otherwise.
+DEFAULT_BUCKET_LIMIT = 5
+DEFAULT_BUCKET_RESET_AFTER = 2.0
+
+
+class _Bucket:
+    __slots__ = ("limit", "remaining", "reset_at")
+
+    def __init__(self):
+        self.limit = DEFAULT_BUCKET_LIMIT
+        self.remaining = DEFAULT_BUCKET_LIMIT
+        # time.monotonic() value at which remaining goes back up to limit
+        self.reset_at = 0.0
+
+
+# keeps one token bucket per webhook url, kept in sync with the X-RateLimit-* headers discord sends back. requests to
+# different urls don't wait on each other, except when discord tells us we hit the global rate limit.
+class RateLimiter:
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._global_reset_at = 0.0
+
+    def _get_bucket(self, url):
+        with self._lock:
+            if url not in self._buckets:
+                self._buckets[url] = _Bucket()
+            return self._buckets[url]
+
+    # blocks until we're allowed to send a request to url. returns how many seconds we waited.
+    def wait(self, url):
+        bucket = self._get_bucket(url)
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait_until = self._global_reset_at
+                if now >= bucket.reset_at:
+                    bucket.remaining = bucket.limit
+                    bucket.reset_at = now + DEFAULT_BUCKET_RESET_AFTER
+                if bucket.remaining <= 0:
+                    wait_until = max(wait_until, bucket.reset_at)
+                if wait_until <= now:
+                    bucket.remaining -= 1
+                    return waited
+
+            time.sleep(wait_until - now)
+            waited += wait_until - now
+
+    # updates the bucket for url from a response. returns the number of seconds to wait before retrying if we got
+    # rate limited (429), otherwise None.
+    def update(self, url, response):
+        bucket = self._get_bucket(url)
+        headers = response.headers
+        now = time.monotonic()
+
+        with self._lock:
+            try:
+                if "X-RateLimit-Limit" in headers:
+                    bucket.limit = int(headers["X-RateLimit-Limit"])
+                if "X-RateLimit-Remaining" in headers:
+                    bucket.remaining = int(headers["X-RateLimit-Remaining"])
+                if "X-RateLimit-Reset-After" in headers:
+                    bucket.reset_at = now + float(headers["X-RateLimit-Reset-After"])
+            except ValueError:
+                print(f"WARNING: Could not parse rate limit headers: {dict(headers)}")
+
+            if response.status_code != 429:
+                return None
+
+            retry_after, is_global = get_retry_after(response)
+            if is_global:
+                self._global_reset_at = max(self._global_reset_at, now + retry_after)
+            else:
+                bucket.remaining = 0
+                bucket.reset_at = max(bucket.reset_at, now + retry_after)
+            return retry_after
+
+
+# reads how long to wait from a 429 response, preferring the body (which has sub-second precision) over the header
+def get_retry_after(response):
+    try:
+        body = response.json()
+        return float(body["retry_after"]), bool(body.get("global", False))
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    try:
+        return float(response.headers.get("Retry-After", DEFAULT_BUCKET_RESET_AFTER)), \
+            response.headers.get("X-RateLimit-Global") == "true"
+    except ValueError:
+        return DEFAULT_BUCKET_RESET_AFTER, False
@@ -1,24 +1,48 @@
+import concurrent.futures
+import datetime
 import functools
 import itertools
 import json
 import os
 import sys
 
-import gspread
-# noinspection PyPackageRequirements
-from google.oauth2.service_account import Credentials
-
 import helpers
-from constants import MIN_REQUIRED_ROWS, CLEARS_PAGE_NAME, CLD_PAGE_NAME
+import lists
+import local_cache
+import timing
+from constants import MIN_REQUIRED_ROWS
+from state import ClearState
+from state_metadata import StateMetadata, METADATA_WORKSHEET_TITLE, METADATA_NUM_COLS
+
+# gspread and google-auth (and the requests and oauthlib packages they pull in) take a good part of a second to import,
+# so they're only imported by the functions that need them, and --help never imports them. runs against fake sheets
+# (see fake_sheets.py) don't need google-auth's token exchange, but gspread (and with it google-auth) still gets
+# imported for its range helpers and exceptions once they read a sheet, so only the ones that stop after finding the
+# main sheet unmodified skip the imports.
 
 _SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive'
 ]
 
+# opt-in file to keep the access token in between runs, as {"email": ..., "scopes": [...], "token": ..., "expiry": iso
+# utc time}, so a run doesn't have to trade a signed jwt for a new token while the last run's one is still good. it's a
+# live credential, so it's only written with owner-only permissions, and never inside the local cache directory (which
+# the workflow uploads with actions/cache, where runs on other refs could restore it). --watch doesn't need it, since
+# it keeps the client and its token in memory.
+GOOGLE_TOKEN_CACHE_ENV_VAR = "HISTCORD_GOOGLE_TOKEN_CACHE"
+# don't use a cached token that expires sooner than this, so it doesn't run out in the middle of a run
+GOOGLE_TOKEN_MIN_SECONDS_LEFT = 300
+
 
 @functools.cache
 def get_gspread_client():
+    # offline runs against local files (see fake_sheets.py)
+    fake_sheets_dir = os.environ.get('HISTCORD_FAKE_SHEETS_DIR')
+    if fake_sheets_dir:
+        import fake_sheets
+        return fake_sheets.FakeClient(fake_sheets_dir)
+
     creds_json_string = os.environ.get('GOOGLE_CREDS_JSON')
 
     if not creds_json_string:
@@ -32,29 +56,142 @@ def get_gspread_client():
         sys.exit(1)
 
     try:
+        import gspread
+        # noinspection PyPackageRequirements
+        from google.oauth2.service_account import Credentials
+
         creds = Credentials.from_service_account_info(
             creds_info, scopes=_SCOPES
         )
-        return gspread.authorize(creds)
+        token_cache_path = get_google_token_cache_path()
+        if token_cache_path is not None and not load_cached_google_token(creds, token_cache_path):
+            refresh_google_token(creds, token_cache_path)
+        gc = gspread.authorize(creds)
+        gc.http_client.session.hooks["response"].append(count_google_api_response)
+        return gc
     except Exception as e:
         print(f"ERROR: Failed to authenticate with Google API: {e}")
         sys.exit(1)
 
 
+# the token cache file from the environment, or None if there isn't one or it's somewhere it shouldn't be
+def get_google_token_cache_path():
+    token_cache_path = os.environ.get(GOOGLE_TOKEN_CACHE_ENV_VAR)
+    if not token_cache_path:
+        return None
+    token_cache_path = os.path.abspath(token_cache_path)
+    cache_dir = os.path.abspath(local_cache.CACHE_DIR)
+    if os.path.commonpath([token_cache_path, cache_dir]) == cache_dir:
+        print(f"WARNING: Not caching the Google access token in the local cache directory {cache_dir}, since that gets "
+              f"uploaded with it. Set {GOOGLE_TOKEN_CACHE_ENV_VAR} to a path outside of it.")
+        return None
+    return token_cache_path
+
+
+# returns whether creds got a cached access token that's still good for a while
+def load_cached_google_token(creds, token_cache_path):
+    try:
+        with open(token_cache_path, encoding="utf-8") as f:
+            cached_token = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        print(f"WARNING: Ignoring unreadable Google access token cache: {e}")
+        return False
+    if not isinstance(cached_token, dict) or cached_token.get("email") != creds.service_account_email or \
+            cached_token.get("scopes") != _SCOPES:
+        return False
+    try:
+        # google-auth works with naive utc times
+        expiry = datetime.datetime.fromisoformat(cached_token["expiry"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    if expiry - utcnow() < datetime.timedelta(seconds=GOOGLE_TOKEN_MIN_SECONDS_LEFT):
+        return False
+
+    creds.token = cached_token["token"]
+    creds.expiry = expiry
+    return True
+
+
+# gets a new access token now instead of on the first request, so it can be cached for the next runs
+def refresh_google_token(creds, token_cache_path):
+    # noinspection PyPackageRequirements
+    import google.auth.transport.requests
+
+    creds.refresh(google.auth.transport.requests.Request())
+    timing.count("google_token_refreshes")
+
+    cached_token = {
+        "email": creds.service_account_email,
+        "scopes": _SCOPES,
+        "token": creds.token,
+        "expiry": creds.expiry.isoformat(),
+    }
+    # create the temp file owner-only from the start, so the token is never readable by anyone else, even briefly
+    tmp_path = f"{token_cache_path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(token_cache_path), exist_ok=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w", encoding="utf-8") as f:
+            json.dump(cached_token, f)
+        os.replace(tmp_path, token_cache_path)
+    except OSError as e:
+        print(f"WARNING: Could not cache Google access token: {e}")
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+# response hook for the gspread session, so every run knows how much of its quota it used
+def count_google_api_response(response, *_args, **_kwargs):
+    timing.count("google_api_calls")
+    # read the body first, then ask urllib3 how many (possibly compressed) bytes that took over the wire
+    num_bytes = len(response.content)
+    try:
+        num_bytes = response.raw.tell() or num_bytes
+    except (AttributeError, OSError):
+        pass
+    timing.count("google_bytes_downloaded", num_bytes)
+
+
+# returns (state_sheet, state_table, previous_state, metadata), where metadata is the StateMetadata saved next to the
+# state (see state_metadata.py)
 def load_previous_state_from_state_sheet():
-    state_sheet_id = os.environ.get('STATE_SHEET_ID')
+    import gspread
+
+    state_sheet_id = lists.current().state_sheet_id
 
     gc = get_gspread_client()
-    previous_state = {}
+    previous_state = ClearState()
 
     try:
         state_sheet = gc.open_by_key(state_sheet_id)
 
-        state_table = state_sheet.sheet1.get_all_values()
+        # both worksheets are read in a single request
+        worksheets = state_sheet.worksheets()
+        state_worksheet = get_state_worksheet(worksheets)
+        metadata_worksheet = next(
+            (worksheet for worksheet in worksheets if worksheet.title == METADATA_WORKSHEET_TITLE), None)
+        ranges = [gspread.utils.absolute_range_name(state_worksheet.title)]
+        if metadata_worksheet is not None:
+            ranges.append(gspread.utils.absolute_range_name(metadata_worksheet.title))
+        value_ranges = state_sheet.values_batch_get(ranges)["valueRanges"]
+
+        # pad the rows to the same width like get_all_values does
+        state_values = value_ranges[0].get("values", [])
+        state_table = gspread.utils.fill_gaps(state_values) if state_values else []
+        if metadata_worksheet is not None:
+            metadata = StateMetadata(metadata_worksheet.title, metadata_worksheet.id, metadata_worksheet.row_count,
+                                     value_ranges[1].get("values", []))
+        else:
+            metadata = StateMetadata()
 
         if not state_table:
             print("State sheet is empty; initializing empty state.")
-            return state_sheet, {}
+            return state_sheet, state_table, previous_state, metadata
         if len(state_table) < MIN_REQUIRED_ROWS:
             print(f"ERROR: State sheet has too few rows ({len(state_table)})")
             sys.exit(1)
@@ -67,7 +204,7 @@ def load_previous_state_from_state_sheet():
             if data_row and data_row[0]:
                 helpers.parse_data_row(data_row, 1, previous_state, player_names)
 
-        return state_sheet, previous_state
+        return state_sheet, state_table, previous_state, metadata
 
     except gspread.exceptions.SpreadsheetNotFound:
         print(f"ERROR: Could not find state sheet: {state_sheet_id}")
@@ -78,16 +215,183 @@ def load_previous_state_from_state_sheet():
         sys.exit(1)
 
 
+# the state is the first worksheet of the state sheet that isn't the metadata one (see state_metadata.py), wherever
+# that is in the order. the saves look it up again every time, since its size changes with every save.
+def get_state_worksheet(worksheets):
+    return next(worksheet for worksheet in worksheets if worksheet.title != METADATA_WORKSHEET_TITLE)
+
+
+# loads the state sheet, the clears page and (optionally) the cld page at the same time, since each of them is mostly
+# spent waiting on google. the clears and cld pages come from the same spreadsheet, so they're read in a single request.
+# returns (state_sheet, state_table, previous_state, metadata) or None if load_previous_state is False, then the clears
+# page (see load_current_clears_from_main_sheet), then the cld page (see load_cld_from_main_sheet) or None if load_cld
+# is False or the cld page failed to load.
+def load_pages_concurrently(load_previous_state=True, load_cld=False):
+    # authenticate once up front instead of letting every thread race to do it
+    get_gspread_client()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        saved_state_future = (lists.submit_in_context(executor, load_previous_state_from_state_sheet)
+                              if load_previous_state else None)
+        main_sheet_future = lists.submit_in_context(executor, load_clears_and_maybe_cld_from_main_sheet, load_cld)
+
+        saved_state = saved_state_future.result() if saved_state_future is not None else None
+        current_clears, cld = main_sheet_future.result()
+
+    return saved_state, current_clears, cld
+
+
+def load_clears_and_maybe_cld_from_main_sheet(load_cld):
+    if load_cld:
+        try:
+            return load_pages_from_main_sheet(load_clears=True, load_cld=True)
+        except (Exception, SystemExit):
+            # the cld page is only a speculative prefetch, it'll be loaded again if it's actually needed
+            print("WARNING: Failed to prefetch the CLD page, will load it later if needed.")
+
+    current_clears, _ = load_pages_from_main_sheet(load_clears=True)
+    return current_clears, None
+
+
+# the drive modified time of the main sheet, which changes whenever any page in it is edited. returns None if it can't
+# be fetched, in which case callers should assume the sheet changed.
+def get_main_sheet_modified_time():
+    clears_sheet_id = lists.current().clears_sheet_id
+
+    try:
+        return get_gspread_client().get_file_drive_metadata(clears_sheet_id)["modifiedTime"]
+    except Exception as e:
+        print(f"WARNING: Failed to get the modified time of the main sheet: {e}")
+        return None
+
+
+# returns (player names row, map rows), where the map rows start at the list's first_real_map_row_index. see
+# clears.get_current_state_and_maps_from_clears_rows.
 def load_current_clears_from_main_sheet():
-    return load_page_from_main_sheet(CLEARS_PAGE_NAME)
+    current_clears, _ = load_pages_from_main_sheet(load_clears=True)
+    return current_clears
 
 
+# returns a list of star groups (one per star difficulty of the list), each a list of [map name, c tier, fc tier] rows
+# starting at the list's cld_first_tier_row_index. see goldens.parse_golden_tiers.
 def load_cld_from_main_sheet():
-    return load_page_from_main_sheet(CLD_PAGE_NAME)
+    _, cld = load_pages_from_main_sheet(load_cld=True)
+    return cld
+
+
+# reads only the ranges of the clears and/or cld pages that the parsers actually use, in a single batchGet request.
+# returns the clears page and the cld page in the formats above, or None for the ones that weren't requested.
+def load_pages_from_main_sheet(load_clears=False, load_cld=False):
+    import gspread
+
+    list_config = lists.current()
+    clears_sheet_id = list_config.clears_sheet_id
+
+    gc = get_gspread_client()
+
+    try:
+        clears_ranges = get_clears_ranges() if load_clears else []
+        cld_ranges = get_cld_ranges() if load_cld else []
+        value_ranges = gc.http_client.values_batch_get(clears_sheet_id, clears_ranges + cld_ranges)["valueRanges"]
+    except gspread.exceptions.SpreadsheetNotFound:
+        print(f"ERROR: Could not find main sheet: {clears_sheet_id}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"ERROR: Failed to read target sheet: {e}")
+        sys.exit(1)
+
+    current_clears = None
+    if load_clears:
+        header_range, map_rows_range = value_ranges[:len(clears_ranges)]
+        header_rows = header_range.get("values", [])
+        player_names = header_rows[0] if header_rows else []
+        if len(player_names) > get_main_sheet_grid_sizes()[list_config.clears_page_name][1]:
+            # the page got wider since we got its size (e.g. in watch mode), so we'd be missing the new players
+            fetch_main_sheet_grid_sizes.cache_clear()
+            return load_pages_from_main_sheet(load_clears, load_cld)
+        current_clears = (player_names, normalize_rows(map_rows_range.get("values", []), 1))
 
+    cld = None
+    if load_cld:
+        cld = [normalize_rows(cld_range.get("values", []),
+                              list_config.cld_info_end_offset - list_config.cld_map_name_offset)
+               for cld_range in value_ranges[len(clears_ranges):]]
 
+    return current_clears, cld
+
+
+# the api leaves out trailing empty cells and rows, which get_all_values used to pad back in. pad every row to at
+# least min_width cells so the parsers can index them, and so that empty rows (which separate the star difficulties in
+# the clears page) still have an empty map name.
+def normalize_rows(rows, min_width):
+    for i, row in enumerate(rows):
+        if len(row) < min_width:
+            rows[i] = row + [""] * (min_width - len(row))
+    return rows
+
+
+# the player names row and every map row, only up to the last column of the page
+def get_clears_ranges():
+    import gspread
+
+    list_config = lists.current()
+    _, col_count = get_main_sheet_grid_sizes()[list_config.clears_page_name]
+    last_col = gspread.utils.rowcol_to_a1(1, col_count).rstrip("0123456789")
+    return [
+        gspread.utils.absolute_range_name(list_config.clears_page_name, "1:1"),
+        gspread.utils.absolute_range_name(list_config.clears_page_name,
+                                          f"A{list_config.first_real_map_row_index + 1}:{last_col}"),
+    ]
+
+
+# the map name and tier columns of every star group, without the other columns in between
+def get_cld_ranges():
+    import gspread
+
+    list_config = lists.current()
+    cld_ranges = []
+    for i in range(list_config.max_star_difficulty):
+        first_col_i = list_config.cld_cols_per_star * i + list_config.cld_map_name_offset
+        first_cell = gspread.utils.rowcol_to_a1(list_config.cld_first_tier_row_index + 1, first_col_i + 1)
+        last_col = gspread.utils.rowcol_to_a1(
+            1, list_config.cld_cols_per_star * i + list_config.cld_info_end_offset).rstrip("0123456789")
+        cld_ranges.append(gspread.utils.absolute_range_name(list_config.cld_page_name, f"{first_cell}:{last_col}"))
+    return cld_ranges
+
+
+# page title -> (row count, col count) of the current list's main sheet, fetched once with only the fields we need.
+# the row ranges above are open-ended, so only the column count can go stale, which load_pages_from_main_sheet checks
+# for.
+def get_main_sheet_grid_sizes():
+    list_config = lists.current()
+    return fetch_main_sheet_grid_sizes(list_config.clears_sheet_id, list_config.clears_page_name,
+                                       list_config.cld_page_name)
+
+
+@functools.cache
+def fetch_main_sheet_grid_sizes(clears_sheet_id, clears_page_name, cld_page_name):
+    metadata = get_gspread_client().http_client.fetch_sheet_metadata(clears_sheet_id, params={
+        "fields": "sheets.properties(title,gridProperties(rowCount,columnCount))",
+    })
+    grid_sizes = {}
+    for sheet in metadata.get("sheets", []):
+        properties = sheet["properties"]
+        grid_properties = properties.get("gridProperties", {})
+        grid_sizes[properties["title"]] = (grid_properties.get("rowCount", 0), grid_properties.get("columnCount", 0))
+
+    for page_name in (clears_page_name, cld_page_name):
+        if page_name not in grid_sizes:
+            print(f"ERROR: Worksheet '{page_name}' not found in sheet '{clears_sheet_id}'.")
+            sys.exit(1)
+
+    return grid_sizes
+
+
+# reads a whole page of the main sheet, for when the exact layout isn't known yet (e.g. in the test notebooks)
 def load_page_from_main_sheet(page_name):
-    clears_sheet_id = os.environ.get('CLEARS_SHEET_ID')
+    import gspread
+
+    clears_sheet_id = lists.current().clears_sheet_id
 
     gc = get_gspread_client()
 
@@ -103,15 +407,162 @@ def load_page_from_main_sheet(page_name):
         sys.exit(1)
 
 
-def save_clears_to_state_sheet(state_sheet, state_grid):
+# metadata_update is (metadata, sections, new_values) to also replace those sections of the state's metadata (see
+# StateMetadata.get_updates), or None. exits if the state couldn't be written. returns whether everything after that
+# worked too: if clearing what's left of a bigger previous grid or saving the metadata fails, the new state is still
+# saved (so its messages should still be sent), but without metadata, and what's in the state sheet has to be loaded
+# again to be known for sure.
+def save_clears_to_state_sheet(state_sheet, state_grid, metadata_update=None):
+    import gspread
+
     try:
+        worksheet = get_state_worksheet(state_sheet.worksheets())
+
+        # forget the old metadata first, so if we die halfway the next run doesn't trust it with the new state
+        if metadata_update is not None:
+            metadata, sections, _ = metadata_update
+            write_state_metadata_updates(state_sheet, worksheet, metadata, sections, {})
+
         num_rows = len(state_grid)
         num_cols = len(state_grid[0])
         range_end = gspread.utils.rowcol_to_a1(num_rows, num_cols)
 
-        state_sheet.sheet1.clear()
-        state_sheet.sheet1.update(range_name=f'A1:{range_end}', values=state_grid, value_input_option='USER_ENTERED')
-        print("Successfully saved new state.")
+        # write first and only then clear whatever is left over from a bigger previous grid, so the state sheet is never
+        # empty in between (if we die halfway, the next run still has a usable, if slightly stale, state)
+        worksheet.update(range_name=f'A1:{range_end}', values=state_grid, value_input_option='USER_ENTERED')
+        timing.count("state_cells_written", num_rows * num_cols)
     except Exception as e:
         print(f"ERROR: Could not save state to sheet: {e}")
         sys.exit(1)
+
+    try:
+        leftover_ranges = []
+        if worksheet.row_count > num_rows:
+            leftover_ranges.append(f"{num_rows + 1}:{worksheet.row_count}")
+        if worksheet.col_count > num_cols:
+            first_leftover_col = gspread.utils.rowcol_to_a1(1, num_cols + 1).rstrip("0123456789")
+            last_col = gspread.utils.rowcol_to_a1(1, worksheet.col_count).rstrip("0123456789")
+            leftover_ranges.append(f"{first_leftover_col}:{last_col}")
+        if leftover_ranges:
+            worksheet.batch_clear(leftover_ranges)
+
+        if metadata_update is not None:
+            write_state_metadata_updates(state_sheet, worksheet, *metadata_update)
+    except Exception as e:
+        # the metadata was already forgotten above, so the next run won't trust any of it
+        print(f"WARNING: Saved new state, but could not finish saving the state sheet: {e}")
+        return False
+    print("Successfully saved new state.")
+    return True
+
+
+# applies the output of clears.get_state_grid_updates: at most one structural request (deleting and appending rows/cols)
+# and one values request covering only the changed cells. metadata_update is like in save_clears_to_state_sheet, and
+# its changed cells go in the same values request as the state's, so they're saved together or not at all. exits if
+# they couldn't be saved.
+def save_clear_updates_to_state_sheet(state_sheet, grid_updates, metadata_update=None):
+    try:
+        state_worksheet = get_state_worksheet(state_sheet.worksheets())
+        num_cells_written = write_state_updates(state_sheet, state_worksheet, grid_updates, metadata_update)
+        print(f"Successfully saved new state ({num_cells_written} cells updated).")
+    except Exception as e:
+        print(f"ERROR: Could not save state updates to sheet: {e}")
+        sys.exit(1)
+
+
+# saves only the metadata, for when it changed but the state didn't
+def save_state_metadata(state_sheet, metadata, sections, new_values):
+    try:
+        write_state_metadata_updates(state_sheet, get_state_worksheet(state_sheet.worksheets()), metadata, sections,
+                                     new_values)
+        print("Successfully saved state metadata.")
+    except Exception as e:
+        print(f"ERROR: Could not save state metadata to sheet: {e}")
+        sys.exit(1)
+
+
+def write_state_metadata_updates(state_sheet, state_worksheet, metadata, sections, new_values):
+    write_state_updates(state_sheet, state_worksheet, ([], [], 0, 0, []), (metadata, sections, new_values))
+
+
+# state_worksheet is the one get_state_worksheet found. returns the number of state cells written.
+def write_state_updates(state_sheet, state_worksheet, grid_updates, metadata_update):
+    import gspread
+
+    deleted_row_indices, deleted_col_indices, num_appended_rows, num_appended_cols, cell_updates = grid_updates
+
+    dimension_requests = []
+
+    # delete from the bottom/right up so earlier deletions don't shift the indices of later ones
+    for dimension, deleted_indices in (("ROWS", deleted_row_indices), ("COLUMNS", deleted_col_indices)):
+        for i in sorted(deleted_indices, reverse=True):
+            dimension_requests.append({"deleteDimension": {"range": {
+                "sheetId": state_worksheet.id, "dimension": dimension, "startIndex": i, "endIndex": i + 1,
+            }}})
+
+    # the grid might have spare rows/cols already, so only append what we're actually short of
+    for dimension, grid_size, num_deleted, num_used, num_appended in (
+            ("ROWS", state_worksheet.row_count, len(deleted_row_indices), cell_updates_extent(cell_updates, 0),
+             num_appended_rows),
+            ("COLUMNS", state_worksheet.col_count, len(deleted_col_indices), cell_updates_extent(cell_updates, 1),
+             num_appended_cols)):
+        missing = num_used - (grid_size - num_deleted)
+        if num_appended and missing > 0:
+            dimension_requests.append({"appendDimension": {
+                "sheetId": state_worksheet.id, "dimension": dimension, "length": missing,
+            }})
+
+    metadata_cell_updates = []
+    if metadata_update is not None:
+        metadata, sections, new_values = metadata_update
+        metadata_cell_updates, num_metadata_rows = metadata.get_updates(sections, new_values)
+        if metadata_cell_updates:
+            dimension_requests += get_metadata_dimension_requests(metadata, num_metadata_rows)
+
+    if dimension_requests:
+        response = state_sheet.batch_update({"requests": dimension_requests})
+        for reply in response.get("replies", []):
+            if "addSheet" in reply:
+                properties = reply["addSheet"]["properties"]
+                metadata.worksheet_title = properties["title"]
+                metadata.worksheet_id = properties["sheetId"]
+
+    value_ranges = [
+        {"range": gspread.utils.absolute_range_name(state_worksheet.title,
+                                                    gspread.utils.rowcol_to_a1(row_i + 1, col_i + 1)),
+         "values": [[value]]}
+        for row_i, col_i, value in cell_updates
+    ]
+    value_ranges += [
+        {"range": gspread.utils.absolute_range_name(METADATA_WORKSHEET_TITLE,
+                                                    gspread.utils.rowcol_to_a1(row_i + 1, col_i + 1)),
+         "values": [[value]]}
+        for row_i, col_i, value in metadata_cell_updates
+    ]
+    if value_ranges:
+        state_sheet.values_batch_update({"valueInputOption": "USER_ENTERED", "data": value_ranges})
+        timing.count("state_cells_written", len(cell_updates))
+        timing.count("metadata_cells_written", len(metadata_cell_updates))
+
+    if metadata_cell_updates:
+        metadata.apply_updates(metadata_cell_updates, num_metadata_rows)
+    return len(cell_updates)
+
+
+# the structural requests that make the metadata worksheet at least num_rows rows long, creating it if needed
+def get_metadata_dimension_requests(metadata, num_rows):
+    if metadata.worksheet_title is None:
+        return [{"addSheet": {"properties": {
+            "title": METADATA_WORKSHEET_TITLE,
+            "gridProperties": {"rowCount": num_rows, "columnCount": METADATA_NUM_COLS},
+        }}}]
+    if num_rows > metadata.row_count:
+        return [{"appendDimension": {
+            "sheetId": metadata.worksheet_id, "dimension": "ROWS", "length": num_rows - metadata.row_count,
+        }}]
+    return []
+
+
+# number of rows (axis 0) or cols (axis 1) needed to hold every cell update
+def cell_updates_extent(cell_updates, axis):
+    return max((cell_update[axis] + 1 for cell_update in cell_updates), default=0)
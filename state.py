@@ -0,0 +1,210 @@
+import array
+import bisect
+from collections.abc import ItemsView, MutableMapping
+
+
+# assigns every distinct name a small integer id, so the state only has to store (and hash) each name once
+class InternTable:
+    __slots__ = ("names", "ids")
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = name_id
+        return name_id
+
+
+# the cells of one map, as two parallel arrays sorted by player id
+class StateRow:
+    __slots__ = ("player_ids", "value_ids")
+
+    def __init__(self):
+        self.player_ids = array.array("I")
+        self.value_ids = array.array("I")
+
+    def __len__(self):
+        return len(self.player_ids)
+
+    def find(self, player_id):
+        i = bisect.bisect_left(self.player_ids, player_id)
+        return i, i < len(self.player_ids) and self.player_ids[i] == player_id
+
+
+# a normal items view, except that iterating over it walks the rows directly instead of looking every key up again
+class ClearStateItemsView(ItemsView):
+    __slots__ = ()
+
+    def __iter__(self):
+        state = self._mapping
+        player_names = state.players.names
+        value_names = state.values.names
+        for map_name, row in zip(state.maps.names, state.rows):
+            for player_id, value_id in zip(row.player_ids, row.value_ids):
+                yield (player_names[player_id], map_name), value_names[value_id]
+
+
+# a sparse players x maps grid of non-empty cell values. behaves like the {(player_name, map_name): value} dict it
+# replaces, but player names, map names and cell values are interned, and every map's cells live in a StateRow, so
+# memory grows with the number of non-empty cells instead of with per-key tuples and strings.
+# players and maps stay interned after their last cell is removed, but only ones with cells show up in keys(),
+# player_names() and map_names().
+class ClearState(MutableMapping):
+    __slots__ = ("players", "maps", "values", "rows", "player_cell_counts", "_len")
+
+    def __init__(self, items=()):
+        self.players = InternTable()
+        self.maps = InternTable()
+        self.values = InternTable()
+        # indexed by map id
+        self.rows = []
+        # indexed by player id
+        self.player_cell_counts = array.array("I")
+        self._len = 0
+        self.update(items)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, key):
+        player_name, map_name = key
+        player_id = self.players.ids.get(player_name)
+        map_id = self.maps.ids.get(map_name)
+        if player_id is not None and map_id is not None:
+            row = self.rows[map_id]
+            i, found = row.find(player_id)
+            if found:
+                return self.values.names[row.value_ids[i]]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        player_name, map_name = key
+        # look the ids up directly first, since this is called for every cell and nearly every name already exists
+        player_id = self.players.ids.get(player_name)
+        if player_id is None:
+            player_id = self.intern_player(player_name)
+        map_id = self.maps.ids.get(map_name)
+        if map_id is None:
+            map_id = self.intern_map(map_name)
+        value_id = self.values.ids.get(value)
+        if value_id is None:
+            value_id = self.values.intern(value)
+        row = self.rows[map_id]
+
+        # cells are almost always added in increasing player order, so check for that before bisecting
+        if not row.player_ids or row.player_ids[-1] < player_id:
+            i, found = len(row.player_ids), False
+        else:
+            i, found = row.find(player_id)
+
+        if found:
+            row.value_ids[i] = value_id
+        else:
+            row.player_ids.insert(i, player_id)
+            row.value_ids.insert(i, value_id)
+            self.player_cell_counts[player_id] += 1
+            self._len += 1
+
+    def __delitem__(self, key):
+        player_name, map_name = key
+        player_id = self.players.ids.get(player_name)
+        map_id = self.maps.ids.get(map_name)
+        if player_id is not None and map_id is not None:
+            row = self.rows[map_id]
+            i, found = row.find(player_id)
+            if found:
+                del row.player_ids[i]
+                del row.value_ids[i]
+                self.player_cell_counts[player_id] -= 1
+                self._len -= 1
+                return
+        raise KeyError(key)
+
+    def __iter__(self):
+        player_names = self.players.names
+        for map_name, row in zip(self.maps.names, self.rows):
+            for player_id in row.player_ids:
+                yield player_names[player_id], map_name
+
+    def __repr__(self):
+        return f"ClearState({dict(self.items())!r})"
+
+    def items(self):
+        return ClearStateItemsView(self)
+
+    def intern_player(self, player_name):
+        player_id = self.players.intern(player_name)
+        if player_id == len(self.player_cell_counts):
+            self.player_cell_counts.append(0)
+        return player_id
+
+    def intern_map(self, map_name):
+        map_id = self.maps.intern(map_name)
+        if map_id == len(self.rows):
+            self.rows.append(StateRow())
+        return map_id
+
+    # returns an independent copy. the interned names are shared, but every table and row is copied.
+    def copy(self):
+        state = ClearState()
+        for table_name in ("players", "maps", "values"):
+            table = getattr(self, table_name)
+            copied_table = getattr(state, table_name)
+            copied_table.names = table.names.copy()
+            copied_table.ids = table.ids.copy()
+        for row in self.rows:
+            copied_row = StateRow()
+            copied_row.player_ids = row.player_ids[:]
+            copied_row.value_ids = row.value_ids[:]
+            state.rows.append(copied_row)
+        state.player_cell_counts = self.player_cell_counts[:]
+        state._len = self._len
+        return state
+
+    # (player_name, value) of every cell of one map
+    def row_items(self, map_name):
+        map_id = self.maps.ids.get(map_name)
+        if map_id is None:
+            return
+        player_names = self.players.names
+        value_names = self.values.names
+        row = self.rows[map_id]
+        for player_id, value_id in zip(row.player_ids, row.value_ids):
+            yield player_names[player_id], value_names[value_id]
+
+    # removes every cell of one map
+    def clear_row(self, map_name):
+        map_id = self.maps.ids.get(map_name)
+        if map_id is None:
+            return
+        row = self.rows[map_id]
+        for player_id in row.player_ids:
+            self.player_cell_counts[player_id] -= 1
+        self._len -= len(row)
+        self.rows[map_id] = StateRow()
+
+    # number of cells of one player
+    def player_cell_count(self, player_name):
+        player_id = self.players.ids.get(player_name)
+        return self.player_cell_counts[player_id] if player_id is not None else 0
+
+    # number of cells of one map
+    def map_cell_count(self, map_name):
+        map_id = self.maps.ids.get(map_name)
+        return len(self.rows[map_id]) if map_id is not None else 0
+
+    # names of players with at least one cell
+    def player_names(self):
+        return [player_name for player_name, count in zip(self.players.names, self.player_cell_counts) if count]
+
+    # names of maps with at least one cell
+    def map_names(self):
+        return [map_name for map_name, row in zip(self.maps.names, self.rows) if row]
@@ -0,0 +1,78 @@
+METADATA_WORKSHEET_TITLE = "histcord_metadata"
+METADATA_NUM_COLS = 3
+
+
+# key/value pairs saved next to the state in their own worksheet of the state sheet, one [section, key, value] row
+# each, so they're always loaded and saved together with the state they describe. rows keep their position between
+# saves, so saving only has to write the rows that changed. removed rows are blanked and reused later.
+class StateMetadata:
+    def __init__(self, worksheet_title=None, worksheet_id=None, row_count=0, rows=()):
+        # None if the worksheet doesn't exist yet
+        self.worksheet_title = worksheet_title
+        self.worksheet_id = worksheet_id
+        self.row_count = row_count
+        self.load_rows(rows)
+
+    def load_rows(self, rows):
+        # (section, key) -> value
+        self.values = {}
+        # (section, key) -> row index
+        self.row_indices = {}
+        self.free_row_indices = []
+        self.num_rows = 0
+
+        for row_i, row in enumerate(rows):
+            row = list(row) + [""] * (METADATA_NUM_COLS - len(row))
+            section, key, value = row[:METADATA_NUM_COLS]
+            if section:
+                self.values[section, key] = value
+                self.row_indices[section, key] = row_i
+            else:
+                self.free_row_indices.append(row_i)
+            self.num_rows = row_i + 1
+
+    def get(self, section, key, default=None):
+        return self.values.get((section, key), default)
+
+    # key -> value for every entry of one section
+    def section(self, section):
+        return {key: value for (entry_section, key), value in self.values.items() if entry_section == section}
+
+    # works out how to replace every entry of the given sections with new_values ({(section, key): value}, which may
+    # only have entries of those sections). returns (cell updates as (row index, col index, value), rows needed). the
+    # cell updates are for the metadata worksheet and 0-based. call apply_updates once they're saved.
+    def get_updates(self, sections, new_values):
+        cell_updates = []
+        free_row_indices = list(self.free_row_indices)
+        num_rows = self.num_rows
+
+        for entry, row_i in self.row_indices.items():
+            if entry[0] in sections and entry not in new_values:
+                cell_updates += [(row_i, col_i, "") for col_i in range(METADATA_NUM_COLS)]
+                free_row_indices.append(row_i)
+
+        free_row_indices.sort(reverse=True)
+        for (section, key), value in new_values.items():
+            row_i = self.row_indices.get((section, key))
+            if row_i is not None:
+                if self.values[section, key] != value:
+                    cell_updates.append((row_i, 2, value))
+                continue
+            if free_row_indices:
+                row_i = free_row_indices.pop()
+            else:
+                row_i = num_rows
+                num_rows += 1
+            cell_updates += [(row_i, 0, section), (row_i, 1, key), (row_i, 2, value)]
+
+        return cell_updates, num_rows
+
+    # updates the in-memory copy after the updates from get_updates were saved
+    def apply_updates(self, cell_updates, num_rows):
+        rows = [[""] * METADATA_NUM_COLS for _ in range(num_rows)]
+        for (section, key), row_i in self.row_indices.items():
+            rows[row_i] = [section, key, self.values[section, key]]
+        for row_i, col_i, value in cell_updates:
+            rows[row_i][col_i] = value
+        self.row_count = max(self.row_count, num_rows)
+        self.load_rows(rows)
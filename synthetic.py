@@ -0,0 +1,126 @@
+import itertools
+import random
+
+from constants import FIRST_REAL_MAP_ROW_INDEX, MIN_PLAYER_COL_INDEX, MAX_STAR_DIFFICULTY, CLD_INFO_END_OFFSET, \
+    CLD_MAP_NAME_OFFSET
+
+# fake but realistically shaped clears pages, cld pages and states for benchmarking (see benchmark.py). everything is
+# seeded, so the same arguments always give the same list.
+
+# cell values and how often they show up, roughly like the real list
+CELL_VALUE_WEIGHTS = [
+    ("V", 40), ("NV", 15), ("FC", 10), ("V FC", 5), ("NV FC", 3), ("V1 V2", 3), ("G", 2), ("G & FC", 1), ("FCG", 1),
+    ("S", 1), ("S1 S2 & FC", 1), ("Creator", 1), ("Creator [FC]", 1),
+]
+CELL_VALUES = [value for value, _ in CELL_VALUE_WEIGHTS]
+CELL_VALUE_CUM_WEIGHTS = list(itertools.accumulate(weight for _, weight in CELL_VALUE_WEIGHTS))
+
+TIERS = ["Tier 1", "Tier 2", "Tier 3", "Tier 4", "Tier 5", "Tier 6", "Tier 7", "Untiered", "Undetermined"]
+
+
+def random_cell_value(rng):
+    return rng.choices(CELL_VALUES, cum_weights=CELL_VALUE_CUM_WEIGHTS)[0]
+
+
+# map names for every star difficulty, from hardest to easiest like in the clears page. fc_pair_fraction of the maps
+# come as a [C]/[FC] pair.
+def make_map_names(num_maps, fc_pair_fraction, rng):
+    map_names_by_star = [[] for _ in range(MAX_STAR_DIFFICULTY)]
+    map_i = 0
+    while map_i < num_maps:
+        star_i = map_i * MAX_STAR_DIFFICULTY // num_maps
+        base_name = f"Map {map_i}"
+        author = f"Author {rng.randrange(max(num_maps // 4, 1))}"
+        if rng.random() < fc_pair_fraction and map_i + 1 < num_maps:
+            map_names_by_star[star_i] += [f"{base_name} [C] by {author}", f"{base_name} [FC] by {author}"]
+            map_i += 2
+        else:
+            map_names_by_star[star_i].append(f"{base_name} by {author}")
+            map_i += 1
+    return map_names_by_star
+
+
+# returns a clears page as get_all_values would: the player names row, filler rows up to FIRST_REAL_MAP_ROW_INDEX, then
+# every star difficulty's maps followed by two empty rows. fill is the fraction of cells with a clear in them, but
+# easier maps get more clears than harder ones.
+def make_clears_page(num_players, num_maps, fill=0.05, fc_pair_fraction=0.3, seed=0):
+    rng = random.Random(seed)
+    width = MIN_PLAYER_COL_INDEX + num_players
+
+    header_row = [""] * MIN_PLAYER_COL_INDEX + [f"Player {i}" for i in range(num_players)]
+    page = [header_row] + [[""] * width for _ in range(FIRST_REAL_MAP_ROW_INDEX - 1)]
+
+    for star_i, map_names in enumerate(make_map_names(num_maps, fc_pair_fraction, rng)):
+        # star_i 0 is the hardest difficulty
+        map_fill = min(fill * 2 * (star_i + 1) / MAX_STAR_DIFFICULTY, 1)
+        num_clears = round(map_fill * num_players)
+        for map_name in map_names:
+            row = [map_name] + [""] * (width - 1)
+            for player_i in rng.sample(range(num_players), num_clears):
+                row[MIN_PLAYER_COL_INDEX + player_i] = random_cell_value(rng)
+            page.append(row)
+        page += [[""] * width, [""] * width]
+
+    return page
+
+
+# returns a copy of the clears page with edit_fraction of its clears changed (a third each removed, changed to another
+# value and added somewhere else) and rename_fraction of its players and maps renamed
+def edit_clears_page(page, edit_fraction=0.01, rename_fraction=0.005, seed=0):
+    rng = random.Random(seed)
+    page = [list(row) for row in page]
+    map_row_indices = [i for i in range(FIRST_REAL_MAP_ROW_INDEX, len(page)) if page[i][0]]
+    num_players = len(page[0]) - MIN_PLAYER_COL_INDEX
+
+    filled_cells = [(row_i, col_i) for row_i in map_row_indices
+                    for col_i in range(MIN_PLAYER_COL_INDEX, len(page[row_i])) if page[row_i][col_i]]
+    num_edits = round(edit_fraction * len(filled_cells))
+    for i, (row_i, col_i) in enumerate(rng.sample(filled_cells, min(num_edits, len(filled_cells)))):
+        if i % 3 == 0:
+            page[row_i][col_i] = ""
+        elif i % 3 == 1:
+            page[row_i][col_i] = random_cell_value(rng)
+        elif num_players:
+            page[rng.choice(map_row_indices)][MIN_PLAYER_COL_INDEX + rng.randrange(num_players)] = \
+                random_cell_value(rng)
+
+    for col_i in rng.sample(range(MIN_PLAYER_COL_INDEX, len(page[0])), round(rename_fraction * num_players)):
+        page[0][col_i] += " (renamed)"
+    for row_i in rng.sample(map_row_indices, round(rename_fraction * len(map_row_indices))):
+        page[row_i][0] = "Renamed " + page[row_i][0]
+
+    return page
+
+
+# splits a clears page into what sheets.load_current_clears_from_main_sheet returns
+def clears_page_to_rows(page):
+    return page[0], page[FIRST_REAL_MAP_ROW_INDEX:]
+
+
+# returns cld star groups (see sheets.load_cld_from_main_sheet) for the maps in a clears page, giving tier_fraction of
+# them a golden tier
+def make_cld(page, tier_fraction=1.0, seed=0):
+    rng = random.Random(seed)
+    width = CLD_INFO_END_OFFSET - CLD_MAP_NAME_OFFSET
+    cld = [[] for _ in range(MAX_STAR_DIFFICULTY)]
+    star_i = 0
+    previous_map_empty = False
+
+    for row in page[FIRST_REAL_MAP_ROW_INDEX:]:
+        map_name = row[0]
+        # two empty map names in a row means a new star difficulty, like in the clears parser
+        if not map_name:
+            if previous_map_empty:
+                star_i = min(star_i + 1, MAX_STAR_DIFFICULTY - 1)
+                previous_map_empty = False
+            else:
+                previous_map_empty = True
+            continue
+
+        cld_row = [map_name] + [""] * (width - 1)
+        if rng.random() < tier_fraction:
+            cld_row[1] = rng.choice(TIERS)
+            cld_row[2] = rng.choice(["", "<<<", rng.choice(TIERS)])
+        cld[star_i].append(cld_row)
+
+    return cld
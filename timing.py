@@ -1,21 +1,244 @@
+import contextvars
+import datetime
+import json
+import os
+import re
+import threading
 import time
 
+RUN_REPORT_FILE_NAME = "run_report.json"
+PROMETHEUS_FILE_NAME = "metrics.prom"
+PROMETHEUS_PREFIX = "histcord"
 
+# every Timer is a span in a tree of spans for the current run (see start_run). counters added with count() go to the
+# run's totals and to every span that's open at the time. the open spans belong to the current context, so worker
+# threads started with lists.submit_in_context count to whatever their caller is waiting on, and every list that's
+# checked in its own thread (see start_branch) gets its own spans under the run's.
+
+
+class Span:
+    __slots__ = ("name", "start_time", "duration", "children", "counters")
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.perf_counter()
+        self.duration = None
+        self.children = []
+        self.counters = {}
+
+    def elapsed(self):
+        return self.duration if self.duration is not None else time.perf_counter() - self.start_time
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "duration": self.elapsed(),
+            "counters": dict(self.counters),
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+_lock = threading.Lock()
+# the open spans, outermost (the run) first
+_span_stack = contextvars.ContextVar("span_stack", default=None)
+_run = None
+_run_started_at = None
+_run_counters = {}
+# whether the last thing a Timer printed was a loading message without a newline
+_line_open = contextvars.ContextVar("line_open", default=False)
+# what every Timer that's a stage is reported to while profiling (see profiling.py), otherwise None
+_profiler = None
+
+
+def get_span_stack():
+    span_stack = _span_stack.get()
+    if span_stack is None:
+        span_stack = []
+        _span_stack.set(span_stack)
+    return span_stack
+
+
+# starts a new run, forgetting the spans and counters of the previous one (e.g. between checks in watch mode)
+def start_run(name="run"):
+    global _run, _run_started_at
+    with _lock:
+        _run = Span(name)
+        _run_started_at = time.time()
+        _run_counters.clear()
+        _span_stack.set([_run])
+
+
+# gives the current context its own copy of the open spans, so the spans it opens nest under the ones that are open now
+# without getting mixed up with the spans of other threads doing the same (e.g. every list being checked at once)
+def start_branch():
+    with _lock:
+        _span_stack.set(list(get_span_stack()))
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def finish_run():
+    with _lock:
+        if _run is not None and _run.duration is None:
+            _run.duration = time.perf_counter() - _run.start_time
+        get_span_stack().clear()
+
+
+def count(name, amount=1):
+    with _lock:
+        _run_counters[name] = _run_counters.get(name, 0) + amount
+        for span in get_span_stack():
+            span.counters[name] = span.counters.get(name, 0) + amount
+
+
+def open_span(name):
+    span = Span(name)
+    with _lock:
+        span_stack = get_span_stack()
+        if span_stack:
+            span_stack[-1].children.append(span)
+        span_stack.append(span)
+    return span
+
+
+def close_span(span):
+    with _lock:
+        span.duration = time.perf_counter() - span.start_time
+        span_stack = get_span_stack()
+        if span in span_stack:
+            # also closes anything that was left open inside it
+            del span_stack[span_stack.index(span):]
+
+
+# "Loading previous and current states... " -> "loading_previous_and_current_states"
+def message_to_span_name(message):
+    return re.sub(r"[^a-z0-9]+", "_", message.lower()).strip("_") or "span"
+
+
+# stage is False for timers that only wrap other timers (the whole run, a list), which aren't worth profiling on their
+# own
 class Timer:
-    def __init__(self, loading_message, done_format_func=None):
+    def __init__(self, loading_message, done_format_func=None, name=None, stage=True):
         self.loading_message = loading_message
         self.done_format_func = done_format_func if done_format_func is not None else lambda d: f"Done in {d:.3f} sec!"
+        self.name = name if name is not None else message_to_span_name(loading_message)
+        self.stage = stage
+        self.span = None
         self.start_time = None
+        self.profiler = None
+        self.profiled_stage = None
 
     def __enter__(self):
+        # don't let a nested timer's message run into the end of ours
+        if _line_open.get():
+            print()
         print(self.loading_message, end="")
-        self.start_time = time.time()
+        _line_open.set(not self.loading_message.endswith("\n"))
+
+        # the profiler's own work happens outside of the span, so it doesn't count towards the stage's duration
+        self.profiler = _profiler
+        if self.profiler is not None and self.stage:
+            # the path the span will have, like in the prometheus file
+            path = "/".join([span.name for span in get_span_stack()[1:]] + [self.name])
+            self.profiled_stage = self.profiler.start_stage(path)
+
+        self.span = open_span(self.name)
+        self.start_time = self.span.start_time
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        end_time = time.time()
-        duration = end_time - self.start_time
+        close_span(self.span)
+        if self.profiled_stage is not None:
+            self.profiler.stop_stage(self.profiled_stage, self.span.duration)
+            self.profiled_stage = None
+
+        # if a nested timer printed in between, say again what's done
+        if not _line_open.get() and not self.loading_message.endswith("\n"):
+            print(self.loading_message, end="")
+        print(self.done_format_func(self.span.duration))
+        _line_open.set(False)
+
+        return False
+
+
+def get_run_report():
+    with _lock:
+        if _run is None:
+            return None
+        return {
+            "name": _run.name,
+            "started_at": datetime.datetime.fromtimestamp(_run_started_at, datetime.timezone.utc).isoformat(),
+            "duration": _run.elapsed(),
+            "counters": dict(_run_counters),
+            "spans": [child.to_dict() for child in _run.children],
+        }
+
+
+# writes the current run's report as json and as a prometheus text file (e.g. for node_exporter's textfile collector)
+# to metrics_dir. both are written to a temp file first, so a scraper never sees half a file.
+def write_run_report(metrics_dir):
+    report = get_run_report()
+    if report is None:
+        return
+
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        write_file_atomically(os.path.join(metrics_dir, RUN_REPORT_FILE_NAME), json.dumps(report, indent=2))
+        write_file_atomically(os.path.join(metrics_dir, PROMETHEUS_FILE_NAME), run_report_to_prometheus(report))
+    except OSError as e:
+        print(f"WARNING: Could not write run metrics to {metrics_dir}: {e}")
+
+
+def write_file_atomically(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def run_report_to_prometheus(report):
+    started_at = datetime.datetime.fromisoformat(report["started_at"]).timestamp()
+    lines = [
+        f"# HELP {PROMETHEUS_PREFIX}_run_start_timestamp_seconds When the last run started.",
+        f"# TYPE {PROMETHEUS_PREFIX}_run_start_timestamp_seconds gauge",
+        f"{PROMETHEUS_PREFIX}_run_start_timestamp_seconds {started_at:.3f}",
+        f"# HELP {PROMETHEUS_PREFIX}_run_duration_seconds How long the last run took.",
+        f"# TYPE {PROMETHEUS_PREFIX}_run_duration_seconds gauge",
+        f"{PROMETHEUS_PREFIX}_run_duration_seconds {report['duration']:.6f}",
+    ]
+
+    for counter_name, value in sorted(report["counters"].items()):
+        metric_name = f"{PROMETHEUS_PREFIX}_run_{message_to_span_name(counter_name)}"
+        lines += [
+            f"# HELP {metric_name} {counter_name} during the last run.",
+            f"# TYPE {metric_name} gauge",
+            f"{metric_name} {value}",
+        ]
+
+    # span path -> total duration. the same path can show up more than once, e.g. for a timer in a loop.
+    span_durations = {}
+
+    def add_span_durations(spans, parent_path):
+        for span in spans:
+            path = f"{parent_path}/{span['name']}" if parent_path else span["name"]
+            span_durations[path] = span_durations.get(path, 0) + span["duration"]
+            add_span_durations(span["children"], path)
+
+    add_span_durations(report["spans"], "")
 
-        print(self.done_format_func(duration))
+    if span_durations:
+        lines += [
+            f"# HELP {PROMETHEUS_PREFIX}_span_duration_seconds How long each part of the last run took.",
+            f"# TYPE {PROMETHEUS_PREFIX}_span_duration_seconds gauge",
+        ]
+        lines += [f'{PROMETHEUS_PREFIX}_span_duration_seconds{{span="{path}"}} {duration:.6f}'
+                  for path, duration in span_durations.items()]
 
-        return False
\ No newline at end of file
+    return "\n".join(lines) + "\n"